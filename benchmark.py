@@ -0,0 +1,106 @@
+import os
+import copy
+import time
+import torch
+import numpy as np
+from optimization.image_editor import ImageEditor
+from optimization.arguments import get_arguments
+from optimization.guidance import gaze_window
+from models.guided_diffusion.respace import space_timesteps
+
+
+# Every configuration overrides some of the command line arguments.
+# They all run on the same aligned frames (./data/src/aligned and ./data/dst/aligned),
+# so run main.py (or main.py --merge_crop_only) once before benchmarking.
+# The samplers: the default DDPM against DDIM with fewer steps (a quarter of the steps is skipped in all of them)
+CONFIGURATIONS = {
+    "exact gradient": {"guidance_grad": "exact"},
+    "detached gradient": {"guidance_grad": "detached"},
+    "ddpm 100 steps": {"ddim": False, "dpm_solver": False, "parallel": False, "timestep_respacing": "100", "skip_timesteps": 25},
+    "ddim 25 steps": {"ddim": True, "dpm_solver": False, "timestep_respacing": "25", "skip_timesteps": 6},
+    "ddim 20 steps": {"ddim": True, "dpm_solver": False, "timestep_respacing": "20", "skip_timesteps": 5},
+    "ddim 10 steps": {"ddim": True, "dpm_solver": False, "timestep_respacing": "10", "skip_timesteps": 2},
+    "dpm-solver++ 20 steps": {"dpm_solver": True, "solver_order": 2, "timestep_respacing": "20", "skip_timesteps": 5},
+    "dpm-solver++ 10 steps": {"dpm_solver": True, "solver_order": 2, "timestep_respacing": "10", "skip_timesteps": 2},
+    "parallel ddpm 100 steps": {"ddim": False, "dpm_solver": False, "parallel": True, "timestep_respacing": "100", "skip_timesteps": 25},
+}
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def check_configuration(args, name, overrides):
+    # Every configuration has to sample some steps with the gaze guidance, otherwise it is not comparable
+    args = copy.deepcopy(args)
+    for key, value in overrides.items():
+        setattr(args, key, value)
+
+    num_timesteps = len(space_timesteps(1000, args.timestep_respacing))
+    sampled = torch.arange(num_timesteps - args.skip_timesteps)
+    if not gaze_window(sampled, num_timesteps).any():
+        raise ValueError(f"{name}: no sampled step is in the gaze window")
+
+
+def run_configuration(args, name, overrides):
+    args = copy.deepcopy(args)
+    for key, value in overrides.items():
+        setattr(args, key, value)
+
+    # Keep the benchmark outputs away from the real results
+    output_path = os.path.join("./data/benchmark", name.replace(" ", "_"))
+    args.output_path = output_path
+    image_editor = ImageEditor(args)
+    image_editor.preded_path = output_path + "/preded/"
+    os.makedirs(image_editor.preded_path, exist_ok=True)
+
+    device = image_editor.device
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    synchronize(device)
+    start = time.perf_counter()
+    distances = image_editor.edit_image_by_prompt()
+    synchronize(device)
+    elapsed = time.perf_counter() - start
+
+    samples = max(len(distances), 1)
+    steps = image_editor.diffusion.num_timesteps - args.skip_timesteps
+    peak_memory = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == "cuda" else float("nan")
+
+    return {
+        "name": name,
+        "samples": len(distances),
+        "sec_per_sample": elapsed / samples,
+        "ms_per_step": elapsed / (samples * steps) * 1000,
+        "peak_memory": peak_memory,
+        "id_mean": float(np.mean(distances)) if distances else float("nan"),
+        "id_std": float(np.std(distances)) if distances else float("nan"),
+    }
+
+
+def print_table(results):
+    print("| configuration | samples | s / sample | ms / step | peak memory (MB) | ID distance |")
+    print("|---|---|---|---|---|---|")
+    for r in results:
+        print(
+            f"| {r['name']} | {r['samples']} | {r['sec_per_sample']:.2f} | {r['ms_per_step']:.1f} "
+            f"| {r['peak_memory']:.0f} | {r['id_mean']:.4f} ± {r['id_std']:.4f} |"
+        )
+
+
+if __name__ == "__main__":
+
+    # Same arguments as main.py, they are the baseline every configuration starts from
+    args = get_arguments()
+
+    results = []
+    for name, overrides in CONFIGURATIONS.items():
+        check_configuration(args, name, overrides)
+
+    for name, overrides in CONFIGURATIONS.items():
+        print(f"Benchmarking {name}")
+        results.append(run_configuration(args, name, overrides))
+
+    print_table(results)
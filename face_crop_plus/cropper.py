@@ -2,19 +2,20 @@ import os
 import cv2
 import tqdm
 import torch
-import json
-import piexif
-import piexif.helper
 import numpy as np
-from PIL import Image
+
+import queue
+import threading
+import multiprocessing
 
 from functools import partial
-from collections import defaultdict
+from collections import defaultdict, deque
 from multiprocessing.pool import ThreadPool
 
 from .models import BiSeNet
 from .models import RRDBNet
 from .models import RetinaFace
+from .tracker import LandmarkTracker
 
 from .utils import (
     STANDARD_LANDMARKS_5, 
@@ -23,7 +24,14 @@ from .utils import (
     as_numpy, 
     as_tensor,
     read_images,
+    read_source,
     as_batch,
+    get_batch_size,
+    sort_by_bucket,
+    save_index,
+    to_shared_memory,
+    from_shared_memory,
+    StageStats,
 )
 
 
@@ -157,6 +165,12 @@ class Cropper():
         batch_size: int = 8,
         num_processes: int = 1,
         device: str | torch.device = "cpu",
+        track_interval: int | None = None,
+        track_confidence: float = 0.6,
+        backend: str = "thread",
+        torch_threads: int | None = None,
+        aspect_buckets: bool = False,
+        det_tile_size: int | None = None,
     ):
         """Initializes the cropper.
 
@@ -303,6 +317,56 @@ class Cropper():
                 parsing. If landmarks are provided, no enhancement and 
                 no parsing is desired, then this has no effect. Defaults
                 to "cpu".
+            track_interval: If specified, the images are treated as 
+                consecutive video frames (in file name order) and the 
+                detection model only runs on keyframes: the first frame, 
+                scene cuts and every ``track_interval`` frames. The 
+                landmarks of the frames in between are tracked with 
+                optical flow, see :class:`.LandmarkTracker`. The 
+                directories are then processed sequentially, on a single 
+                process. If None, every image is detected. Defaults to 
+                None.
+            track_confidence: The minimum fraction of reliably tracked 
+                features of a face. If tracking is less confident, the 
+                frame is detected instead. Defaults to 0.6.
+            backend: How :meth:`process_dir` runs ``num_processes`` 
+                workers. The available options are:
+
+                    * "thread" - worker threads sharing this cropper 
+                      (and its models).
+                    * "pipeline" - the loading, inference and saving of 
+                      consecutive batches overlap on 3 threads, see 
+                      :meth:`process_batches_pipelined`.
+                    * "process" - worker processes, each with its own 
+                      copy of the models (loaded once per process). The 
+                      images are read by the main process and passed to 
+                      the workers through shared memory.
+
+                Tracking (see ``track_interval``) is sequential, so it 
+                never runs on worker processes. Defaults to "thread".
+            torch_threads: The number of torch intra-op threads of every 
+                worker process (only for the "process" backend). If 
+                None, the CPU cores are split evenly between the 
+                processes. Defaults to None.
+            aspect_buckets: Whether to batch the images for detection 
+                in aspect ratio buckets instead of letterboxing all of 
+                them to ``resize_size``. A batch of images of the same 
+                bucket (e.g., 16:9 video frames) is resized + padded to 
+                the shape of the bucket (e.g., 1024×576 instead of 
+                1024×1024), so the detection model runs on much less 
+                padding. Mixed batches fall back to ``resize_size``, so 
+                :meth:`process_dir` sorts the images by bucket (unless 
+                tracking). See :func:`.utils.get_bucket_size`. Defaults 
+                to False.
+            det_tile_size: If specified, faces are detected on 
+                overlapping tiles of this size of the images at their 
+                native (full) resolution, instead of on the images 
+                resized to ``resize_size``, so that small faces in large 
+                images are found without enhancement. See 
+                :meth:`.RetinaFace.predict_tiled` (and 
+                :meth:`detect_tiled`). It is not used when tracking or 
+                enhancing. If None, images are detected at 
+                ``resize_size``. Defaults to None.
         """
         # Init specified attributes
         self.output_size = output_size
@@ -320,6 +384,16 @@ class Cropper():
         self.batch_size = batch_size
         self.num_processes = num_processes
         self.device = device
+        self.backend = backend
+        self.torch_threads = torch_threads
+        self.aspect_buckets = aspect_buckets
+        self.det_tile_size = det_tile_size
+        self.tracker = None
+
+        if track_interval is not None:
+            # Track landmarks between keyframes
+            args = (track_interval, track_confidence)
+            self.tracker = LandmarkTracker(*args)
 
         # The only option for STD
         self.num_std_landmarks = 5
@@ -347,6 +421,17 @@ class Cropper():
         self._init_models()
         self._init_landmarks_target()
     
+    def __getstate__(self) -> dict:
+        """Pickles the cropper without its models.
+
+        The models are not sent to the worker processes, each of them 
+        loads its own copy (see :func:`_init_worker`).
+        """
+        state = self.__dict__.copy()
+        state.update({"det_model": None, "enh_model": None, "par_model": None})
+
+        return state
+
     def _init_models(self):
         """Initializes detection, enhancement and parsing models.
 
@@ -448,6 +533,7 @@ class Cropper():
         padding: np.ndarray | None,
         indices: list[int],
         landmarks_source: np.ndarray,
+        sources: list[np.ndarray | str] | None = None,
     ) -> tuple[np.ndarray, list[int]]:
         """Aligns and center-crops faces based on the given landmarks.
 
@@ -502,6 +588,13 @@ class Cropper():
                 (num_faces, ``self.num_std_landmarks``, 2). These are 
                 landmark sets of all the desired faces to extract from 
                 the given batch of N images.
+            sources: The full resolution versions of the N images, 
+                either as RGB :attr:`numpy.uint8` numpy arrays or as 
+                paths (read only if the image has faces). If specified, 
+                the landmarks are scaled to them and the faces are 
+                cropped from them instead of from ``images``, which can 
+                then be of lower resolution. The meta data refers to 
+                the full resolution images. Defaults to None.
 
         Returns:
             A batch of aligned and center-cropped faces where the factor 
@@ -511,12 +604,35 @@ class Cropper():
             structure as for the input images). (H, W) is defined by 
             ``self.output_size``.
         """
-        # Init list, border mode
+        # Init list, border mode, loaded full resolution images
         transformed_images = []
         transformed_meta = []
         border_mode = getattr(cv2, f"BORDER_{self.padding.upper()}")
+        full_images = {}
 
         for landmarks_idx, image_idx in enumerate(indices):
+            # Retrieve current image and the landmarks in it
+            image = images[image_idx]
+            landmarks = landmarks_source[landmarks_idx]
+
+            if padding is not None:
+                # Crop out the un-padded area
+                [t, b, l, r] = padding[image_idx]
+                image = image[t:image.shape[0]-b, l:image.shape[1]-r]
+
+            if sources is not None:
+                if image_idx not in full_images:
+                    # Only images with faces are read at full resolution
+                    full_images[image_idx] = read_source(sources[image_idx])
+
+                # Warp the full resolution image instead (scale landmarks)
+                full_image = full_images[image_idx]
+                scale = np.float32([
+                    full_image.shape[1] / image.shape[1],
+                    full_image.shape[0] / image.shape[0],
+                ])
+                image, landmarks = full_image, landmarks * scale
+
             if self.allow_skew:
                 # Perform full perspective transformation
                 transform_function = cv2.estimateAffine2D
@@ -526,7 +642,7 @@ class Cropper():
             
             # Estimate transformation matrix to apply
             transform_matrix = transform_function(
-                landmarks_source[landmarks_idx],
+                landmarks,
                 self.landmarks_target,
                 ransacReprojThreshold=np.inf,
             )[0]
@@ -535,18 +651,6 @@ class Cropper():
                 # Could not estimate
                 continue
 
-            # Retrieve current image
-            image = images[image_idx]
-
-            #cv2.imwrite("./output/im1.jpg", image) #1024x1024 black
-
-            if padding is not None:
-                # Crop out the un-padded area
-                [t, b, l, r] = padding[image_idx]
-                image = image[t:image.shape[0]-b, l:image.shape[1]-r]
-
-            cv2.imwrite("./data/debug/base.jpg", image) #1024x576
-
             # Apply affine transformation to the image
             transformed_image = cv2.warpAffine(
                 image,
@@ -576,7 +680,12 @@ class Cropper():
             width = max_x - min_x
             height = max_y - min_y
 
-            transformed_meta.append([x, y, width, height, image.shape[1], image.shape[0], inverse_transform_matrix])
+            # The landmarks in the aligned face, relative to the output size
+            # (the editor derives the eye boxes for the gaze loss from them)
+            aligned_landmarks = cv2.transform(landmarks.reshape(-1, 1, 2).astype(np.float32), transform_matrix).reshape(-1, 2)
+            aligned_landmarks /= np.float32(self.output_size)
+
+            transformed_meta.append([x, y, width, height, image.shape[1], image.shape[0], inverse_transform_matrix, aligned_landmarks])
         
         # Normally stacking would be applied unless the list is empty
         numpy_fn = np.stack if len(transformed_images) > 0 else np.array
@@ -584,54 +693,13 @@ class Cropper():
         # return 
         return numpy_fn(transformed_images), transformed_meta
 
-    def save_meta(self, image, meta, path):
-      # Save the image using OpenCV
-      cv2.imwrite(path, image)
-
-      mypath = path
-      # convert to JPG if not the case
-      if not path.endswith(".jpg"):
-        im = Image.open(path)
-        mypath = path.replace(".png", ".jpg")
-        im.save(mypath)
-        os.remove(path)
-
-      # Convert the transform_matrix to a nested Python list
-      inverted = meta[6].tolist()
-      # Serialize the transform_matrix_list to a JSON string
-      inverted = json.dumps(inverted)
-
-      # Define metadata
-      metadata = {
-        "x": float(meta[0]),
-        "y": float(meta[1]),
-        "w": int(meta[2]),
-        "h": int(meta[3]),
-        "parentw": int(meta[4]), # width of parent image (to calc aspect ratio)
-        "parenth": int(meta[5]),
-        "inverse": inverted
-      }
-
-      # load existing exif data from image
-      exif_dict = piexif.load(mypath)
-      # insert custom data in usercomment field
-      exif_dict["Exif"][piexif.ExifIFD.UserComment] = piexif.helper.UserComment.dump(
-          json.dumps(metadata),
-          encoding="unicode"
-      )
-      # insert mutated data (serialised into JSON) into image
-      piexif.insert(
-          piexif.dump(exif_dict),
-          mypath
-      )
-    
     def save_group(
         self,
         faces: np.ndarray,
         file_names: list[str],
         output_dir: str,
-        transformed_meta: np.ndarray
-    ):
+        transformed_meta: list[list] | None = None,
+    ) -> list[dict]:
         """Saves a group of images to output directory.
 
         Takes in a batch of faces or masks as well as corresponding file 
@@ -653,14 +721,28 @@ class Cropper():
                 multiple faces to be extracted from the same file, such 
                 as "all", counters at the end of filenames are added.
             output_dir: The output directory to save ``faces``.
+            transformed_meta: The crop metadata of every face (see 
+                :meth:`crop_align`) or None if the faces were not 
+                aligned. Defaults to None.
+
+        Returns:
+            The list of the index records (see 
+            :func:`.utils.save_index`, without the frame index) of the 
+            saved faces, with full file paths as names. Masks and 
+            unaligned faces have no record.
         """
         if len(faces) == 0:
             # Just return
-            return
+            return []
         
-        # Create output directory, name counts
+        # Create output directory, name counts, index records
         os.makedirs(output_dir, exist_ok=True)
         file_name_counts = defaultdict(lambda: -1)
+        records = []
+
+        if transformed_meta is None:
+            # No alignment, no metadata
+            transformed_meta = [None] * len(faces)
 
         for face, file_name, meta in zip(faces, file_names, transformed_meta):
             # Split each filename to base name, ext
@@ -681,19 +763,30 @@ class Cropper():
 
             # Make image path based on file format and save
             file_path = os.path.join(output_dir, name + ext)
-            # cv2.imwrite(file_path, face)
-            self.save_meta(face, meta, file_path)
-
+            cv2.imwrite(file_path, face)
+
+            if face.ndim == 3 and meta is not None:
+                # meta = [x, y, w, h, parentw, parenth, inverse, landmarks]
+                records.append({
+                    "name": file_path,
+                    "source": str(file_name),
+                    "bbox": meta[:4],
+                    "parent": meta[4:6],
+                    "inverse": meta[6],
+                    "landmarks": meta[7],
+                })
+
+        return records
     
     def save_groups(
         self,
         faces: np.ndarray,
         file_names: np.ndarray,
         output_dir: str,
-        transformed_meta: list[int],
+        transformed_meta: list[list] | None,
         attr_groups: dict[str, list[int]] | None,
         mask_groups: dict[str, tuple[list[int], np.ndarray]] | None,
-    ):
+    ) -> list[dict]:
         """Saves images (and masks) group-wise.
 
         This method takes a batch of face images of equal dimensions, a 
@@ -797,7 +890,14 @@ class Cropper():
                 numpy arrays of shape (N, H, W) with values of type 
                 :attr:`numpy.uint8` and being either 0 (negative) or 255 
                 (positive).
+
+        Returns:
+            The list of the index records of the saved faces (see 
+            :meth:`save_group`), with names relative to ``output_dir``.
         """
+        # Index records of the saved faces
+        records = []
+
         if attr_groups is None:
             # No-name group of idx mapping to all faces
             attr_groups = {'': list(range(len(faces)))}
@@ -815,65 +915,206 @@ class Cropper():
                 # Retrieve group values & save
                 face_group = [faces[idx] for idx in group_idx]
                 file_name_group = file_names[group_idx]
-                self.save_group(face_group, file_name_group, group_dir, transformed_meta)
+                meta_group = None if not transformed_meta else [transformed_meta[idx] for idx in group_idx]
+                records += self.save_group(face_group, file_name_group, group_dir, meta_group)
 
                 if masks is not None:
                     # Save to masks dir
                     group_dir += "_mask"
                     masks = masks[[mask_indices.index(i) for i in group_idx]]
-                    self.save_group(masks, file_name_group, group_dir, transformed_meta)
+                    self.save_group(masks, file_name_group, group_dir)
+
+        for record in records:
+            # Names relative to the output dir (where the index is)
+            record["name"] = os.path.relpath(record["name"], output_dir)
+
+        return records
     
-    def process_batch(self, file_names: list[str], input_dir: str, output_dir: str):
-        """Extracts faces from a batch of images and saves them.
+    def track(
+        self,
+        images: np.ndarray,
+        paddings: np.ndarray,
+    ) -> tuple[np.ndarray, list[int]]:
+        """Gets the landmarks of consecutive video frames by tracking.
 
-        Takes file names, input directory, reads images and extracts 
-        faces and saves them to the output directory. This method works 
-        as follows:
+        The detection model only runs on keyframes (as a single batch) 
+        and on the frames where the tracker is not confident enough, 
+        the landmarks of the other frames are propagated from the 
+        previous frame by ``self.tracker``. For more details, see 
+        :class:`.LandmarkTracker`.
 
-            1. *Batch generation* - a batch of images form the given 
-               file names is generated. Each images is padded and 
-               resized to ``self.resize_size`` while keeping the same 
-               aspect ratio.
-            2. *Landmark detection* - detection model is used to predict 
-               5 landmarks for each face in each image, unless the 
-               landmarks were already initialized  or face alignment + 
-               cropping is not needed.
-            3. *Image enhancement* - some images are enhanced if the 
-               faces compared with the image size are small. If 
-               landmarks are None, i.e., if no alignment + cropping was 
-               desired, all images are enhanced. Enhancement is not done 
-               if ``self.enh_threshold`` is None.
-            4. *Image grouping* - each face image is parsed, i.e., a map 
-               of face attributes is generated. Based on those 
-               attributes, each face image is put to a corresponding 
-               group. There may also be mask groups, in which case masks 
-               for each image in that group are also generated. Faces 
-               are not parsed if ``self.attr_groups`` and 
-               ``self.mask_groups`` are both None.
-            5. *Image saving* - each face image (and a potential mask) 
-               is saved according to the group structure (if there is 
-               any).
-        
-        Note:
-            If detection model is not used, then batch is just a list of 
-            loaded images of different dimensions.
+        Args:
+            images: Resized and padded frames of shape (N, H, W, 3) of 
+                type :attr:`numpy.uint8`, in order (see 
+                :func:`.utils.as_batch`).
+            paddings: Their paddings of shape (N, 4) (top, bottom, left, 
+                right).
+
+        Returns:
+            A tuple where the first element is a numpy array of shape 
+            (``num_faces``, 5, 2) with the un-padded landmarks of every 
+            face and the second element is the list of the frame 
+            indices of every face.
+        """
+        # Un-padded gray frames, where the landmarks are tracked
+        grays = [
+            cv2.cvtColor(image[t:image.shape[0]-b, l:image.shape[1]-r], cv2.COLOR_RGB2GRAY)
+            for image, (t, b, l, r) in zip(images, paddings)
+        ]
+
+        def detect(frame_indices):
+            # Predict landmarks for the given frames, undo padding
+            batch = as_tensor(images[frame_indices], self.device)
+            landmarks, indices = self.det_model.predict(batch)
+            landmarks -= paddings[frame_indices][indices][:, None, [2, 0]]
+
+            return {i: landmarks[np.array(indices) == j] 
+                    for j, i in enumerate(frame_indices)}
+
+        # Find the keyframes and detect them at once
+        keyframes, hists = self.tracker.plan(grays)
+        keyframe_indices = [i for i, is_key in enumerate(keyframes) if is_key]
+        detected = detect(keyframe_indices) if keyframe_indices else {}
+
+        # Track the other frames (detect them if tracking fails)
+        return self.tracker.track(grays, hists, keyframes, detected, 
+                                  lambda i: detect([i])[i])
+
+    def detect_tiled(
+        self,
+        sources: list[np.ndarray],
+        images: np.ndarray,
+        paddings: np.ndarray,
+    ) -> tuple[np.ndarray, list[int]]:
+        """Detects faces in full resolution images, tile by tile.
+
+        The landmarks are detected by :meth:`.RetinaFace.predict_tiled` 
+        with tiles of ``self.det_tile_size`` (overlapping by 1/8 of it) 
+        and then scaled to the un-padded images of the batch, as if 
+        they were detected in it, so :meth:`crop_align` scales them 
+        back to the full images.
 
         Args:
-            file_names: The list of image file names (not full paths). 
-                All the images should be in the same directory.
-            input_dir: Path to input directory with image files.
-            output_dir: Path to output directory to save the extracted 
-                face images.
+            sources: The full resolution RGB images.
+            images: The resized + padded batch of shape (N, H, W, 3) 
+                (see :meth:`prepare_images`).
+            paddings: Its paddings of shape (N, 4) (top, bottom, left, 
+                right).
+
+        Returns:
+            A tuple where the first element is a numpy array of shape 
+            (``num_faces``, 5, 2) with the un-padded landmarks of every 
+            face and the second element is the list of the image 
+            indices of every face.
         """
-        # Read images and filter valid corresponding file names
-        images, file_names = read_images(file_names, input_dir)
+        # Detect the tiles of every image, self.batch_size at a time (the 
+        # sources stay on the CPU, only the tiles go to the device)
+        args = (self.det_tile_size, self.det_tile_size // 8, self.batch_size)
+        sources_chw = [torch.from_numpy(x).permute(2, 0, 1) for x in sources]
+        landmarks, indices = self.det_model.predict_tiled(sources_chw, *args)
+
+        for i, (t, b, l, r) in enumerate(paddings):
+            # Scale to the size of the un-padded image in the batch
+            size = (images.shape[2] - l - r, images.shape[1] - t - b)
+            scale = np.float32(size) / np.float32(sources[i].shape[1::-1])
+            landmarks[np.array(indices) == i] *= scale
+
+        return landmarks, indices
+
+    def prepare_images(
+        self,
+        images: list[np.ndarray] | np.ndarray,
+        paddings: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray | None]:
+        """Resizes and pads images to a batch for the detection model.
+
+        Does nothing if the detection model is not used (the images are 
+        not batched) or if the images were already prepared (i.e., if 
+        ``paddings`` are given). This is the CPU work that can be done 
+        ahead of :meth:`process_images`, e.g., on a loading thread.
+
+        Args:
+            images: The list of RGB images of type :attr:`numpy.uint8`.
+            paddings: The paddings of the images if they were already 
+                prepared. Defaults to None.
+
+        Returns:
+            A tuple where the first element is the batch of images of 
+            shape (N, H, W, 3) (or the unchanged images) and the second 
+            element is the paddings of shape (N, 4) (or None), see 
+            :func:`.utils.as_batch`.
+        """
+        if paddings is not None or self.landmarks is not None or self.det_model is None:
+            # Already prepared or no detection
+            return images, paddings
+
+        # The shape of the batch (the aspect ratio bucket of the images)
+        size = self.resize_size
+
+        if self.aspect_buckets:
+            size = get_batch_size(images, size)
+
+        images, _, paddings = as_batch(images, size)
+
+        return images, paddings
+
+    def process_images(
+        self,
+        images: list[np.ndarray] | np.ndarray,
+        file_names: np.ndarray | None = None,
+        paddings: np.ndarray | None = None,
+        sources: list[np.ndarray | str] | None = None,
+    ) -> tuple[np.ndarray, list[int], list[list], tuple]:
+        """Extracts faces from a batch of images in memory.
+
+        Performs steps 2 to 4 of :meth:`process_batch` (landmark 
+        detection, enhancement, alignment + cropping and grouping) 
+        without reading or saving anything, e.g., for frames decoded 
+        from a video stream.
+
+        Args:
+            images: The list of RGB images of type :attr:`numpy.uint8` 
+                (they can have different shapes).
+            file_names: The file names of the images. They are only 
+                needed if landmarks were initialized from a landmarks 
+                file (to look up the landmarks of every image). Defaults 
+                to None.
+            paddings: If the images were already resized and padded to 
+                a batch for the detection model (see 
+                :meth:`prepare_images`), their paddings of shape (N, 4). 
+                Defaults to None.
+            sources: The full resolution images (or their paths) to 
+                crop the detected faces from, if ``images`` are of lower 
+                resolution (see :meth:`load_images`). If None and the 
+                images are not prepared, the faces are cropped from the 
+                given images before they are resized for detection. Not 
+                used if images are enhanced. Defaults to None.
+
+        Returns:
+            A tuple of 4 elements: the extracted faces (a numpy array 
+            of shape (num_faces, H, W, 3)), the list of length 
+            num_faces of the index of the image each face comes from, 
+            the meta data of every face (see :meth:`crop_align`, empty 
+            if no alignment was done) and the attribute and mask groups 
+            (both None if no face parsing was done).
+        """
+        # No metadata unless the faces are aligned
+        transformed_meta = []
+
+        if self.det_model is None or self.landmarks is not None or \
+           self.enh_model is not None:
+            # Faces are cropped from the batch (e.g., enhanced)
+            sources = None
+        elif sources is None and paddings is None:
+            # Crop from the original images, not from the resized ones
+            sources = list(images)
 
         if self.landmarks is None and self.det_model is None:
             # One-to-one image to index mapping and no landmarks
-            indices, landmarks = list(range(len(file_names))), None
+            indices, landmarks = list(range(len(images))), None
         elif self.landmarks is not None:
-            # Initialize empty idx lists and None paddings
-            indices, indices_ldm, paddings = [], [], None
+            # Initialize empty idx lists
+            indices, indices_ldm = [], []
 
             for i, file_name in enumerate(file_names):
                 # Check the indices of landmark sets in landmarks file
@@ -890,18 +1131,33 @@ class Cropper():
             # Set landmarks according to the indices
             landmarks = self.landmarks[0][indices_ldm]
             
+        elif self.det_model is not None and self.tracker is not None:
+            # Create a batch of images (with faces) and their paddings
+            images, paddings = self.prepare_images(images, paddings)
+
+            # Detect the keyframes only, track the landmarks in between
+            landmarks, indices = self.track(images, paddings)
+            images = as_tensor(images, self.device)
+        elif self.det_model is not None and self.det_tile_size is not None \
+             and sources is not None:
+            # Read the full images once (for detection and cropping)
+            sources = [read_source(source) for source in sources]
+            images, paddings = self.prepare_images(images, paddings)
+
+            # Detect at native resolution, in the batch coordinates
+            landmarks, indices = self.detect_tiled(sources, images, paddings)
         elif self.det_model is not None:
              # Create a batch of images (with faces) and their paddings
-            images, _, paddings = as_batch(images, self.resize_size)
-            images, paddings = as_tensor(images, self.device), paddings
+            images, paddings = self.prepare_images(images, paddings)
+            images = as_tensor(images, self.device)
 
             # If landmarks were not given, predict, undo padding
             landmarks, indices = self.det_model.predict(images)
             landmarks -= paddings[indices][:, None, [2, 0]]
 
         if landmarks is not None and len(landmarks) == 0:
-            # Nothing to save
-            return
+            # No faces
+            return np.array([]), [], [], (None, None)
             
         if landmarks is not None and landmarks.shape[1] != self.num_std_landmarks:
             # Compute the mean landmark coordinates from retrieved slices
@@ -918,15 +1174,210 @@ class Cropper():
 
         if landmarks is not None:    
             # Generate source, target landmarks, estimate & apply transform
-            images, transformed_meta = self.crop_align(images, paddings, indices, landmarks)
+            args = (images, paddings, indices, landmarks, sources)
+            images, transformed_meta = self.crop_align(*args)
 
         if self.par_model is not None:
             # Predict attribute and mask groups if face parsing desired
             groups = self.par_model.predict(as_tensor(images, self.device))
 
+        return images, list(indices), transformed_meta, groups
+
+    def process_batch(
+        self,
+        file_names: list[str],
+        input_dir: str,
+        output_dir: str,
+    ) -> list[dict]:
+        """Extracts faces from a batch of images and saves them.
+
+        Takes file names, input directory, reads images and extracts 
+        faces and saves them to the output directory. This method works 
+        as follows:
+
+            1. *Batch generation* - a batch of images form the given 
+               file names is generated. Each images is padded and 
+               resized to ``self.resize_size`` while keeping the same 
+               aspect ratio.
+            2. *Landmark detection* - detection model is used to predict 
+               5 landmarks for each face in each image, unless the 
+               landmarks were already initialized  or face alignment + 
+               cropping is not needed.
+            3. *Image enhancement* - some images are enhanced if the 
+               faces compared with the image size are small. If 
+               landmarks are None, i.e., if no alignment + cropping was 
+               desired, all images are enhanced. Enhancement is not done 
+               if ``self.enh_threshold`` is None.
+            4. *Image grouping* - each face image is parsed, i.e., a map 
+               of face attributes is generated. Based on those 
+               attributes, each face image is put to a corresponding 
+               group. There may also be mask groups, in which case masks 
+               for each image in that group are also generated. Faces 
+               are not parsed if ``self.attr_groups`` and 
+               ``self.mask_groups`` are both None.
+            5. *Image saving* - each face image (and a potential mask) 
+               is saved according to the group structure (if there is 
+               any).
+        
+        Note:
+            If detection model is not used, then batch is just a list of 
+            loaded images of different dimensions.
+
+        Args:
+            file_names: The list of image file names (not full paths). 
+                All the images should be in the same directory.
+            input_dir: Path to input directory with image files.
+            output_dir: Path to output directory to save the extracted 
+                face images.
+
+        Returns:
+            The list of the index records of the saved faces (see 
+            :meth:`save_groups`).
+        """
+        # Read images and filter valid corresponding file names
+        images, file_names, sources = self.load_images(file_names, input_dir)
+
+        return self.save_images(images, file_names, output_dir, sources)
+
+    def load_images(
+        self,
+        file_names: list[str],
+        input_dir: str,
+    ) -> tuple[list[np.ndarray], np.ndarray, list[str] | None]:
+        """Reads images for processing.
+
+        If the faces are detected, the images are only needed at the 
+        detection resolution (``self.resize_size``), so large JPEG 
+        images are decoded at a reduced resolution (see 
+        :func:`.utils.reduced_read_flag`). The faces are then cropped 
+        from the full resolution images, which are read again only if 
+        they have faces (see :meth:`crop_align`).
+
+        Args:
+            file_names: The list of image file names.
+            input_dir: Path to input directory with image files.
+
+        Returns:
+            A tuple of 3 elements: the list of RGB images, the file 
+            names of the images that were read (see 
+            :func:`.utils.read_images`) and the paths of the full 
+            resolution images (None if the images are full resolution).
+        """
+        if self.det_model is None or self.landmarks is not None:
+            # Images are processed at their own resolution
+            return *read_images(file_names, input_dir), None
+
+        images, file_names = read_images(file_names, input_dir, self.resize_size)
+        sources = [os.path.join(input_dir, file_name) for file_name in file_names]
+
+        return images, file_names, sources
+
+    def save_images(
+        self,
+        images: list[np.ndarray],
+        file_names: np.ndarray,
+        output_dir: str,
+        sources: list[str] | None = None,
+    ) -> list[dict]:
+        """Extracts faces from a batch of loaded images and saves them.
+
+        Args:
+            images: The list of RGB images of type :attr:`numpy.uint8`.
+            file_names: The file names of the images (used to name the 
+                faces).
+            output_dir: Path to output directory to save the extracted 
+                face images.
+            sources: The paths of the full resolution images if 
+                ``images`` were read at a reduced resolution (see 
+                :meth:`load_images`). Defaults to None.
+
+        Returns:
+            The list of the index records of the saved faces (see 
+            :meth:`save_groups`).
+        """
+        # Extract the faces (in memory)
+        faces, indices, transformed_meta, groups = self.process_images(images, file_names, sources=sources)
+
+        if len(indices) == 0:
+            # Nothing to save
+            return []
+
         # Pick file names for each face, save faces (by groups if exist)
-        self.save_groups(images, file_names[indices], output_dir, transformed_meta, *groups)
-    
+        return self.save_groups(faces, file_names[indices], output_dir, transformed_meta, *groups)
+
+    def process_batches_parallel(
+        self,
+        file_batches: list[list[str]],
+        input_dir: str,
+        output_dir: str,
+        desc: str | None = "Processing",
+    ) -> list[dict]:
+        """Processes batches of images on worker processes.
+
+        Each of the ``self.num_processes`` worker processes loads its 
+        own models once (see :func:`_init_worker`). The main process 
+        reads every batch of images and copies it to a shared memory 
+        block, a worker maps it, extracts and saves the faces (see 
+        :meth:`save_images`) and returns the index records. At most 2 
+        batches per worker are in flight at once, and the results are 
+        collected in the order of the batches.
+
+        Args:
+            file_batches: The batches of image file names.
+            input_dir: Path to input directory with image files.
+            output_dir: Path to output directory to save the extracted 
+                face images.
+            desc: The description to use for the progress bar. If 
+                specified as ``None``, no progress bar is shown. 
+                Defaults to "Processing".
+
+        Returns:
+            The list of the index records of all the saved faces.
+        """
+        # Split the cores between the workers unless specified
+        threads = self.torch_threads or max(1, (os.cpu_count() or 1) // self.num_processes)
+        context = multiprocessing.get_context("spawn")
+        pbar = tqdm.tqdm(total=len(file_batches), desc=desc, disable=desc is None)
+        records, pending = [], deque()
+
+        def collect():
+            # Wait for the oldest batch, free its shared memory
+            shm, result = pending.popleft()
+
+            try:
+                records.extend(result.get())
+            finally:
+                shm.close()
+                shm.unlink()
+                pbar.update()
+
+        with context.Pool(self.num_processes, _init_worker, (self, threads)) as pool:
+            try:
+                for file_names in file_batches:
+                    # Read images, pass them through shared memory
+                    images, file_names, sources = self.load_images(file_names, input_dir)
+                    shm, specs = to_shared_memory(images)
+                    args = (shm.name, specs, file_names, output_dir, sources)
+                    pending.append((shm, pool.apply_async(_process_shared, args)))
+
+                    if len(pending) >= 2 * self.num_processes:
+                        # Enough work queued
+                        collect()
+                
+                while len(pending) > 0:
+                    # Collect the remaining batches
+                    collect()
+            finally:
+                while len(pending) > 0:
+                    # Free the shared memory of unfinished batches
+                    shm, _ = pending.popleft()
+                    shm.close()
+                    shm.unlink()
+                
+                pbar.close()
+
+        return records
+
     def process_dir(
         self, 
         input_dir: str, 
@@ -941,7 +1392,9 @@ class Cropper():
         landmarks are generated and used to optionally align and 
         center-crop faces, and grouping is optionally applied based on
         face attributes. For more details, check 
-        :meth:`process_batch`.
+        :meth:`process_batch`. The crop metadata of all the aligned 
+        faces is saved to a single index in the output directory (see 
+        :func:`.utils.save_index`).
 
         Note:
             There might be a few seconds delay before the actual 
@@ -965,23 +1418,243 @@ class Cropper():
 
         # Create batches of image file names in input dir
         files, bs = os.listdir(input_dir), self.batch_size
+
+        if self.tracker is not None:
+            # Frames must be tracked in order, from a new start
+            files = sorted(files)
+            self.tracker.reset()
+        elif self.aspect_buckets and self.det_model is not None:
+            # Batch the images of the same aspect ratio together
+            files = sort_by_bucket(files, input_dir, self.resize_size)
+
         file_batches = [files[i:i+bs] for i in range(0, len(files), bs)]
 
         if len(file_batches) == 0:
             # Empty
             return
         
+        if self.backend == "process" and self.tracker is None:
+            # True parallelism, one set of models per process
+            args = (file_batches, input_dir, output_dir, desc)
+            records = self.process_batches_parallel(*args)
+        elif self.backend == "pipeline":
+            # Load, infer and save overlapped on 3 threads
+            args = (file_batches, input_dir, output_dir, desc)
+            records = self.process_batches_pipelined(*args)
+        else:
+            # Worker threads sharing the models of this cropper
+            records = self.process_batches_threaded(file_batches, input_dir, output_dir, desc)
+
+        # Frame index of every source file (its position in the sorted input dir)
+        frames = {file: i for i, file in enumerate(sorted(files))}
+
+        for record in records:
+            record["frame"] = frames[record["source"]]
+
+        if len(records) > 0:
+            # One index (crop metadata of all the faces) per output dir
+            save_index(output_dir, records)
+
+    def process_batches_pipelined(
+        self,
+        file_batches: list[list[str]],
+        input_dir: str,
+        output_dir: str,
+        desc: str | None = "Processing",
+    ) -> list[dict]:
+        """Processes batches of images as an overlapped pipeline.
+
+        Runs 3 stages concurrently, each on its own thread and connected 
+        by bounded queues (of 2 batches):
+
+            1. *Load* - reads the images of batch N+1 (see 
+               :meth:`load_images`) and resizes + pads them for the 
+               detection model (see :meth:`prepare_images`).
+            2. *Infer* - extracts the faces of batch N (detection or 
+               tracking, enhancement, alignment and parsing, see 
+               :meth:`process_images`). It runs on the calling thread.
+            3. *Save* - encodes and writes the faces of batch N-1 (see 
+               :meth:`save_groups`).
+
+        Batches are processed in order. If ``desc`` is not None, the 
+        busy time and utilisation of every stage is printed at the end 
+        (see :class:`.utils.StageStats`), the bottleneck is the stage 
+        close to 100%.
+
+        Args:
+            file_batches: The batches of image file names.
+            input_dir: Path to input directory with image files.
+            output_dir: Path to output directory to save the extracted 
+                face images.
+            desc: The description to use for the progress bar. If 
+                specified as ``None``, no progress bar (and no report) 
+                is shown. Defaults to "Processing".
+
+        Returns:
+            The list of the index records of all the saved faces.
+        """
+        # Stage stats, queues between stages, stop flag and records
+        stats = StageStats(["load", "infer", "save"])
+        loaded, inferred = queue.Queue(maxsize=2), queue.Queue(maxsize=2)
+        stop, errors, records = threading.Event(), [], []
+
+        def put(items, item):
+            # Wait for room unless the pipeline stopped
+            while not stop.is_set():
+                try:
+                    return items.put(item, timeout=0.1)
+                except queue.Full:
+                    pass
+
+        def get(items):
+            # Wait for an item unless the pipeline stopped
+            while not stop.is_set():
+                try:
+                    return items.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+        def run(stage):
+            # Any error stops the pipeline and is raised again below
+            try:
+                stage()
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+        def load():
+            for file_names in file_batches:
+                with stats.measure("load"):
+                    images, file_names, sources = self.load_images(file_names, input_dir)
+                    images, paddings = self.prepare_images(images) if len(images) > 0 else (images, None)
+
+                put(loaded, (images, file_names, paddings, sources))
+
+            put(loaded, None)
+
+        def save():
+            while (item := get(inferred)) is not None:
+                with stats.measure("save"):
+                    faces, file_names, transformed_meta, groups = item
+                    records.extend(self.save_groups(faces, file_names, output_dir, transformed_meta, *groups))
+
+        threads = [threading.Thread(target=run, args=(stage,), daemon=True) for stage in [load, save]]
+        pbar = tqdm.tqdm(total=len(file_batches), desc=desc, disable=desc is None)
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while (item := get(loaded)) is not None:
+                with stats.measure("infer"):
+                    images, file_names, paddings, sources = item
+                    faces, indices = [], []
+
+                    if len(images) > 0:
+                        # Extract the faces (in memory)
+                        args = (images, file_names, paddings, sources)
+                        faces, indices, transformed_meta, groups = self.process_images(*args)
+
+                if len(indices) > 0:
+                    # Save them in the background
+                    put(inferred, (faces, file_names[indices], transformed_meta, groups))
+
+                pbar.update()
+
+            put(inferred, None)
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            # Wait for the last faces to be saved
+            threads[1].join()
+            stop.set()
+            threads[0].join()
+            pbar.close()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+        if desc is not None:
+            # Which stage is the bottleneck
+            print(stats.report())
+
+        return records
+
+    def process_batches_threaded(
+        self,
+        file_batches: list[list[str]],
+        input_dir: str,
+        output_dir: str,
+        desc: str | None = "Processing",
+    ) -> list[dict]:
+        """Processes batches of images on worker threads.
+
+        The ``self.num_processes`` threads share the models of this 
+        cropper (see :meth:`process_batch`). When tracking, a single 
+        thread processes the batches in order.
+
+        Args:
+            file_batches: The batches of image file names.
+            input_dir: Path to input directory with image files.
+            output_dir: Path to output directory to save the extracted 
+                face images.
+            desc: The description to use for the progress bar. If 
+                specified as ``None``, no progress bar is shown. 
+                Defaults to "Processing".
+
+        Returns:
+            The list of the index records of all the saved faces.
+        """
         # Define worker function and its additional arguments
         kwargs = {"input_dir": input_dir, "output_dir": output_dir}
         worker = partial(self.process_batch, **kwargs)
+        num_processes = self.num_processes if self.tracker is None else 1
         
-        with ThreadPool(self.num_processes, self._init_models) as pool:
-            # Create imap object and apply workers to it
-            imap = pool.imap_unordered(worker, file_batches)
+        with ThreadPool(num_processes) as pool:
+            # Create imap object and apply workers to it (in order when 
+            # tracking, each batch starts where the previous one ended)
+            if self.tracker is None:
+                imap = pool.imap_unordered(worker, file_batches)
+            else:
+                imap = pool.imap(worker, file_batches)
             
             if desc is not None:
                 # If description is provided, wrap progress bar around
                 imap = tqdm.tqdm(imap, total=len(file_batches), desc=desc)
             
-            # Process
-            list(imap)
+            # Process, collect the index records of every batch
+            return [record for batch in imap for record in batch]
+
+
+# The cropper of a worker process (see Cropper.process_batches_parallel)
+_worker_cropper = None
+
+def _init_worker(cropper: Cropper, torch_threads: int):
+    """Initializes a worker process: its torch threads and models."""
+    global _worker_cropper
+    torch.set_num_threads(torch_threads)
+    _worker_cropper = cropper
+    _worker_cropper._init_models()
+
+def _process_shared(
+    name: str,
+    specs: list[tuple[int, tuple[int, ...]]],
+    file_names: np.ndarray,
+    output_dir: str,
+    sources: list[str] | None = None,
+) -> list[dict]:
+    """Extracts and saves the faces of a batch in shared memory."""
+    shm, images = from_shared_memory(name, specs)
+
+    try:
+        return _worker_cropper.save_images(images, file_names, output_dir, sources)
+    finally:
+        # Release the views before closing the block
+        del images
+
+        try:
+            shm.close()
+        except BufferError:
+            # Still referenced (by a traceback), freed on exit
+            pass
@@ -4,6 +4,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.models as models
 import torchvision.models._utils as _utils
+from torchvision.ops import batched_nms
 from ._layers import LoadMixin, PriorBox, SSH, FPN, Head
 
 
@@ -45,6 +46,8 @@ class RetinaFace(nn.Module, LoadMixin):
         variance (list[int]): The variance of the bounding boxes 
             used to undo the encoding of coordinates of raw  bounding 
             box and landmark predictions.
+        priors (dict): The cache of prior boxes (anchors), one per 
+            input size and device, see :meth:`get_priors`.
     """
     #: WEIGHTS_FILENAME (str): The constant specifying the name of 
     #: ``.pth`` file from which the weights for this model should be 
@@ -88,6 +91,7 @@ class RetinaFace(nn.Module, LoadMixin):
         self.vis_threshold = vis
         self.nms_threshold = 0.4
         self.variance = [0.1, 0.2]
+        self.priors = {}
 
         # Set up backbone and config
         backbone = models.resnet50()
@@ -143,6 +147,29 @@ class RetinaFace(nn.Module, LoadMixin):
         
         return F.softmax(pred[0], dim=-1), pred[1], pred[2]
     
+    def get_priors(
+        self,
+        size: tuple[int, int],
+        device: torch.device,
+    ) -> torch.Tensor:
+        """Gets the prior boxes (anchors) for the given input size.
+
+        The anchors only depend on the input size, so they are built 
+        once per input size and device and cached in ``self.priors``.
+
+        Args:
+            size: The input size (H, W).
+            device: The device to put the anchors on.
+
+        Returns:
+            Prior boxes in center-offset form of shape (out_dim, 4).
+        """
+        if (key := (size, str(device))) not in self.priors:
+            # Build the anchors for a new input size
+            self.priors[key] = PriorBox(size).forward().to(device)
+
+        return self.priors[key]
+
     def decode_bboxes(
         self,
         loc: torch.Tensor,
@@ -216,7 +243,7 @@ class RetinaFace(nn.Module, LoadMixin):
         scores: torch.Tensor,
         bboxes: torch.Tensor,
         landms: torch.Tensor,
-    ) -> tuple[torch.Tensor, torch.Tensor, list[int]]:
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """Filters predictions for identified faces for each sample.
         
         This method works as follows:
@@ -227,15 +254,15 @@ class RetinaFace(nn.Module, LoadMixin):
                batch dimension, i.e., the batch dimension becomes not
                the number of samples but the number of filtered out
                predictions.
-            3. It loops for each set of filtered predictions per sample
-               sorting each set of confidence scores from best to worst.
-            4. For each set of confidence scores, it identifies distinct 
-               faces and keeps the record of which indices to keep. At 
-               this stage it uses ``self.nms_threshold`` to remove the 
-               duplicate face predictions.
-            5. Finally, it applies the kept indices for each person
-               (each face) to select corresponding bounding boxes and
-               landmarks.
+            3. It applies non-maximum suppression to the predictions of 
+               every sample at once (batched by sample index, see 
+               :func:`torchvision.ops.batched_nms`) and identifies 
+               distinct faces. At this stage it uses 
+               ``self.nms_threshold`` to remove the duplicate face 
+               predictions.
+            4. Finally, it sorts the kept faces by sample and, within a 
+               sample, from the best to the worst confidence score and 
+               selects corresponding bounding boxes and landmarks.
 
         Args:
             scores: The confidence score predictions of shape
@@ -250,64 +277,38 @@ class RetinaFace(nn.Module, LoadMixin):
 
         Returns:
             A tuple where the first element is a torch tensor of shape
-            (``num_faces``, 4), the second element is a torch tensor of
-            shape (``num_faces``, ``num_landmarks`` * 2) and the third 
-            element is a list of length ``num_faces``. First and second 
-            elements correspond to bounding boxes and landmarks for each 
-            face across all samples and the third element provides an 
-            index for each bounding box/set of landmarks that identifies
-            which sample that box/set (or that face) is extracted from
-            (because each sample can have multiple faces).
+            (``num_faces``, ``num_landmarks`` * 2), the second element 
+            is a torch tensor of shape (``num_faces``, 4) and the third 
+            element is a torch tensor of shape (``num_faces``,). First 
+            and second elements correspond to landmarks and bounding 
+            boxes for each face across all samples and the third element 
+            provides an index for each set of landmarks/bounding box 
+            that identifies which sample that set/box (or that face) is 
+            extracted from (because each sample can have multiple 
+            faces). All of them are on the device of the inputs.
         """
-        # Init variables, identify masks to filter best faces
-        cumsum, people_indices, sample_indices = 0, [], []
+        # Identify masks to filter best faces, sample of every face
         masks = scores > self.vis_threshold
+        sample_indices = masks.nonzero()[:, 0]
 
-        # Flatten across batch filtered predictions, compute face areas
+        # Flatten across batch filtered predictions
         scores, bboxes, landms = scores[masks], bboxes[masks], landms[masks]
-        areas = (bboxes[:, 2]-bboxes[:, 0]+1) * (bboxes[:, 3]-bboxes[:, 1]+1)
-
-        for i, num_valid in enumerate(masks.sum(dim=1)):
-            # Extract all face preds for a single sample
-            start, end, keep = cumsum, cumsum+num_valid, []
-            bbox, area = bboxes[start:end], areas[start:end]
-            scores_sorted = scores[start:end].argsort(descending=True)
-
-            while scores_sorted.numel() > 0:
-                # Append best face's index to keep
-                keep.append(j := scores_sorted[0])
-                
-                # Find coordinates that at least bound the current face
-                xy1 = torch.maximum(bbox[j, :2], bbox[scores_sorted[1:], :2])
-                xy2 = torch.minimum(bbox[j, 2:], bbox[scores_sorted[1:], 2:])
-
-                # Compute width and height for the current minimal face
-                w = torch.maximum(torch.tensor(0.0), xy2[:, 0] - xy1[:, 0] + 1)
-                h = torch.maximum(torch.tensor(0.0), xy2[:, 1] - xy1[:, 1] + 1)
-
-                # Compute nms for identifying areas for the current face
-                ovr = (a := w * h) / (area[j] + area[scores_sorted[1:]] - a)
-                
-                # Filter out current face, keep next best scores
-                inds = torch.where(ovr <= self.nms_threshold)[0]
-                scores_sorted = scores_sorted[inds + 1]
-            
-            # Update people and sample indices, increment cumsum
-            people_indices.extend([cumsum + k for k in keep])
-            sample_indices.extend([i] * len(keep))
-            cumsum += num_valid
-        
-        # Select the final landms and bboxes
-        bboxes = bboxes[people_indices, :]
-        landms = landms[people_indices, :]
+
+        # Remove duplicate faces of each sample (+1 on the end corners
+        # for the inclusive pixel areas the thresholds were tuned with)
+        boxes = torch.cat((bboxes[:, :2], bboxes[:, 2:] + 1), dim=1)
+        keep = batched_nms(boxes, scores, sample_indices, self.nms_threshold)
+
+        # Kept faces are sorted by score, group them by sample (stable)
+        keep = keep[sample_indices[keep].sort(stable=True).indices]
         
-        return landms, bboxes, sample_indices
+        return landms[keep], bboxes[keep], sample_indices[keep]
     
     def take_by_strategy(
         self,
         landms: torch.Tensor,
         bboxes: torch.Tensor,
-        idx: list[int],
+        idx: torch.Tensor,
     ) -> tuple[torch.Tensor, list[int]]:
         """Filters landmarks according to strategy.
 
@@ -333,15 +334,15 @@ class RetinaFace(nn.Module, LoadMixin):
               landmarks) for each image but selected faces are returned.
 
         Note:
-            Strategy "best" is most memory efficient, strategy "largest" 
-            is least time efficient. Strategy "all" is as fast as "best" 
-            but takes up more space.
+            All the strategies are computed on the device of the inputs, 
+            without looping over the faces: "largest" is a segment-wise 
+            argmax of the bounding box areas (the first face wins ties).
 
         Args:
             landms: Landmarks batch of shape 
                 (``num_faces``, ``num_landm`` * 2).
             bboxes: Bounding boxes batch of shape (``num_faces``, 4).
-            idx: Indices where each index maps to an image from
+            idx: Indices tensor where each index maps to an image from
                 which some face prediction (landmarks and bounding box) 
                 was retrieved. For instance if the 2nd element of idx is 
                 1, that means that the 2nd element of ``landms`` and the
@@ -363,49 +364,36 @@ class RetinaFace(nn.Module, LoadMixin):
         if len(idx) == 0:
             # If no predicted landmarks, return empty lists
             return torch.tensor([], device=landms.device), []
-        
-        # Init helper variables
-        landmarks, indices = [], []
-        cache = {"idx": [], "bboxes": [], "landms": []}
-
-        for i in range(len(idx)):
-            # Apend everything to cache
-            cache["idx"].append(idx[i])
-            cache["bboxes"].append(bboxes[i])
-            cache["landms"].append(landms[i])
-
-            if i != len(idx) - 1 and cache["idx"][-1] == idx[i + 1]:
-                # No operations until cache for current idx is full
-                continue
-
-            match self.strategy:
-                case "all":
-                    # Append all landmarks and indices
-                    landmarks.extend(cache["landms"])
-                    indices.extend(cache["idx"])
-                case "best":
-                    # Append the first set of landmarks
-                    landmarks.append(cache["landms"][0])
-                    indices.append(cache["idx"][0])
-                case "largest":
-                    # Compute bounding box areas
-                    bbs = torch.stack(cache["bboxes"])
-                    areas = (bbs[:, 2] - bbs[:, 0] + 1) *\
-                            (bbs[:, 3] - bbs[:, 1] + 1)
-
-                    # Append only the largest face landmarks and its idx
-                    landmarks.append(cache["landms"][areas.argmax()])
-                    indices.append(cache["idx"][0])
-                case _:
-                    raise ValueError(f"Unsupported startegy: {self.strategy}")
-            
-            # Clear cache (reinitialize empty lists)
-            cache = {k: [] for k in cache.keys()}
-
-        # Stack landmarks across batch dim
-        landmarks = torch.stack(landmarks)
-    
-        return landmarks, indices
+
+        match self.strategy:
+            case "all":
+                # Keep all landmarks and indices
+                keep = torch.arange(len(idx), device=idx.device)
+            case "best":
+                # Keep the first set of landmarks of every image
+                keep = torch.ones_like(idx, dtype=torch.bool)
+                keep[1:] = idx[1:] != idx[:-1]
+                keep = keep.nonzero()[:, 0]
+            case "largest":
+                # Compute bounding box areas, the largest one per image
+                areas = (bboxes[:, 2] - bboxes[:, 0] + 1) *\
+                        (bboxes[:, 3] - bboxes[:, 1] + 1)
+                size = int(idx[-1]) + 1
+                largest = areas.new_zeros(size).scatter_reduce(
+                    0, idx, areas, "amax", include_self=False
+                )
+
+                # Keep the first face with the largest area per image
+                position = torch.arange(len(idx), device=idx.device)
+                position[areas != largest[idx]] = len(idx)
+                keep = position.new_full((size,), len(idx)).scatter_reduce(
+                    0, idx, position, "amin", include_self=True
+                )
+                keep = keep[keep < len(idx)]
+            case _:
+                raise ValueError(f"Unsupported startegy: {self.strategy}")
+
+        return landms[keep], idx[keep].tolist()
     
     @torch.no_grad()
     def predict(self, images: torch.Tensor) -> tuple[np.ndarray, list[int]]:
@@ -446,12 +434,40 @@ class RetinaFace(nn.Module, LoadMixin):
             corresponding indices mapping each face to an image it comes
             from.
         """
+        # Perform inference, decode the predictions
+        scores, bboxes, landms = self.detect(images)
+
+        # Filter out bad predictions, then filter by strategy
+        filtered = self.filter_preds(scores, bboxes, landms)
+        landmarks, indices = self.take_by_strategy(*filtered)
+
+        # Stack landmarks across batch dim and reshape as coords
+        landmarks = landmarks.view(-1, 5, 2).cpu().numpy()
+
+        return landmarks, indices
+
+    def detect(
+        self,
+        images: torch.Tensor,
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Performs inference and decodes all the predictions.
+
+        Args:
+            images: Image batch of shape (N, 3, H, W) in RGB form with 
+                float values from 0.0 to 255.0.
+
+        Returns:
+            A tuple of unfiltered confidence scores of shape 
+            (N, out_dim), bounding boxes of shape (N, out_dim, 4) and 
+            landmarks of shape (N, out_dim, 10), in the pixel 
+            coordinates of the images.
+        """
         # Convert images to appropriate input and perform inference
         x, offset = images[:, [2, 1, 0]], torch.tensor([104, 117, 123])
         scores, bboxes, landms = self(x - offset.view(3, 1, 1).to(x.device))
 
-        # Create prior boxes and scale factors to decode bboxes & landms
-        priors = PriorBox((x.size(2), x.size(3))).forward().to(x.device)
+        # Get prior boxes and scale factors to decode bboxes & landms
+        priors = self.get_priors((x.size(2), x.size(3)), x.device)
         scale_b = torch.tensor([x.size(3), x.size(2)] * 2, device=x.device)
         scale_l = torch.tensor([x.size(3), x.size(2)] * 5, device=x.device)
 
@@ -460,11 +476,173 @@ class RetinaFace(nn.Module, LoadMixin):
         bboxes = self.decode_bboxes(bboxes, priors) * scale_b
         landms = self.decode_landms(landms, priors) * scale_l
 
-        # Filter out bad predictions, then filter by strategy
-        filtered = self.filter_preds(scores, bboxes, landms)
-        landmarks, indices = self.take_by_strategy(*filtered)
+        return scores, bboxes, landms
 
-        # Stack landmarks across batch dim and reshape as coords
+    def get_tiles(
+        self,
+        size: tuple[int, int],
+        tile_size: int,
+        overlap: int,
+    ) -> list[tuple[int, int, int, int]]:
+        """Splits an image to overlapping tiles.
+
+        Args:
+            size: The (height, width) of the image.
+            tile_size: The width and height of a tile.
+            overlap: The minimum overlap of neighboring tiles.
+
+        Returns:
+            The list of tiles (x0, y0, x1, y1) covering the image. Tiles 
+            are ``tile_size`` square unless the image is smaller.
+        """
+        starts = []
+
+        for length in size:
+            # Tiles along this axis, the last one ends at the border
+            stride = max(tile_size - overlap, 1)
+            axis = list(range(0, max(length - tile_size, 0), stride))
+            starts.append(axis + [max(length - tile_size, 0)])
+
+        return [(x, y, min(x + tile_size, size[1]), min(y + tile_size, size[0]))
+                for y in starts[0] for x in starts[1]]
+
+    @torch.no_grad()
+    def get_tile(
+        self,
+        image: torch.Tensor,
+        box: tuple[int, int, int, int],
+        scale: float,
+        tile_size: int,
+    ) -> torch.Tensor:
+        """Cuts a tile of an image for :meth:`predict_tiled`.
+
+        Args:
+            image: The image of shape (3, H, W) with values from 0 to 
+                255, on any device.
+            box: The (x0, y0, x1, y1) box of the tile in the image.
+            scale: 1 for a native resolution tile, otherwise the factor 
+                by which the box is downscaled to fit the tile size.
+            tile_size: The width and height of a tile.
+
+        Returns:
+            The tile of shape (3, ``tile_size``, ``tile_size``) of type 
+            :attr:`torch.float32`, on the device of this model and 
+            padded with zeros on its right and bottom edges.
+        """
+        device = next(self.parameters()).device
+        x0, y0, x1, y1 = box
+        tile = image[:, y0:y1, x0:x1].to(device).float()
+
+        if scale != 1:
+            # Resized on the device, only one image at a time is there
+            size = (max(round((y1 - y0) / scale), 1), 
+                    max(round((x1 - x0) / scale), 1))
+            tile = F.interpolate(tile[None], size, mode="bilinear", 
+                                 antialias=True, align_corners=False)[0]
+
+        pad = (0, tile_size - tile.size(2), 0, tile_size - tile.size(1))
+        return F.pad(tile, pad)
+
+    def predict_tiled(
+        self,
+        images: list[torch.Tensor],
+        tile_size: int = 1024,
+        overlap: int = 128,
+        batch_size: int = 4,
+    ) -> tuple[np.ndarray, list[int]]:
+        """Predicts the sets of landmarks from native resolution images.
+
+        Small faces in large images are often missed at the resized 
+        resolution of :meth:`predict`. This method runs the detector on 
+        overlapping ``tile_size`` tiles of every image at its native 
+        resolution (and on the whole image resized to ``tile_size``, 
+        the top of a 2-level pyramid, for the faces larger than the 
+        overlap). It works as follows:
+
+            1. The tiles of every image are detected in batches of 
+               ``batch_size``, image by image. A tile is only cut (and 
+               the edge tiles padded) when its batch is detected, so 
+               at most ``batch_size`` tiles are on the device at once.
+            2. The predictions are shifted (and scaled) to the 
+               coordinates of the image. The faces cut by an inner tile 
+               border are dropped, they are whole in a neighboring tile 
+               (if smaller than ``overlap``) or in the top level.
+            3. The predictions of all the tiles of an image are merged 
+               by :meth:`filter_preds` (non-maximum suppression) and 
+               filtered by :meth:`take_by_strategy`.
+
+        The cost grows linearly with the image area.
+
+        Args:
+            images: The list of images of shape (3, H, W) in RGB form 
+                with values from 0 to 255 (of different sizes, of any 
+                dtype). They can stay on the CPU, every tile is moved to 
+                the device of this model.
+            tile_size: The width and height of a tile. It should be a 
+                multiple of 32. Defaults to 1024.
+            overlap: The minimum overlap of neighboring tiles. Defaults 
+                to 128.
+            batch_size: The number of tiles detected at once. Defaults 
+                to 4.
+
+        Returns:
+            A tuple where the first element is a numpy array of shape 
+            (``num_faces``, 5, 2) of the selected sets of landmark 
+            coordinates (in the pixels of the images) and the second 
+            element is the list of indices mapping each face to an 
+            image it comes from.
+        """
+        # The predictions of every image
+        preds = [([], [], []) for _ in images]
+
+        for i, image in enumerate(images):
+            # Every tile of the image as (tile box, scale)
+            (h, w) = image.shape[1:]
+            tiles = [(box, 1) for box in self.get_tiles((h, w), tile_size, overlap)]
+
+            if max(h, w) > tile_size:
+                # Top level: the whole image fitted to the tile size
+                tiles.append(((0, 0, w, h), max(h, w) / tile_size))
+
+            for j in range(0, len(tiles), batch_size):
+                # Only the tiles of this batch are cut and moved to the device
+                batch = tiles[j:j+batch_size]
+                pixels = [self.get_tile(image, *tile, tile_size) for tile in batch]
+                detected = self.detect(torch.stack(pixels))
+
+                for ((x0, y0, x1, y1), scale), *pred in zip(batch, *detected):
+                    # Back to the image coordinates
+                    scores, bboxes, landms = pred
+                    bboxes = bboxes * scale + bboxes.new_tensor([x0, y0] * 2)
+                    landms = landms * scale + landms.new_tensor([x0, y0] * 5)
+
+                    # Drop the faces cut by the inner tile borders
+                    margin = 2 * scale
+                    cut = ((bboxes[:, 0] < x0 + margin) & (x0 > 0)) |\
+                          ((bboxes[:, 1] < y0 + margin) & (y0 > 0)) |\
+                          ((bboxes[:, 2] > x1 - margin) & (x1 < w)) |\
+                          ((bboxes[:, 3] > y1 - margin) & (y1 < h))
+                    keep = (scores > self.vis_threshold) & ~cut
+
+                    for k, x in enumerate([scores, bboxes, landms]):
+                        preds[i][k].append(x[keep])
+
+        # Merge the tiles of every image (one sample) by NMS
+        landms, bboxes, indices = [], [], []
+
+        for i, (scores, bboxes_i, landms_i) in enumerate(preds):
+            merged = self.filter_preds(
+                torch.cat(scores)[None], 
+                torch.cat(bboxes_i)[None], 
+                torch.cat(landms_i)[None],
+            )
+            landms.append(merged[0])
+            bboxes.append(merged[1])
+            indices.append(torch.full_like(merged[2], i))
+
+        # Filter by strategy, reshape as coords
+        filtered = [torch.cat(x) for x in [landms, bboxes, indices]]
+        landmarks, indices = self.take_by_strategy(*filtered)
         landmarks = landmarks.view(-1, 5, 2).cpu().numpy()
 
         return landmarks, indices
@@ -12,7 +12,8 @@ class RRDBNet(nn.Module, LoadMixin):
     faces, i.e., which images have small face areas compared to the 
     dimensions of the image and is able to enhance the quality of those 
     images. The images are up-scaled 4 times and then resized to their 
-    original size - this results in less blurry faces.
+    original size - this results in less blurry faces. Only the regions 
+    around the faces are enhanced, tile by tile (see :meth:`predict`).
 
     This class also inherits ``load`` method from ``LoadMixin`` class. 
     The method takes a device on which to load the model and loads the 
@@ -34,20 +35,44 @@ class RRDBNet(nn.Module, LoadMixin):
     #: loaded. Defaults to "bsrgan_x4_enhancer.pth".
     WEIGHTS_FILENAME = "bsrgan_x4_enhancer.pth"
 
-    def __init__(self, min_face_factor: float = 0.001):
+    def __init__(
+        self,
+        min_face_factor: float = 0.001,
+        tile_size: int = 128,
+        tile_overlap: int = 16,
+        tile_batch: int = 4,
+        roi_scale: float = 4.0,
+    ):
         """Initializes RRDB (BSRGAN) model.
 
-        Just assigns the minimum face threshold attribute and constructs 
-        module layers for quality inference.
+        Assigns the minimum face threshold and tiling attributes and 
+        constructs module layers for quality inference.
 
         Args:
             min_face_factor: The minimum average face factor, i.e., face 
-                area relative to the image, below which the whole image 
-                is enhanced. Defaults to 0.001.
+                area relative to the image, below which the image is 
+                enhanced. Defaults to 0.001.
+            tile_size: The maximum width and height of an enhanced tile 
+                (before up-scaling). It bounds the memory of inference: 
+                every tile is up-scaled to ``4 * tile_size``. Defaults 
+                to 128.
+            tile_overlap: The overlap of neighboring tiles, over which 
+                they are blended linearly (also the width of the blend 
+                with the original image at the region borders). Defaults 
+                to 16.
+            tile_batch: The number of tiles (of the same shape) enhanced 
+                at once. Defaults to 4.
+            roi_scale: The size of the enhanced region around a face 
+                relative to the size of its landmarks. It should cover 
+                the area that is later cropped. Defaults to 4.0.
         """
         super().__init__()
-        # Init minimum face factor attribute
+        # Init minimum face factor and tiling attributes
         self.min_face_factor = min_face_factor
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_batch = tile_batch
+        self.roi_scale = roi_scale
 
         # Initialize first layers that produce features
         self.conv_first = nn.Conv2d(3, 64, 3, 1, 1)
@@ -80,6 +105,135 @@ class RRDBNet(nn.Module, LoadMixin):
 
         return self.conv_last(self.lrelu(self.HRconv(fea)))
 
+    def get_rois(
+        self,
+        size: tuple[int, int],
+        landmarks: np.ndarray | None,
+    ) -> list[tuple[int, int, int, int]]:
+        """Gets the regions of an image to enhance.
+
+        Args:
+            size: The (height, width) of the image.
+            landmarks: The landmarks of the faces in the image of shape 
+                (``num_faces``, 5, 2). If None, the whole image is the 
+                region.
+
+        Returns:
+            The list of regions (y0, y1, x0, x1), one per face, clipped 
+            to the image.
+        """
+        if landmarks is None:
+            # The whole image
+            return [(0, size[0], 0, size[1])]
+
+        rois = []
+
+        for landmarks_i in landmarks:
+            # Square around the center of the landmarks
+            (x0, y0), (x1, y1) = landmarks_i.min(0), landmarks_i.max(0)
+            half = max(x1 - x0, y1 - y0, 1) * self.roi_scale / 2
+            cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+
+            y0, y1 = max(int(cy - half), 0), min(int(cy + half) + 1, size[0])
+            x0, x1 = max(int(cx - half), 0), min(int(cx + half) + 1, size[1])
+
+            if y0 < y1 and x0 < x1:
+                # Inside the image
+                rois.append((y0, y1, x0, x1))
+
+        return rois
+
+    def get_tiles(
+        self,
+        roi: tuple[int, int, int, int],
+    ) -> list[tuple[int, int, int, int]]:
+        """Splits a region to overlapping tiles of at most ``tile_size``.
+
+        Args:
+            roi: The region (y0, y1, x0, x1).
+
+        Returns:
+            The list of tiles (y0, y1, x0, x1) covering the region.
+        """
+        starts = []
+
+        for start, end in [roi[:2], roi[2:]]:
+            # Tile size and stride along this axis, last tile at the end
+            size = min(self.tile_size, end - start)
+            stride = max(size - self.tile_overlap, 1)
+            axis = list(range(start, end - size, stride)) + [end - size]
+            starts.append([(s, s + size) for s in axis])
+
+        return [(*ys, *xs) for ys in starts[0] for xs in starts[1]]
+
+    def get_weight(
+        self,
+        tile: tuple[int, int, int, int],
+        size: tuple[int, int],
+        device: torch.device,
+    ) -> torch.Tensor:
+        """Gets the blending weight of a tile.
+
+        The weight ramps linearly from 0 to 1 over ``tile_overlap`` 
+        pixels from every tile border, except at the image borders. The 
+        ramps of 2 tiles overlapping by ``tile_overlap`` sum to 1.
+
+        Args:
+            tile: The tile (y0, y1, x0, x1).
+            size: The (height, width) of the image.
+            device: The device to create the weight on.
+
+        Returns:
+            The weight of shape (tile height, tile width).
+        """
+        ramps = []
+
+        for start, end, limit in [(*tile[:2], size[0]), (*tile[2:], size[1])]:
+            # Distance (in pixels) to the tile borders inside the image
+            x = torch.arange(end - start, device=device) + 0.5
+            ramp = torch.ones_like(x)
+
+            if start > 0:
+                ramp = ramp.minimum(x / self.tile_overlap)
+            
+            if end < limit:
+                ramp = ramp.minimum(x.flip(0) / self.tile_overlap)
+
+            ramps.append(ramp.clamp(max=1))
+
+        return ramps[0][:, None] * ramps[1][None, :]
+
+    def enhance(self, tiles: list[torch.Tensor]) -> list[torch.Tensor]:
+        """Enhances tiles, ``tile_batch`` tiles of the same shape at once.
+
+        Args:
+            tiles: The list of tiles of shape (3, h, w) with float values 
+                from 0.0 to 255.0.
+
+        Returns:
+            The list of enhanced tiles (up-scaled 4 times, then resized 
+            back) of the same shapes and values range.
+        """
+        enhanced = [None] * len(tiles)
+        shapes = {}
+
+        for i, tile in enumerate(tiles):
+            # Group the tiles by shape to batch them
+            shapes.setdefault(tuple(tile.shape), []).append(i)
+
+        for group in shapes.values():
+            for j in range(0, len(group), self.tile_batch):
+                # Enhance a batch of tiles
+                idx = group[j:j+self.tile_batch]
+                x4 = self(torch.stack([tiles[k] for k in idx]).div(255))
+                x1 = F.interpolate(x4, None, 0.25, "bicubic")
+                x1 = x1.clamp(0, 1).mul(255)
+
+                for k, tile in zip(idx, x1):
+                    enhanced[k] = tile
+
+        return enhanced
+
     @torch.no_grad()
     def predict(
         self,
@@ -97,10 +251,18 @@ class RRDBNet(nn.Module, LoadMixin):
         left-eye, right-eye, left-mouth, right-mouth landmark 
         coordinates) by the image area.
 
+        Only the regions around the faces are enhanced (see 
+        :meth:`get_rois`), not the whole images. Every region is split 
+        to overlapping tiles of at most ``self.tile_size`` (see 
+        :meth:`get_tiles`), the tiles of all the images are enhanced in 
+        batches of ``self.tile_batch`` (see :meth:`enhance`) and blended 
+        back linearly over their overlaps and at the region borders 
+        (see :meth:`get_weight`).
+
         Note:
-            The images are enhanced one by one instead of as a batch 
-            because the inference is very memory consuming and can 
-            result in memory errors.
+            The tile size bounds the memory of the inference, which is 
+            very memory consuming and can otherwise result in memory 
+            errors.
 
         Args:
             images: Image batch of shape (N, 3, H, W) in RGB form with 
@@ -109,22 +271,26 @@ class RRDBNet(nn.Module, LoadMixin):
                 of different shapes.
             landmarks: Landmarks batch of shape (``num_faces``, 5, 2) 
                 used to compute average face area for each image. If 
-                None, then every image will be enhanced.
+                None, then every image will be enhanced (as a whole).
             indices: Indices list mapping each set of landmarks to a 
                 specific image in ``images`` batch (multiple sets of 
                 landmarks can come from the same image). If None, then 
-                every image will be enhanced.
+                every image will be enhanced (as a whole).
 
         Returns:
             The same image batch as ``images`` - the shape is 
             (N, 3, H, W) channels are in RGB and values range from 
             0.0 to 255.0. The only difference is that some of the images 
-            are of much higher quality, i.e., less blurry.
+            are of much higher quality, i.e., less blurry, around faces.
         """
+        # The tiles of all the images: image index, box, pixels
+        tiles = []
+
         for i in range(len(images)):
             if landmarks is None or indices is None:
                 # Create a dummy face factor to ensure enhance
                 face_factor = np.array([self.min_face_factor])
+                landmarks_i = None
             else:
                 # Select all face landmarks in the current i'th image
                 landmarks_i = landmarks[[idx == i for idx in indices]]
@@ -138,9 +304,35 @@ class RRDBNet(nn.Module, LoadMixin):
                 face_factor = w * h / (images[0].shape[1] * images[0].shape[2])
 
             if face_factor.mean() <= self.min_face_factor:
-                # Enhance ith img if factor below threshold
-                image_x4 = self(images[i].unsqueeze(0).div(255))
-                image_x1 = F.interpolate(image_x4, None, 0.25, "bicubic")
-                images[i] = image_x1.clamp(0, 1).mul(255).round()[0]
+                # Enhance the regions of the ith img if factor below threshold
+                for roi in self.get_rois(images[i].shape[1:], landmarks_i):
+                    for (y0, y1, x0, x1) in self.get_tiles(roi):
+                        tile = images[i][:, y0:y1, x0:x1]
+                        tiles.append((i, (y0, y1, x0, x1), tile))
+
+        if len(tiles) == 0:
+            # Nothing to enhance
+            return images
+
+        # Enhance all the tiles, accumulate weighted per image
+        enhanced = self.enhance([tile for _, _, tile in tiles])
+        sums = {}
+
+        for (i, (y0, y1, x0, x1), _), tile in zip(tiles, enhanced):
+            size = images[i].shape[1:]
+
+            if i not in sums:
+                # Weighted sum of the enhanced tiles and sum of weights
+                sums[i] = (torch.zeros_like(images[i]), 
+                           images[i].new_zeros(size))
+
+            weight = self.get_weight((y0, y1, x0, x1), size, tile.device)
+            sums[i][0][:, y0:y1, x0:x1] += tile * weight
+            sums[i][1][y0:y1, x0:x1] += weight
+
+        for i, (total, weight) in sums.items():
+            # Blend with the original where the weights are below 1
+            original = images[i] * (1 - weight).clamp(min=0)
+            images[i] = (total + original).div(weight.clamp(min=1)).round()
 
         return images
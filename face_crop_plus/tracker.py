@@ -0,0 +1,234 @@
+import cv2
+import numpy as np
+
+
+class LandmarkTracker():
+    """Propagates 5-point face landmarks between consecutive frames.
+
+    This class keeps the landmarks of the previous video frame and
+    moves them to the next frame with sparse optical flow, so that the
+    face detector only has to run on keyframes. A frame is a keyframe
+    (i.e., it needs detection) if it is the first frame, if it comes
+    after a scene cut, if ``interval`` frames were tracked since the
+    last keyframe or if the previous frame had no faces. Tracking
+    itself can fail (low confidence), in which case the frame should
+    be detected as well.
+
+    Tracking works as follows for every face:
+
+        1. Corner features are found in a padded box around the
+           previous landmarks (the landmarks themselves are tracked as
+           well).
+        2. The features are tracked to the next frame with pyramidal
+           Lucas-Kanade optical flow and back again. Features that do
+           not come back to where they started (forward-backward error
+           above ``max_error`` pixels) are rejected.
+        3. The confidence is the fraction of the features that were
+           kept. If it is below ``min_confidence``, tracking fails.
+        4. A similarity transformation is estimated from the kept
+           features (with RANSAC) and applied to the landmarks.
+    """
+    def __init__(
+        self,
+        interval: int = 10,
+        min_confidence: float = 0.6,
+        scene_threshold: float = 0.6,
+        max_error: float = 1.0,
+    ):
+        """Initializes the tracker.
+
+        Args:
+            interval: The maximum number of frames tracked between two
+                keyframes. Defaults to 10.
+            min_confidence: The minimum fraction of features that must
+                be tracked reliably for the tracked landmarks to be
+                used. Below it, the frame is detected. Defaults to 0.6.
+            scene_threshold: The minimum correlation between the gray
+                histograms of two consecutive frames. Below it, the
+                frames are considered to be from different scenes and
+                the second one is a keyframe. Defaults to 0.6.
+            max_error: The maximum forward-backward optical flow error
+                (in pixels) of a reliably tracked feature. Defaults to
+                1.0.
+        """
+        self.interval = interval
+        self.min_confidence = min_confidence
+        self.scene_threshold = scene_threshold
+        self.max_error = max_error
+        self.reset()
+
+    def reset(self):
+        """Forgets the previous frame, e.g., before a new video."""
+        self.prev_gray = None
+        self.prev_hist = None
+        self.prev_landmarks = []
+        self.num_tracked = 0
+
+    def histogram(self, gray: np.ndarray) -> np.ndarray:
+        """Normalized 32-bin histogram of a gray frame."""
+        hist = cv2.calcHist([gray], [0], None, [32], [0, 256])
+        return cv2.normalize(hist, hist)
+
+    def is_scene_cut(self, prev_hist: np.ndarray | None, hist: np.ndarray) -> bool:
+        """Checks whether two frames (given by their histograms) are from
+        different scenes."""
+        if prev_hist is None:
+            return True
+
+        correlation = cv2.compareHist(prev_hist, hist, cv2.HISTCMP_CORREL)
+
+        return correlation < self.scene_threshold
+
+    def plan(self, grays: list[np.ndarray]) -> tuple[list[bool], list[np.ndarray]]:
+        """Finds the keyframes of the next frames.
+
+        The keyframes are predicted assuming that tracking succeeds on
+        all the other frames, so that they can all be detected as one
+        batch. Frames where tracking fails are detected on the fly (see
+        :meth:`track`).
+
+        Args:
+            grays: The next gray frames, in order.
+
+        Returns:
+            A tuple where the first element is a list of flags telling
+            which frames are keyframes and the second element is the
+            list of the histograms of the frames (for :meth:`track`).
+        """
+        keyframes, hists = [], [self.histogram(gray) for gray in grays]
+        prev_hist, num_tracked = self.prev_hist, self.num_tracked
+        has_faces = len(self.prev_landmarks) > 0
+
+        for i, hist in enumerate(hists):
+            # Detection is needed after a cut, or if it is time to
+            is_keyframe = not has_faces or num_tracked >= self.interval or\
+                          self.is_scene_cut(prev_hist, hist)
+
+            # Faces are assumed after a keyframe (checked when tracking)
+            keyframes.append(is_keyframe)
+            num_tracked = 0 if is_keyframe else num_tracked + 1
+            prev_hist, has_faces = hist, True
+
+        return keyframes, hists
+
+    def propagate(
+        self,
+        prev_gray: np.ndarray,
+        gray: np.ndarray,
+        landmarks: np.ndarray,
+    ) -> np.ndarray | None:
+        """Moves the landmarks of a face from a frame to the next one.
+
+        Args:
+            prev_gray: The previous gray frame.
+            gray: The next gray frame (of the same size).
+            landmarks: The landmarks of the face in the previous frame
+                of shape (5, 2).
+
+        Returns:
+            The landmarks of the face in the next frame of shape (5, 2)
+            or None if the face could not be tracked confidently.
+        """
+        # A padded box around the landmarks (the face)
+        (x1, y1), (x2, y2) = landmarks.min(0), landmarks.max(0)
+        pad_x, pad_y = (x2 - x1) * 0.5, (y2 - y1) * 0.5
+        x1, y1 = int(max(x1 - pad_x, 0)), int(max(y1 - pad_y, 0))
+        x2 = int(min(x2 + pad_x, gray.shape[1]))
+        y2 = int(min(y2 + pad_y, gray.shape[0]))
+
+        if x2 - x1 < 8 or y2 - y1 < 8:
+            # The face left the frame
+            return None
+
+        # Corner features of the face and the landmarks themselves
+        roi = prev_gray[y1:y2, x1:x2]
+        corners = cv2.goodFeaturesToTrack(roi, 64, 0.01, 3)
+        points = landmarks.reshape(-1, 1, 2).astype(np.float32)
+
+        if corners is not None:
+            corners = corners + np.float32([x1, y1])
+            points = np.concatenate((points, corners))
+
+        # Track forward, then backward to check the features
+        kwargs = {"winSize": (21, 21), "maxLevel": 3}
+        nexts, st1, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points, None, **kwargs)
+        backs, st2, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, nexts, None, **kwargs)
+
+        # Keep the features that came back to where they started
+        error = np.linalg.norm(points - backs, axis=2)[:, 0]
+        good = (st1[:, 0] == 1) & (st2[:, 0] == 1) & (error < self.max_error)
+
+        if good.mean() < self.min_confidence or good.sum() < 3:
+            # Not confident enough
+            return None
+
+        # Similarity transformation of the face between the frames
+        matrix = cv2.estimateAffinePartial2D(
+            points[good], nexts[good], method=cv2.RANSAC,
+            ransacReprojThreshold=2 * self.max_error,
+        )[0]
+
+        if matrix is None:
+            # Could not estimate
+            return None
+
+        return cv2.transform(landmarks.reshape(-1, 1, 2), matrix).reshape(-1, 2)
+
+    def track(
+        self,
+        grays: list[np.ndarray],
+        hists: list[np.ndarray],
+        keyframes: list[bool],
+        detected: dict[int, np.ndarray],
+        detect: callable,
+    ) -> tuple[np.ndarray, list[int]]:
+        """Gets the landmarks of the next frames.
+
+        Keyframes take the detected landmarks, the other frames the
+        landmarks tracked from the previous frame. If tracking fails,
+        the frame is detected with ``detect``.
+
+        Args:
+            grays: The next gray frames, in order.
+            hists: Their histograms (see :meth:`plan`).
+            keyframes: The keyframe flags (see :meth:`plan`).
+            detected: The detected landmarks of every keyframe, an
+                array of shape (num_faces, 5, 2) per frame index.
+            detect: The function detecting the landmarks of a single
+                frame (given by its index), returns an array of shape
+                (num_faces, 5, 2).
+
+        Returns:
+            A tuple where the first element is the landmarks of all the
+            faces of shape (``num_faces``, 5, 2) and the second element
+            is the list of the indices of the frames of every face.
+        """
+        landmarks, indices = [], []
+
+        for i, gray in enumerate(grays):
+            if keyframes[i] or len(self.prev_landmarks) == 0:
+                # Keyframe (or no faces to track)
+                current = detected[i] if keyframes[i] else detect(i)
+                self.num_tracked = 0
+            else:
+                # Track every face of the previous frame
+                current = [self.propagate(self.prev_gray, gray, ldm)
+                           for ldm in self.prev_landmarks]
+
+                if any(ldm is None for ldm in current):
+                    # Fall back to detection
+                    current = detect(i)
+                    self.num_tracked = 0
+                else:
+                    self.num_tracked += 1
+
+            # Remember the frame for the next one
+            self.prev_gray, self.prev_hist = gray, hists[i]
+            self.prev_landmarks = list(current)
+
+            landmarks.extend(current)
+            indices.extend([i] * len(current))
+
+        landmarks = np.array(landmarks, dtype=np.float32).reshape(-1, 5, 2)
+
+        return landmarks, indices
@@ -4,12 +4,17 @@ import cv2
 import json
 import tqdm
 import torch
+import time
 import shutil
 import warnings
 import unidecode
 import collections
 import numpy as np
 
+from PIL import Image
+from contextlib import contextmanager
+from multiprocessing.shared_memory import SharedMemory
+
 STANDARD_LANDMARKS_5 = np.float32([
     [0.31556875000000000, 0.4615741071428571],
     [0.68262291666666670, 0.4615741071428571],
@@ -18,6 +23,12 @@ STANDARD_LANDMARKS_5 = np.float32([
     [0.65343645833333330, 0.8246919642857142],
 ])
 
+# The file, in every output directory, with the crop metadata of its faces
+INDEX_FILE = "index.npz"
+
+# The aspect ratios (width / height) of the batch shapes for bucketing
+ASPECT_BUCKETS = [1 / 2, 9 / 16, 3 / 4, 1, 4 / 3, 16 / 9, 2]
+
 def parse_landmarks_file(
     file_path: str,
     **kwargs,
@@ -225,9 +236,172 @@ def as_tensor(
     
     return img
 
+def read_size(path: str) -> tuple[int, int] | None:
+    """Reads the size of an image from its file header.
+
+    The image is not decoded. The size is that of the image as it is
+    read by OpenCV, i.e., swapped if the EXIF orientation rotates the
+    image by 90 degrees.
+
+    Args:
+        path: The path to the image.
+
+    Returns:
+        The (width, height) of the image or None if it is not a
+        readable image.
+    """
+    try:
+        with Image.open(path) as image:
+            (w, h), orientation = image.size, image.getexif().get(274, 1)
+    except OSError:
+        return None
+
+    return (h, w) if orientation in {5, 6, 7, 8} else (w, h)
+
+def get_bucket_size(
+    width: int,
+    height: int,
+    size: tuple[int, int],
+    multiple: int = 32,
+) -> tuple[int, int]:
+    """Gets the batch shape of the aspect ratio bucket of an image.
+
+    The bucket is the one of :data:`ASPECT_BUCKETS` closest to the
+    aspect ratio of the image. Its longer side is the longer side of
+    ``size`` and the other one is rounded up to a multiple of
+    ``multiple`` (the largest stride of the detection model). E.g.,
+    a 1920×1080 image with ``size`` of (1024, 1024) is in the (1024,
+    576) bucket, so it is barely padded when it is batched.
+
+    Args:
+        width: The width of the image.
+        height: The height of the image.
+        size: The (width, height) the images are normally resized +
+            padded to (see :func:`as_batch`).
+        multiple: The number both sides are a multiple of. Defaults to
+            32.
+
+    Returns:
+        The (width, height) of the bucket.
+    """
+    ratio = min(ASPECT_BUCKETS, key=lambda r: abs(np.log(r * height / width)))
+    longest = max(size)
+
+    if ratio >= 1:
+        # Landscape (or square)
+        w, h = longest, longest / ratio
+    else:
+        # Portrait
+        w, h = longest * ratio, longest
+
+    return tuple(int(np.ceil(x / multiple)) * multiple for x in (w, h))
+
+def get_batch_size(
+    images: list[np.ndarray],
+    size: tuple[int, int],
+) -> tuple[int, int]:
+    """Gets the shape of a batch of images with aspect ratio buckets.
+
+    Args:
+        images: The list of images of shape (H, W, 3).
+        size: The (width, height) the images are normally resized +
+            padded to (see :func:`as_batch`).
+
+    Returns:
+        The (width, height) of the aspect ratio bucket of the images
+        (see :func:`get_bucket_size`) if they all are in the same
+        bucket, otherwise ``size``.
+    """
+    buckets = {get_bucket_size(i.shape[1], i.shape[0], size) for i in images}
+
+    return buckets.pop() if len(buckets) == 1 else size
+
+def sort_by_bucket(
+    file_names: list[str],
+    input_dir: str,
+    size: tuple[int, int],
+) -> list[str]:
+    """Sorts image file names by their aspect ratio buckets.
+
+    Images of the same bucket (see :func:`get_bucket_size`) become 
+    adjacent, so that most batches have a single bucket. The order 
+    within a bucket is kept, unreadable images are put last.
+
+    Args:
+        file_names: The list of image file names.
+        input_dir: The input directory with the images.
+        size: The (width, height) the images are normally resized +
+            padded to (see :func:`as_batch`).
+
+    Returns:
+        The sorted list of file names.
+    """
+    def key(file_name):
+        if (image_size := read_size(os.path.join(input_dir, file_name))) is None:
+            return (1, size)
+        
+        return (0, get_bucket_size(*image_size, size))
+
+    return sorted(file_names, key=key)
+
+def reduced_read_flag(path: str, size: int | tuple[int, int]) -> int:
+    """Gets the OpenCV read flag to decode an image for a given size.
+
+    JPEG images can be decoded at 1/2, 1/4 or 1/8 of their resolution
+    directly (the decoder skips the high frequencies), which is much
+    faster than decoding the full image and resizing it afterwards.
+    This picks the largest such reduction for which the decoded image
+    still covers ``size`` (as in :func:`as_batch`), i.e., the image is
+    only ever downscaled after reading. The image size is read from the
+    file header (see :func:`read_size`).
+
+    Args:
+        path: The path to the image.
+        size: The width and the height the image will be resized +
+            padded to.
+
+    Returns:
+        One of ``cv2.IMREAD_REDUCED_COLOR_{2,4,8}`` or
+        ``cv2.IMREAD_COLOR`` if the image cannot be reduced.
+    """
+    size = (size, size) if isinstance(size, int) else size
+
+    if os.path.splitext(path)[1].lower() not in {".jpg", ".jpeg"}:
+        # Other decoders resize after decoding the full image
+        return cv2.IMREAD_COLOR
+
+    if (image_size := read_size(path)) is None:
+        return cv2.IMREAD_COLOR
+
+    w, h = image_size
+
+    # The scale as_batch resizes with (for either shape of the batch)
+    scale = max(min(size[0] / w, size[1] / h), min(size[0] / h, size[1] / w))
+
+    for factor in [8, 4, 2]:
+        if factor * scale <= 1:
+            return getattr(cv2, f"IMREAD_REDUCED_COLOR_{factor}")
+
+    return cv2.IMREAD_COLOR
+
+def read_source(source: np.ndarray | str) -> np.ndarray:
+    """Reads a full resolution RGB image, unless it is already read.
+
+    Args:
+        source: The path to the image or the image itself.
+
+    Returns:
+        The RGB image of type :attr:`numpy.uint8` of shape (H, W, 3).
+    """
+    if isinstance(source, np.ndarray):
+        return source
+
+    return cv2.cvtColor(cv2.imread(source), cv2.COLOR_BGR2RGB)
+
 def read_images(
     file_names: list[str],
     input_dir: str,
+    size: int | tuple[int, int] | None = None,
 ) -> tuple[list[np.ndarray], np.ndarray]:
     """Reads images from the specified paths.
 
@@ -238,6 +412,10 @@ def read_images(
     Args:
         file_names: The list of image file names.
         input_dir (str): The input directory with the images.
+        size: The size the images will be resized + padded to (see
+            :func:`as_batch`). If specified, large JPEG images are
+            decoded at a reduced resolution that still covers it (see
+            :func:`reduced_read_flag`). Defaults to None.
 
     Returns:
         A tuple where the first element is a list of length N (number of 
@@ -256,10 +434,15 @@ def read_images(
     for i, file_name in enumerate(file_names):
         # Generate full path to the input image
         path = os.path.join(input_dir, file_name)
+        flag = cv2.IMREAD_COLOR
+
+        if size is not None:
+            # Decode large images at a lower resolution
+            flag = reduced_read_flag(path, size)
 
         try:
             # Read the image from the given path, convert to RGB form
-            image = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+            image = cv2.cvtColor(cv2.imread(path, flag), cv2.COLOR_BGR2RGB)
         except cv2.error as e:
             warnings.warn(f"Could not read the image {path}")
             continue
@@ -451,3 +634,158 @@ def clean_names(
             src = os.path.join(input_dir, filename)
             tgt = os.path.join(input_dir, name + ext)
             os.rename(src, tgt)
+
+def save_index(output_dir: str, records: list[dict]):
+    """Saves the crop metadata of the faces of a directory.
+
+    The metadata of all the faces extracted to ``output_dir`` is stored 
+    column-wise in a single file, ``output_dir/index.npz`` (see 
+    :data:`INDEX_FILE`), so that it can be loaded with a single read.
+
+    Args:
+        output_dir: The directory the faces were saved to.
+        records: The list of the metadata of every face. Each record is 
+            a dictionary with the face file name (relative to 
+            ``output_dir``) as ``"name"``, the name of the image it was 
+            extracted from as ``"source"``, the ``"frame"`` index of 
+            that image (in the sorted input directory), the ``"bbox"`` 
+            (x, y, width, height) of the crop in the source image, the 
+            ``"parent"`` size (width, height) of the source image, the 
+            2x3 ``"inverse"`` affine transformation from the face to 
+            the source image and the 5 aligned ``"landmarks"`` (relative 
+            to the face size).
+    """
+    # Sort by name so that faces and rows are in the same order
+    records = sorted(records, key=lambda record: record["name"])
+    np.savez(
+        os.path.join(output_dir, INDEX_FILE),
+        names=np.array([r["name"] for r in records], dtype=str),
+        sources=np.array([r["source"] for r in records], dtype=str),
+        frames=np.array([r["frame"] for r in records], dtype=np.int64),
+        bbox=np.array([r["bbox"] for r in records], dtype=np.float32).reshape(-1, 4),
+        parent=np.array([r["parent"] for r in records], dtype=np.int64).reshape(-1, 2),
+        inverse=np.array([r["inverse"] for r in records], dtype=np.float64).reshape(-1, 2, 3),
+        landmarks=np.array([r["landmarks"] for r in records], dtype=np.float32).reshape(-1, 5, 2),
+    )
+
+def load_index(input_dir: str) -> dict[str, dict]:
+    """Loads the crop metadata of the faces of a directory.
+
+    Args:
+        input_dir: The directory the faces were saved to (see 
+            :func:`save_index`).
+
+    Returns:
+        A dictionary mapping every face file name to its record (see 
+        :func:`save_index`). It is empty if the directory has no index.
+    """
+    path = os.path.join(input_dir, INDEX_FILE)
+
+    if not os.path.isfile(path):
+        # No faces were saved with metadata
+        return {}
+
+    with np.load(path) as index:
+        columns = {key: index[key] for key in index.files}
+
+    return {
+        str(name): {
+            "name": str(name),
+            "source": str(columns["sources"][i]),
+            "frame": int(columns["frames"][i]),
+            "bbox": columns["bbox"][i],
+            "parent": columns["parent"][i],
+            "inverse": columns["inverse"][i],
+            "landmarks": columns["landmarks"][i],
+        }
+        for i, name in enumerate(columns["names"])
+    }
+
+def to_shared_memory(
+    images: list[np.ndarray],
+) -> tuple[SharedMemory, list[tuple[int, tuple[int, ...]]]]:
+    """Copies a list of images to a new shared memory block.
+
+    The images are stored one after another, so that another process 
+    can map them without copying, see :func:`from_shared_memory`.
+
+    Args:
+        images: The list of images of type :attr:`numpy.uint8` (they 
+            can have different shapes).
+
+    Returns:
+        A tuple where the first element is the shared memory block (the 
+        caller must close and unlink it when it is no longer needed) and 
+        the second element is the list of the (offset, shape) of every 
+        image in the block.
+    """
+    # Offsets and shapes of the images in the block
+    specs, size = [], 0
+
+    for image in images:
+        specs.append((size, image.shape))
+        size += image.nbytes
+
+    # Allocate (a block can not be empty), copy the images
+    shm = SharedMemory(create=True, size=max(size, 1))
+
+    for image, (offset, shape) in zip(images, specs):
+        view = np.ndarray(shape, np.uint8, shm.buf, offset)
+        view[...] = image
+        del view
+
+    return shm, specs
+
+def from_shared_memory(
+    name: str,
+    specs: list[tuple[int, tuple[int, ...]]],
+) -> tuple[SharedMemory, list[np.ndarray]]:
+    """Maps the images of a shared memory block.
+
+    Args:
+        name: The name of the block (see :func:`to_shared_memory`).
+        specs: The list of the (offset, shape) of every image.
+
+    Returns:
+        A tuple where the first element is the shared memory block (the 
+        caller must close it once the images are no longer referenced) 
+        and the second element is the list of images (views into the 
+        block).
+    """
+    shm = SharedMemory(name=name)
+    images = [np.ndarray(shape, np.uint8, shm.buf, offset) for offset, shape in specs]
+
+    return shm, images
+
+class StageStats():
+    """Busy time of every stage of a pipeline.
+
+    Every stage runs on its own thread and measures the time it spends 
+    working (as opposed to waiting for the other stages) with 
+    :meth:`measure`. The utilisation of a stage is its busy time 
+    relative to the wall time of the pipeline: the bottleneck is the 
+    stage close to 100%, the others wait for it.
+    """
+    def __init__(self, stages: list[str]):
+        self.busy = {stage: 0.0 for stage in stages}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def measure(self, stage: str):
+        """Adds the time spent in the ``with`` block to ``stage``."""
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.busy[stage] += time.perf_counter() - start
+
+    def report(self) -> str:
+        """The busy time and utilisation of every stage."""
+        wall = max(time.perf_counter() - self.start, 1e-9)
+        lines = [f"Pipeline wall time: {wall:.2f}s"]
+
+        for stage, busy in self.busy.items():
+            lines.append(f"  {stage:<8} busy {busy:8.2f}s ({busy / wall:6.1%})")
+
+        return "\n".join(lines)
@@ -7,6 +7,7 @@ from optimization.image_editor import ImageEditor
 from optimization.arguments import get_arguments
 from face_crop_plus.cropper import Cropper
 from optimization.merge import merge_faces
+from optimization.stream import VideoStream, read_src_image
 
 
 def get_file_extension(directory, filename):
@@ -52,6 +53,19 @@ if __name__ == "__main__":
       print(f"src can only be jpg or png")
       sys.exit()
 
+    if args.stream:
+      if dst_ext != "mp4":
+        print(f"--stream needs an mp4 dst")
+        sys.exit()
+
+      # crop, edit and merge every frame in memory, straight into ./data/result.mp4
+      print("Requested Stream")
+      cropper = Cropper(face_factor=0.7, strategy="largest", output_size=args.crop_size, track_interval=args.track_interval or None, aspect_buckets=True, det_tile_size=args.det_tile_size or None)
+      image_editor = ImageEditor(args)
+      stream = VideoStream(cropper, image_editor, queue_size=args.stream_queue)
+      stream.run(read_src_image("./data/src." + src_ext), "./data/dst." + dst_ext, "./data/result.mp4")
+      sys.exit()
+
     # We only support jpg, png and mp4 for dst
     if dst_ext in ["jpg", "png"]:
       shutil.copy2("./data/dst."+dst_ext, "./data/dst/dst."+dst_ext)
@@ -75,9 +89,22 @@ if __name__ == "__main__":
       print("Requested Crop")
 
       # We align and crop images and put them into /data/aligned
-      cropper = Cropper(face_factor=0.7, strategy="largest", output_size=args.crop_size)
+      # with --crop_processes > 1 the images are cropped on worker processes, each with its own models,
+      # otherwise reading, cropping and saving overlap on 3 threads
+      # the images are detected in aspect ratio buckets (e.g. 16:9 frames at 1024x576, not letterboxed to 1024x1024)
+      crop_options = {
+        "num_processes": args.crop_processes,
+        "backend": "process" if args.crop_processes > 1 else "pipeline",
+        "torch_threads": args.crop_threads or None,
+        "aspect_buckets": True,
+        "det_tile_size": args.det_tile_size or None,
+      }
+      cropper = Cropper(face_factor=0.7, strategy="largest", output_size=args.crop_size, **crop_options)
       cropper.process_dir(input_dir="./data/src", output_dir="./data/src/aligned")
       if not args.no_extract:
+        if dst_ext == "mp4" and args.track_interval > 0:
+          # video frames: detect keyframes only, track the faces in between
+          cropper = Cropper(face_factor=0.7, strategy="largest", output_size=args.crop_size, track_interval=args.track_interval, **crop_options)
         cropper.process_dir(input_dir="./data/dst", output_dir="./data/dst/aligned")
       
     if do_edit:
@@ -173,12 +173,70 @@ class GaussianDiffusion:
             / (1.0 - self.alphas_cumprod)
         )
 
-        netArc_checkpoint = torch.load('./checkpoints/Arcface.tar')
-        netArc = netArc_checkpoint['model'].module
-        self.netArc = netArc.to('cuda').eval()
+        # derived arrays, so that every schedule term is a plain array
+        self.one_minus_alphas_cumprod = 1.0 - self.alphas_cumprod
+        self.log_betas = np.log(betas)
+        self.fixed_large_variance = np.append(self.posterior_variance[1], betas[1:])
+        self.fixed_large_log_variance = np.log(self.fixed_large_variance)
+        self.recip_posterior_mean_coef1 = 1.0 / self.posterior_mean_coef1
+        self.posterior_mean_coef_ratio = (
+            self.posterior_mean_coef2 / self.posterior_mean_coef1
+        )
+
+        # the posterior variance with the 0 of t = 0 clipped, the noise scale
+        # of the convergence tolerance of the parallel sampler
+        self.posterior_variance_clipped = np.exp(self.posterior_log_variance_clipped)
+
+        # calculations for DPM-Solver++, lambda_t = log(alpha_t / sigma_t)
+        # (the previous step of t = 0 is the clean image, lambda = inf)
+        self.sqrt_alphas_cumprod_prev = np.sqrt(self.alphas_cumprod_prev)
+        self.sqrt_one_minus_alphas_cumprod_prev = np.sqrt(
+            1.0 - self.alphas_cumprod_prev
+        )
+        self.half_log_snr = 0.5 * (
+            np.log(self.alphas_cumprod) - self.log_one_minus_alphas_cumprod
+        )
+        self.half_log_snr_prev = np.append(np.inf, self.half_log_snr[:-1])
+
+        # torch copies of the schedule arrays, per (name, device), see _extract
+        self._buffers = {}
+        self._netArc = None
 
         self.cos = nn.CosineSimilarity(dim=1, eps=1e-6)
 
+    @property
+    def netArc(self):
+        """
+        The ArcFace model, loaded on first use (sampling does not need it).
+        """
+        if self._netArc is None:
+            netArc_checkpoint = torch.load('./checkpoints/Arcface.tar')
+            netArc = netArc_checkpoint['model'].module
+            self._netArc = netArc.to('cuda').eval()
+        return self._netArc
+
+    def _extract(self, name, timesteps, broadcast_shape):
+        """
+        Extract values from a schedule array for a batch of indices.
+
+        Like _extract_into_tensor, but the array is copied to the device of
+        the timesteps (as float32, the working dtype) only once, and cached.
+
+        :param name: the name of the 1-D numpy array attribute, e.g. "betas".
+        :param timesteps: a tensor of indices into the array to extract.
+        :param broadcast_shape: a larger shape of K dimensions with the batch
+                                dimension equal to the length of timesteps.
+        :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
+        """
+        key = (name, timesteps.device)
+        if key not in self._buffers:
+            arr = getattr(self, name)
+            self._buffers[key] = th.from_numpy(arr).to(timesteps.device).float()
+        res = self._buffers[key][timesteps]
+        while len(res.shape) < len(broadcast_shape):
+            res = res[..., None]
+        return res.expand(broadcast_shape)
+
 
     def q_mean_variance(self, x_start, t):
         """
@@ -189,12 +247,10 @@ class GaussianDiffusion:
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
         mean = (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-        )
-        variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(
-            self.log_one_minus_alphas_cumprod, t, x_start.shape
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
         )
+        variance = self._extract("one_minus_alphas_cumprod", t, x_start.shape)
+        log_variance = self._extract("log_one_minus_alphas_cumprod", t, x_start.shape)
         return mean, variance, log_variance
 
     def q_sample(self, x_start, t, noise=None):
@@ -212,8 +268,8 @@ class GaussianDiffusion:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape)
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+            + self._extract("sqrt_one_minus_alphas_cumprod", t, x_start.shape)
             * noise
         )
 
@@ -226,13 +282,11 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
-        )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+            self._extract("posterior_mean_coef1", t, x_t.shape) * x_start
+            + self._extract("posterior_mean_coef2", t, x_t.shape) * x_t
         )
+        posterior_variance = self._extract("posterior_variance", t, x_t.shape)
+        posterior_log_variance_clipped = self._extract("posterior_log_variance_clipped", t, x_t.shape)
         assert (
             posterior_mean.shape[0]
             == posterior_variance.shape[0]
@@ -278,10 +332,8 @@ class GaussianDiffusion:
                 model_log_variance = model_var_values
                 model_variance = th.exp(model_log_variance)
             else:
-                min_log = _extract_into_tensor(
-                    self.posterior_log_variance_clipped, t, x.shape
-                )
-                max_log = _extract_into_tensor(np.log(self.betas), t, x.shape)
+                min_log = self._extract("posterior_log_variance_clipped", t, x.shape)
+                max_log = self._extract("log_betas", t, x.shape)
                 # The model_var_values is [-1, 1] for [min_var, max_var].
                 frac = (model_var_values + 1) / 2
                 model_log_variance = frac * max_log + (1 - frac) * min_log
@@ -291,16 +343,16 @@ class GaussianDiffusion:
                 # for fixedlarge, we set the initial (log-)variance like so
                 # to get a better decoder log likelihood.
                 ModelVarType.FIXED_LARGE: (
-                    np.append(self.posterior_variance[1], self.betas[1:]),
-                    np.log(np.append(self.posterior_variance[1], self.betas[1:])),
+                    "fixed_large_variance",
+                    "fixed_large_log_variance",
                 ),
                 ModelVarType.FIXED_SMALL: (
-                    self.posterior_variance,
-                    self.posterior_log_variance_clipped,
+                    "posterior_variance",
+                    "posterior_log_variance_clipped",
                 ),
             }[self.model_var_type]
-            model_variance = _extract_into_tensor(model_variance, t, x.shape)
-            model_log_variance = _extract_into_tensor(model_log_variance, t, x.shape)
+            model_variance = self._extract(model_variance, t, x.shape)
+            model_log_variance = self._extract(model_log_variance, t, x.shape)
 
         def process_xstart(x):
             if denoised_fn is not None:
@@ -340,32 +392,31 @@ class GaussianDiffusion:
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
+            - self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape) * eps
         )
 
     def _predict_xstart_from_xprev(self, x_t, t, xprev):
         assert x_t.shape == xprev.shape
         return (  # (xprev - coef2*x_t) / coef1
-            _extract_into_tensor(1.0 / self.posterior_mean_coef1, t, x_t.shape) * xprev
-            - _extract_into_tensor(
-                self.posterior_mean_coef2 / self.posterior_mean_coef1, t, x_t.shape
-            )
-            * x_t
+            self._extract("recip_posterior_mean_coef1", t, x_t.shape) * xprev
+            - self._extract("posterior_mean_coef_ratio", t, x_t.shape) * x_t
         )
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
             - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape)
 
     def _scale_timesteps(self, t):
         if self.rescale_timesteps:
             return t.float() * (1000.0 / self.num_timesteps)
         return t
 
-    def condition_mean(self, cond_fn, p_mean_var, x, t, img_id, model_kwargs=None):
+    def condition_mean(
+        self, cond_fn, p_mean_var, x, t, img_id, model_kwargs=None, share_model_output=False
+    ):
         """
         Compute the mean for the previous step, given a function cond_fn that
         computes the gradient of a conditional log probability with respect to
@@ -373,30 +424,50 @@ class GaussianDiffusion:
         condition on y.
 
         This uses the conditioning strategy from Sohl-Dickstein et al. (2015).
+
+        :param share_model_output: if True, p_mean_var was computed from x
+            (with grad enabled, unless detach_shared_output was requested from
+            the sampler) and is handed to cond_fn as the `p_mean_var` kwarg,
+            so cond_fn does not need to run the model a second time.
         """
         # gradient = cond_fn(x, self._scale_timesteps(t), **model_kwargs)
-        gradient = cond_fn(x, self._scale_timesteps(t), img_id, **model_kwargs)
+        gradient = cond_fn(
+            x,
+            self._scale_timesteps(t),
+            img_id,
+            **self._cond_kwargs(p_mean_var, model_kwargs, share_model_output),
+        )
         new_mean = (
-            p_mean_var["mean"].float() + p_mean_var["variance"] * gradient.float()
+            p_mean_var["mean"].detach().float()
+            + p_mean_var["variance"].detach() * gradient.float()
         )
         return new_mean
 
-    def condition_score(self, cond_fn, p_mean_var, x, t, img_id, model_kwargs=None):
+    def condition_score(
+        self, cond_fn, p_mean_var, x, t, img_id, model_kwargs=None, share_model_output=False
+    ):
         """
         Compute what the p_mean_variance output would have been, should the
         model's score function be conditioned by cond_fn.
 
-        See condition_mean() for details on cond_fn.
+        See condition_mean() for details on cond_fn and share_model_output.
 
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
 
-        eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
-        eps = eps - (1 - alpha_bar).sqrt() * cond_fn(
-            x, self._scale_timesteps(t), img_id, **model_kwargs
+        gradient = cond_fn(
+            x,
+            self._scale_timesteps(t),
+            img_id,
+            **self._cond_kwargs(p_mean_var, model_kwargs, share_model_output),
         )
+        p_mean_var = {k: v.detach() for k, v in p_mean_var.items()}
+        x = x.detach()
+
+        eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
+        eps = eps - (1 - alpha_bar).sqrt() * gradient
 
         out = p_mean_var.copy()
         out["pred_xstart"] = self._predict_xstart_from_eps(x, t, eps)
@@ -405,6 +476,62 @@ class GaussianDiffusion:
         )
         return out
 
+    def _cond_kwargs(self, p_mean_var, model_kwargs, share_model_output):
+        """
+        Build the keyword arguments cond_fn is called with.
+        """
+        cond_kwargs = dict(model_kwargs) if model_kwargs is not None else {}
+        if share_model_output:
+            cond_kwargs["p_mean_var"] = p_mean_var
+        return cond_kwargs
+
+    def _guided_p_mean_variance(
+        self,
+        model,
+        x,
+        t,
+        img_id,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        share_model_output=False,
+        detach_shared_output=False,
+    ):
+        """
+        Run p_mean_variance() for a guided step.
+
+        When share_model_output is set, the model is evaluated once with grad
+        enabled on x so that cond_fn can differentiate through the very same
+        forward pass that is used for the posterior sample. If in addition
+        detach_shared_output is set, cond_fn is not going to backpropagate
+        through the model, so the forward pass is run without grad.
+
+        :return: a tuple (x, out) where x requires grad if the output is shared.
+        """
+        if not share_model_output or detach_shared_output:
+            return x, self.p_mean_variance(
+                model,
+                x,
+                t,
+                img_id,
+                clip_denoised=clip_denoised,
+                denoised_fn=denoised_fn,
+                model_kwargs=model_kwargs,
+            )
+
+        with th.enable_grad():
+            x = x.detach().requires_grad_()
+            out = self.p_mean_variance(
+                model,
+                x,
+                t,
+                img_id,
+                clip_denoised=clip_denoised,
+                denoised_fn=denoised_fn,
+                model_kwargs=model_kwargs,
+            )
+        return x, out
+
     def p_sample(
         self,
         model,
@@ -415,6 +542,9 @@ class GaussianDiffusion:
         denoised_fn=None,
         cond_fn=None,
         model_kwargs=None,
+        share_model_output=False,
+        detach_shared_output=False,
+        noise=None,
     ):
         """
         Sample x_{t-1} from the model at the given timestep.
@@ -429,11 +559,19 @@ class GaussianDiffusion:
                         similarly to the model.
         :param model_kwargs: if not None, a dict of extra keyword arguments to
             pass to the model. This can be used for conditioning.
+        :param share_model_output: if True and cond_fn is given, the model is
+            run once with grad enabled and its output is passed to cond_fn as
+            `p_mean_var` instead of cond_fn running the model again.
+        :param detach_shared_output: if True, the shared forward pass is run
+            without grad, for cond_fns that treat the model output as constant.
+        :param noise: if specified, the noise of the sample, of the same shape
+                      as x. If not specified, it is drawn at random.
         :return: a dict containing the following keys:
                  - 'sample': a random sample from the model.
                  - 'pred_xstart': a prediction of x_0.
         """
-        out = self.p_mean_variance(
+        share_model_output = share_model_output and cond_fn is not None
+        x, out = self._guided_p_mean_variance(
             model,
             x,
             t,
@@ -441,15 +579,25 @@ class GaussianDiffusion:
             clip_denoised=clip_denoised,
             denoised_fn=denoised_fn,
             model_kwargs=model_kwargs,
+            share_model_output=share_model_output,
+            detach_shared_output=detach_shared_output,
         )
-        noise = th.randn_like(x)
+        if noise is None:
+            noise = th.randn_like(x)
         nonzero_mask = (
             (t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
         )  # no noise when t == 0
         if cond_fn is not None:
             out["mean"] = self.condition_mean(
-                cond_fn, out, x, t, img_id, model_kwargs=model_kwargs
+                cond_fn,
+                out,
+                x,
+                t,
+                img_id,
+                model_kwargs=model_kwargs,
+                share_model_output=share_model_output,
             )
+        out = {k: v.detach() for k, v in out.items()}
         sample = out["mean"] + nonzero_mask * th.exp(0.5 * out["log_variance"]) * noise
         return {"sample": sample, "pred_xstart": out["pred_xstart"]}
 
@@ -466,7 +614,11 @@ class GaussianDiffusion:
         progress=False,
         skip_timesteps=0,
         init_image=None,
+        init_latent=None,
+        postprocess_fn=None,
         randomize_class=False,
+        share_model_output=False,
+        detach_shared_output=False,
     ):
         """
         Generate samples from the model.
@@ -485,6 +637,16 @@ class GaussianDiffusion:
         :param device: if specified, the device to create the samples on.
                        If not specified, use a model parameter's device.
         :param progress: if True, show a tqdm progress bar.
+        :param init_latent: if specified, the noisy images the sampling starts
+            from, e.g. from ddim_reverse_sample_loop(), instead of init_image
+            noised with q_sample().
+        :param postprocess_fn: if not None, a function applied to the output
+            dict of every step, as postprocess_fn(out, t), before the next
+            step (e.g. to blend the sample with a noised background).
+        :param share_model_output: if True, reuse one model forward pass for
+            both cond_fn and the sample at every step. See p_sample().
+        :param detach_shared_output: if True, run that shared forward pass
+            without grad. See p_sample().
         :return: a non-differentiable batch of samples.
         """
         final = None
@@ -500,7 +662,11 @@ class GaussianDiffusion:
             progress=progress,
             skip_timesteps=skip_timesteps,
             init_image=init_image,
+            init_latent=init_latent,
+            postprocess_fn=postprocess_fn,
             randomize_class=randomize_class,
+            share_model_output=share_model_output,
+            detach_shared_output=detach_shared_output,
         ):
             final = sample
         return final["sample"]
@@ -518,10 +684,13 @@ class GaussianDiffusion:
         progress=False,
         skip_timesteps=0,
         init_image=None,
+        init_latent=None,
         postprocess_fn=None,
         randomize_class=False,
 
         img_id = None,
+        share_model_output=False,
+        detach_shared_output=False,
     ):
         """
         Generate samples from the model and yield intermediate samples from
@@ -546,13 +715,19 @@ class GaussianDiffusion:
 
         indices = list(range(self.num_timesteps - skip_timesteps))[::-1]
 
-        batch_size = shape[0]
-        init_image_batch = th.tile(init_image, dims=(batch_size, 1, 1, 1))
-        img = self.q_sample(
-            x_start=init_image_batch,
-            t=th.tensor(indices[0], dtype=th.long, device=device),
-            noise=img,
-        )
+        if init_latent is not None:
+            img = init_latent
+        else:
+            batch_size = shape[0]
+            init_image_batch = init_image
+            if init_image.shape[0] != batch_size:
+                # A single init image is shared by the whole batch
+                init_image_batch = th.tile(init_image, dims=(batch_size, 1, 1, 1))
+            img = self.q_sample(
+                x_start=init_image_batch,
+                t=th.tensor(indices[0], dtype=th.long, device=device),
+                noise=img,
+            )
 
         if progress:
             # Lazy import so that we don't depend on tqdm.
@@ -579,12 +754,171 @@ class GaussianDiffusion:
                     denoised_fn=denoised_fn,
                     cond_fn=cond_fn,
                     model_kwargs=model_kwargs,
+                    share_model_output=share_model_output,
+                    detach_shared_output=detach_shared_output,
                 )
                 if postprocess_fn is not None:
                     out = postprocess_fn(out, t)
                 yield out
                 img = out["sample"]
 
+    def p_sample_loop_parallel_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        window=8,
+        tolerance=0.1,
+        skip_timesteps=0,
+        init_image=None,
+        init_latent=None,
+        postprocess_fn=None,
+        randomize_class=False,
+
+        img_id=None,
+        share_model_output=False,
+        detach_shared_output=False,
+    ):
+        """
+        Generate samples from the model like p_sample_loop_progressive(), but
+        refine a window of timesteps at once by Picard (fixed-point) iteration,
+        as in ParaDiGMS (Shih et al., 2023).
+
+        The noise of every step is drawn once, so each step is a deterministic
+        function of its input. Every iteration runs the model on the current
+        guesses of the whole window in one batched call, then rebuilds the
+        guesses step by step from the exact start of the window. The converged
+        steps are yielded and the window slides past them, so the result
+        matches the sequential sampler up to the tolerance, in fewer (but
+        larger) model calls.
+
+        Arguments are the same as p_sample_loop(), plus:
+
+        :param window: the number of timesteps refined together.
+        :param tolerance: a step has converged when the mean squared change of
+                          its sample is below tolerance ** 2 times the
+                          posterior variance of the step.
+        :param postprocess_fn: as in p_sample_loop(), it is applied to every
+            step of the window at every iteration, in order, so it has to be
+            deterministic.
+        """
+        assert window >= 1, "the window must hold at least one timestep"
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+
+        if skip_timesteps and init_image is None:
+            init_image = th.zeros_like(img)
+
+        indices = list(range(self.num_timesteps - skip_timesteps))[::-1]
+
+        if init_latent is not None:
+            img = init_latent
+        elif init_image is not None:
+            my_t = th.ones([shape[0]], device=device, dtype=th.long) * indices[0]
+            batch_size = shape[0]
+            init_image_batch = init_image
+            if init_image.shape[0] != batch_size:
+                # A single init image is shared by the whole batch
+                init_image_batch = th.tile(init_image, dims=(batch_size, 1, 1, 1))
+            img = self.q_sample(init_image_batch, my_t, img)
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            progress = tqdm(total=len(indices))
+
+        # trajectory[j] is the (guess of the) sample after j steps, noises[j]
+        # the noise of step j, both only kept for the current window
+        trajectory = {0: img}
+        noises = {}
+        begin = 0
+        while begin < len(indices):
+            end = min(begin + window, len(indices))
+            for j in range(begin, end):
+                if j not in noises:
+                    # a new step of the window starts from the last guess
+                    noises[j] = th.randn(*shape, device=device)
+                    trajectory[j + 1] = trajectory[j]
+            size = end - begin
+
+            t = th.tensor(
+                [indices[j] for j in range(begin, end) for _ in range(shape[0])],
+                device=device,
+            )
+            if randomize_class and "y" in model_kwargs:
+                model_kwargs["y"] = th.randint(
+                    low=0,
+                    high=model.num_classes,
+                    size=model_kwargs["y"].shape,
+                    device=model_kwargs["y"].device,
+                )
+            with th.no_grad():
+                # the steps of the window in one batch, step major
+                x = th.cat([trajectory[j] for j in range(begin, end)])
+                out = self.p_sample(
+                    model,
+                    x,
+                    t,
+                    None if img_id is None else img_id.repeat(size, 1),
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    cond_fn=cond_fn,
+                    model_kwargs=model_kwargs,
+                    share_model_output=share_model_output,
+                    detach_shared_output=detach_shared_output,
+                    noise=th.cat([noises[j] for j in range(begin, end)]),
+                )
+                drifts = (out["sample"] - x).chunk(size)
+                pred_xstarts = out["pred_xstart"].chunk(size)
+
+                # x_{j + 1} = x_j + drift_j, from the exact start of the window
+                sample = trajectory[begin]
+                outs = []
+                unconverged = None
+                for k, j in enumerate(range(begin, end)):
+                    step_t = t[k * shape[0] : (k + 1) * shape[0]]
+                    step = {
+                        "sample": sample + drifts[k],
+                        "pred_xstart": pred_xstarts[k],
+                    }
+                    if postprocess_fn is not None:
+                        step = postprocess_fn(step, step_t)
+                    sample = step["sample"]
+                    outs.append(step)
+
+                    error = (sample - trajectory[j + 1]).square().flatten(1).mean(1)
+                    threshold = (
+                        tolerance ** 2 * self.posterior_variance_clipped[indices[j]]
+                    )
+                    if unconverged is None and error.max() > threshold:
+                        unconverged = k
+                    trajectory[j + 1] = sample
+
+            # the steps before the first unconverged one are final, the first
+            # step always is (it starts from an exact sample)
+            stride = size if unconverged is None else max(unconverged, 1)
+            for k in range(stride):
+                yield outs[k]
+                del trajectory[begin + k], noises[begin + k]
+            if progress:
+                progress.update(stride)
+            begin += stride
+
+        if progress:
+            progress.close()
+
     def ddim_sample(
         self,
         model,
@@ -596,13 +930,16 @@ class GaussianDiffusion:
         cond_fn=None,
         model_kwargs=None,
         eta=0.0,
+        share_model_output=False,
+        detach_shared_output=False,
     ):
         """
         Sample x_{t-1} from the model using DDIM.
 
         Same usage as p_sample().
         """
-        out = self.p_mean_variance(
+        share_model_output = share_model_output and cond_fn is not None
+        x, out = self._guided_p_mean_variance(
             model,
             x,
             t,
@@ -610,16 +947,28 @@ class GaussianDiffusion:
             clip_denoised=clip_denoised,
             denoised_fn=denoised_fn,
             model_kwargs=model_kwargs,
+            share_model_output=share_model_output,
+            detach_shared_output=detach_shared_output,
         )
         if cond_fn is not None:
-            out = self.condition_score(cond_fn, out, x, t, img_id, model_kwargs=model_kwargs)
+            out = self.condition_score(
+                cond_fn,
+                out,
+                x,
+                t,
+                img_id,
+                model_kwargs=model_kwargs,
+                share_model_output=share_model_output,
+            )
+        out = {k: v.detach() for k, v in out.items()}
+        x = x.detach()
 
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
+        alpha_bar_prev = self._extract("alphas_cumprod_prev", t, x.shape)
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
@@ -642,6 +991,7 @@ class GaussianDiffusion:
         model,
         x,
         t,
+        img_id,
         clip_denoised=True,
         denoised_fn=None,
         model_kwargs=None,
@@ -649,12 +999,15 @@ class GaussianDiffusion:
     ):
         """
         Sample x_{t+1} from the model using DDIM reverse ODE.
+
+        :param img_id: the [N x 512] identities conditioning the model.
         """
         assert eta == 0.0, "Reverse ODE only for deterministic path"
         out = self.p_mean_variance(
             model,
             x,
             t,
+            img_id,
             clip_denoised=clip_denoised,
             denoised_fn=denoised_fn,
             model_kwargs=model_kwargs,
@@ -662,10 +1015,10 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
+            self._extract("sqrt_recip_alphas_cumprod", t, x.shape) * x
             - out["pred_xstart"]
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x.shape)
+        alpha_bar_next = self._extract("alphas_cumprod_next", t, x.shape)
 
         # Equation 12. reversed
         mean_pred = (
@@ -675,6 +1028,53 @@ class GaussianDiffusion:
 
         return {"sample": mean_pred, "pred_xstart": out["pred_xstart"]}
 
+    def ddim_reverse_sample_loop(
+        self,
+        model,
+        x_start,
+        img_id,
+        skip_timesteps=0,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        progress=False,
+    ):
+        """
+        Invert images with the DDIM reverse ODE: deterministically map them to
+        the noisy images the sampling starts from when skipping
+        skip_timesteps steps.
+
+        :param x_start: the [N x C x ...] images to invert.
+        :param img_id: the [N x 512] identities conditioning the model.
+        :param progress: if True, show a tqdm progress bar.
+        :return: the [N x C x ...] noisy images at timestep
+                 num_timesteps - skip_timesteps - 1, to pass as init_latent
+                 to the sample loops.
+        """
+        img = x_start
+        indices = list(range(self.num_timesteps - skip_timesteps - 1))
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        for i in indices:
+            t = th.tensor([i] * x_start.shape[0], device=x_start.device)
+            with th.no_grad():
+                out = self.ddim_reverse_sample(
+                    model,
+                    img,
+                    t,
+                    img_id,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    model_kwargs=model_kwargs,
+                )
+                img = out["sample"]
+        return img
+
     def ddim_sample_loop(
         self,
         model,
@@ -689,9 +1089,13 @@ class GaussianDiffusion:
         eta=0.0,
         skip_timesteps=0,
         init_image=None,
+        init_latent=None,
+        postprocess_fn=None,
         randomize_class=False,
 
         img_id=None,
+        share_model_output=False,
+        detach_shared_output=False,
     ):
         """
         Generate samples from the model using DDIM.
@@ -712,9 +1116,13 @@ class GaussianDiffusion:
             eta=eta,
             skip_timesteps=skip_timesteps,
             init_image=init_image,
+            init_latent=init_latent,
+            postprocess_fn=postprocess_fn,
             randomize_class=randomize_class,
 
-            img_id=None,
+            img_id=img_id,
+            share_model_output=share_model_output,
+            detach_shared_output=detach_shared_output,
         ):
             final = sample
         return final["sample"]
@@ -733,10 +1141,13 @@ class GaussianDiffusion:
         eta=0.0,
         skip_timesteps=0,
         init_image=None,
+        init_latent=None,
         postprocess_fn=None,
         randomize_class=False,
 
-        img_id=None
+        img_id=None,
+        share_model_output=False,
+        detach_shared_output=False,
     ):
         """
         Use DDIM to sample from the model and yield intermediate samples from
@@ -757,10 +1168,15 @@ class GaussianDiffusion:
 
         indices = list(range(self.num_timesteps - skip_timesteps))[::-1]
 
-        if init_image is not None:
+        if init_latent is not None:
+            img = init_latent
+        elif init_image is not None:
             my_t = th.ones([shape[0]], device=device, dtype=th.long) * indices[0]
             batch_size = shape[0]
-            init_image_batch = th.tile(init_image, dims=(batch_size, 1, 1, 1))
+            init_image_batch = init_image
+            if init_image.shape[0] != batch_size:
+                # A single init image is shared by the whole batch
+                init_image_batch = th.tile(init_image, dims=(batch_size, 1, 1, 1))
             img = self.q_sample(init_image_batch, my_t, img)
 
         if progress:
@@ -789,7 +1205,239 @@ class GaussianDiffusion:
                     cond_fn=cond_fn,
                     model_kwargs=model_kwargs,
                     eta=eta,
+                    share_model_output=share_model_output,
+                    detach_shared_output=detach_shared_output,
+                )
+                if postprocess_fn is not None:
+                    out = postprocess_fn(out, t)
+                yield out
+                img = out["sample"]
+
+    def dpm_solver_sample(
+        self,
+        model,
+        x,
+        t,
+        img_id,
+        prev_xstart=None,
+        prev_h=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        share_model_output=False,
+        detach_shared_output=False,
+    ):
+        """
+        Sample x_{t-1} from the model with a step of the multistep
+        DPM-Solver++ (Lu et al., 2022), which integrates the probability flow
+        ODE with data (x_start) predictions.
+
+        Same usage as p_sample(), plus:
+
+        :param prev_xstart: the pred_xstart of the previous step, for a second
+                            order step. If None, the step is first order,
+                            which is the same as a deterministic DDIM step.
+        :param prev_h: the 'h' of the previous step.
+        :return: a dict containing the following keys:
+                 - 'sample': the sample x_{t-1}.
+                 - 'pred_xstart': a prediction of x_0.
+                 - 'h': the step size in lambda = log(alpha / sigma).
+        """
+        share_model_output = share_model_output and cond_fn is not None
+        x, out = self._guided_p_mean_variance(
+            model,
+            x,
+            t,
+            img_id,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+            share_model_output=share_model_output,
+            detach_shared_output=detach_shared_output,
+        )
+        if cond_fn is not None:
+            out = self.condition_score(
+                cond_fn,
+                out,
+                x,
+                t,
+                img_id,
+                model_kwargs=model_kwargs,
+                share_model_output=share_model_output,
+            )
+        out = {k: v.detach() for k, v in out.items()}
+        x = x.detach()
+
+        h = self._extract("half_log_snr_prev", t, x.shape) - self._extract(
+            "half_log_snr", t, x.shape
+        )
+        denoised = out["pred_xstart"]
+        if prev_xstart is not None:
+            # D = (1 + 1 / 2r) x_0 - 1 / 2r x_0_prev with r = h_prev / h.
+            # The last two steps are first order: h is infinite for the last
+            # one and much larger than h_prev for the one before it with
+            # respaced timesteps, where the extrapolation is unstable.
+            last = (t <= 1).view(-1, *([1] * (len(x.shape) - 1)))
+            coef = th.where(last, th.zeros_like(h), 0.5 * h / prev_h)
+            denoised = denoised + coef * (denoised - prev_xstart)
+
+        sample = (
+            self._extract("sqrt_one_minus_alphas_cumprod_prev", t, x.shape)
+            / self._extract("sqrt_one_minus_alphas_cumprod", t, x.shape)
+            * x
+            - self._extract("sqrt_alphas_cumprod_prev", t, x.shape)
+            * th.expm1(-h)
+            * denoised
+        )
+        return {"sample": sample, "pred_xstart": out["pred_xstart"], "h": h}
+
+    def dpm_solver_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        order=2,
+        skip_timesteps=0,
+        init_image=None,
+        init_latent=None,
+        postprocess_fn=None,
+        randomize_class=False,
+
+        img_id=None,
+        share_model_output=False,
+        detach_shared_output=False,
+    ):
+        """
+        Generate samples from the model using DPM-Solver++.
+
+        Same usage as p_sample_loop(), plus:
+
+        :param order: 1 or 2, the order of the multistep solver. 1 is the
+                      same as a deterministic DDIM.
+        """
+        final = None
+        for sample in self.dpm_solver_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            cond_fn=cond_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            order=order,
+            skip_timesteps=skip_timesteps,
+            init_image=init_image,
+            init_latent=init_latent,
+            postprocess_fn=postprocess_fn,
+            randomize_class=randomize_class,
+
+            img_id=img_id,
+            share_model_output=share_model_output,
+            detach_shared_output=detach_shared_output,
+        ):
+            final = sample
+        return final["sample"]
+
+    def dpm_solver_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        order=2,
+        skip_timesteps=0,
+        init_image=None,
+        init_latent=None,
+        postprocess_fn=None,
+        randomize_class=False,
+
+        img_id=None,
+        share_model_output=False,
+        detach_shared_output=False,
+    ):
+        """
+        Use DPM-Solver++ to sample from the model and yield intermediate
+        samples from each timestep.
+
+        Same usage as dpm_solver_sample_loop() and p_sample_loop_progressive().
+        """
+        assert order in (1, 2), "DPM-Solver++ is only implemented up to order 2"
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+
+        if skip_timesteps and init_image is None:
+            init_image = th.zeros_like(img)
+
+        indices = list(range(self.num_timesteps - skip_timesteps))[::-1]
+
+        if init_latent is not None:
+            img = init_latent
+        elif init_image is not None:
+            my_t = th.ones([shape[0]], device=device, dtype=th.long) * indices[0]
+            batch_size = shape[0]
+            init_image_batch = init_image
+            if init_image.shape[0] != batch_size:
+                # A single init image is shared by the whole batch
+                init_image_batch = th.tile(init_image, dims=(batch_size, 1, 1, 1))
+            img = self.q_sample(init_image_batch, my_t, img)
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        # the previous data prediction and step size, for the multistep update
+        prev_xstart = None
+        prev_h = None
+        for i in indices:
+            t = th.tensor([i] * shape[0], device=device)
+            if randomize_class and "y" in model_kwargs:
+                model_kwargs["y"] = th.randint(
+                    low=0,
+                    high=model.num_classes,
+                    size=model_kwargs["y"].shape,
+                    device=model_kwargs["y"].device,
+                )
+            with th.no_grad():
+                out = self.dpm_solver_sample(
+                    model,
+                    img,
+                    t,
+                    img_id,
+                    prev_xstart=prev_xstart,
+                    prev_h=prev_h,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    cond_fn=cond_fn,
+                    model_kwargs=model_kwargs,
+                    share_model_output=share_model_output,
+                    detach_shared_output=detach_shared_output,
                 )
+                if order == 2:
+                    prev_xstart = out["pred_xstart"]
+                    prev_h = out["h"]
+                if postprocess_fn is not None:
+                    out = postprocess_fn(out, t)
                 yield out
                 img = out["sample"]
 
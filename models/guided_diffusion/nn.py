@@ -129,10 +129,13 @@ def checkpoint(func, inputs, params, flag):
     :param func: the function to evaluate.
     :param inputs: the argument sequence to pass to `func`.
     :param params: a sequence of parameters `func` depends on but does not
-                   explicitly take as arguments.
+                   explicitly take as arguments. Frozen parameters (with
+                   requires_grad False) are skipped, so no gradient is ever
+                   computed for them.
     :param flag: if False, disable gradient checkpointing.
     """
     if flag:
+        params = [p for p in params if p.requires_grad]
         args = tuple(inputs) + tuple(params)
         return CheckpointFunction.apply(func, len(inputs), *args)
     else:
@@ -151,19 +154,33 @@ class CheckpointFunction(th.autograd.Function):
 
     @staticmethod
     def backward(ctx, *output_grads):
-        ctx.input_tensors = [x.detach().requires_grad_(True) for x in ctx.input_tensors]
+        # Only differentiate with respect to what actually needs a gradient,
+        # e.g. the input image but not the timestep embedding or the weights.
+        needs_grad = ctx.needs_input_grad[2:]
+        ctx.input_tensors = [
+            x.detach().requires_grad_(needs)
+            for x, needs in zip(ctx.input_tensors, needs_grad)
+        ]
         with th.enable_grad():
             # Fixes a bug where the first op in run_function modifies the
             # Tensor storage in place, which is not allowed for detach()'d
             # Tensors.
             shallow_copies = [x.view_as(x) for x in ctx.input_tensors]
             output_tensors = ctx.run_function(*shallow_copies)
-        input_grads = th.autograd.grad(
-            output_tensors,
-            ctx.input_tensors + ctx.input_params,
-            output_grads,
-            allow_unused=True,
+        targets = [
+            x
+            for x, needs in zip(ctx.input_tensors + ctx.input_params, needs_grad)
+            if needs
+        ]
+        grads = iter(
+            th.autograd.grad(
+                output_tensors,
+                targets,
+                output_grads,
+                allow_unused=True,
+            )
         )
+        input_grads = tuple(next(grads) if needs else None for needs in needs_grad)
         del ctx.input_tensors
         del ctx.input_params
         del output_tensors
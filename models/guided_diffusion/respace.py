@@ -1,3 +1,5 @@
+import functools
+
 import numpy as np
 import torch as th
 
@@ -60,6 +62,29 @@ def space_timesteps(num_timesteps, section_counts):
     return set(all_steps)
 
 
+@functools.lru_cache(maxsize=None)
+def space_betas(betas, use_timesteps):
+    """
+    Compute the betas of a diffusion process which only keeps some timesteps
+    of a base process. The result is memoised per (betas, timesteps) key.
+
+    :param betas: a tuple of the betas of the base process.
+    :param use_timesteps: a sorted tuple of the timesteps to retain.
+    :return: a tuple (new_betas, timestep_map) of tuples.
+    """
+    alphas_cumprod = np.cumprod(1.0 - np.array(betas, dtype=np.float64))
+    use_timesteps = set(use_timesteps)
+    last_alpha_cumprod = 1.0
+    new_betas = []
+    timestep_map = []
+    for i, alpha_cumprod in enumerate(alphas_cumprod):
+        if i in use_timesteps:
+            new_betas.append(1 - alpha_cumprod / last_alpha_cumprod)
+            last_alpha_cumprod = alpha_cumprod
+            timestep_map.append(i)
+    return tuple(new_betas), tuple(timestep_map)
+
+
 class SpacedDiffusion(GaussianDiffusion):
     """
     A diffusion process which can skip steps in a base diffusion process.
@@ -71,17 +96,16 @@ class SpacedDiffusion(GaussianDiffusion):
 
     def __init__(self, use_timesteps, **kwargs):
         self.use_timesteps = set(use_timesteps)
-        self.timestep_map = []
         self.original_num_steps = len(kwargs["betas"])
 
-        base_diffusion = GaussianDiffusion(**kwargs)  # pylint: disable=missing-kwoa
-        last_alpha_cumprod = 1.0
-        new_betas = []
-        for i, alpha_cumprod in enumerate(base_diffusion.alphas_cumprod):
-            if i in self.use_timesteps:
-                new_betas.append(1 - alpha_cumprod / last_alpha_cumprod)
-                last_alpha_cumprod = alpha_cumprod
-                self.timestep_map.append(i)
+        # no base GaussianDiffusion is needed, only its alphas_cumprod
+        new_betas, timestep_map = space_betas(
+            tuple(np.asarray(kwargs["betas"], dtype=np.float64).tolist()),
+            tuple(sorted(self.use_timesteps)),
+        )
+        self.timestep_map = list(timestep_map)
+        # the mapped (and rescaled) timesteps, per (device, dtype)
+        self.map_tensors = {}
         kwargs["betas"] = np.array(new_betas)
         super().__init__(**kwargs)
 
@@ -105,7 +129,11 @@ class SpacedDiffusion(GaussianDiffusion):
         if isinstance(model, _WrappedModel):
             return model
         return _WrappedModel(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
+            model,
+            self.timestep_map,
+            self.rescale_timesteps,
+            self.original_num_steps,
+            self.map_tensors,
         )
 
     def _scale_timesteps(self, t):
@@ -114,15 +142,22 @@ class SpacedDiffusion(GaussianDiffusion):
 
 
 class _WrappedModel:
-    def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
+    def __init__(
+        self, model, timestep_map, rescale_timesteps, original_num_steps, map_tensors=None
+    ):
         self.model = model
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        # shared with the SpacedDiffusion, so it is only built once per device
+        self.map_tensors = {} if map_tensors is None else map_tensors
 
     def __call__(self, x, ts, src_id, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
-        if self.rescale_timesteps:
-            new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
+        key = (ts.device, ts.dtype)
+        if key not in self.map_tensors:
+            map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+            if self.rescale_timesteps:
+                map_tensor = map_tensor.float() * (1000.0 / self.original_num_steps)
+            self.map_tensors[key] = map_tensor
+        new_ts = self.map_tensors[key][ts]
         return self.model(x, new_ts, src_id, **kwargs)
@@ -56,6 +56,7 @@ def model_and_diffusion_defaults():
         dropout=0.0,
         class_cond=False,
         use_checkpoint=False,
+        use_attention_checkpoint=True,
         use_scale_shift_norm=True,
         resblock_updown=False,
         use_fp16=False,
@@ -95,6 +96,7 @@ def create_model_and_diffusion(
     resblock_updown,
     use_fp16,
     use_new_attention_order,
+    use_attention_checkpoint=True,
 ):
     model = create_model(
         image_size,
@@ -104,6 +106,7 @@ def create_model_and_diffusion(
         learn_sigma=learn_sigma,
         class_cond=class_cond,
         use_checkpoint=use_checkpoint,
+        use_attention_checkpoint=use_attention_checkpoint,
         attention_resolutions=attention_resolutions,
         num_heads=num_heads,
         num_head_channels=num_head_channels,
@@ -135,6 +138,7 @@ def create_model(
     learn_sigma=False,
     class_cond=False,
     use_checkpoint=False,
+    use_attention_checkpoint=True,
     attention_resolutions="16",
     num_heads=1,
     num_head_channels=-1,
@@ -174,6 +178,7 @@ def create_model(
         channel_mult=channel_mult,
         num_classes=(NUM_CLASSES if class_cond else None),
         use_checkpoint=use_checkpoint,
+        use_attention_checkpoint=use_attention_checkpoint,
         use_fp16=use_fp16,
         num_heads=num_heads,
         num_head_channels=num_head_channels,
@@ -305,7 +305,7 @@ class AttentionBlock(nn.Module):
         self.proj_out = zero_module(conv_nd(1, channels, channels, 1))
 
     def forward(self, x):
-        return checkpoint(self._forward, (x,), self.parameters(), True)
+        return checkpoint(self._forward, (x,), self.parameters(), self.use_checkpoint)
 
     def _forward(self, x):
         b, c, *spatial = x.shape
@@ -424,6 +424,8 @@ class UNetModel(nn.Module):
     :param num_classes: if specified (as an int), then this model will be
         class-conditional with `num_classes` classes.
     :param use_checkpoint: use gradient checkpointing to reduce memory usage.
+    :param use_attention_checkpoint: recompute the attention blocks in the
+        backward pass instead of storing their activations.
     :param num_heads: the number of attention heads in each attention layer.
     :param num_heads_channels: if specified, ignore num_heads and instead use
                                a fixed channel width per attention head.
@@ -449,6 +451,7 @@ class UNetModel(nn.Module):
         dims=2,
         num_classes=None,
         use_checkpoint=False,
+        use_attention_checkpoint=True,
         use_fp16=False,
         num_heads=1,
         num_head_channels=-1,
@@ -522,7 +525,7 @@ class UNetModel(nn.Module):
                     layers.append(
                         AttentionBlock(
                             ch,
-                            use_checkpoint=use_checkpoint,
+                            use_checkpoint=use_attention_checkpoint,
                             num_heads=num_heads,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
@@ -569,7 +572,7 @@ class UNetModel(nn.Module):
             ),
             AttentionBlock(
                 ch,
-                use_checkpoint=use_checkpoint,
+                use_checkpoint=use_attention_checkpoint,
                 num_heads=num_heads,
                 num_head_channels=num_head_channels,
                 use_new_attention_order=use_new_attention_order,
@@ -607,7 +610,7 @@ class UNetModel(nn.Module):
                     layers.append(
                         AttentionBlock(
                             ch,
-                            use_checkpoint=use_checkpoint,
+                            use_checkpoint=use_attention_checkpoint,
                             num_heads=num_heads_upsample,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
@@ -656,6 +659,14 @@ class UNetModel(nn.Module):
         self.middle_block.apply(convert_module_to_f32)
         self.output_blocks.apply(convert_module_to_f32)
 
+    def freeze(self):
+        """
+        Put the model in inference mode: evaluation mode with every parameter
+        frozen, so gradients only flow back to the inputs (e.g. for guidance).
+        """
+        self.requires_grad_(False)
+        return self.eval()
+
     def forward(self, x, timesteps, src_id, y=None):
         """
         Apply the model to an input batch.
@@ -728,6 +739,7 @@ class EncoderUNetModel(nn.Module):
         conv_resample=True,
         dims=2,
         use_checkpoint=False,
+        use_attention_checkpoint=True,
         use_fp16=False,
         num_heads=1,
         num_head_channels=-1,
@@ -788,7 +800,7 @@ class EncoderUNetModel(nn.Module):
                     layers.append(
                         AttentionBlock(
                             ch,
-                            use_checkpoint=use_checkpoint,
+                            use_checkpoint=use_attention_checkpoint,
                             num_heads=num_heads,
                             num_head_channels=num_head_channels,
                             use_new_attention_order=use_new_attention_order,
@@ -833,7 +845,7 @@ class EncoderUNetModel(nn.Module):
             ),
             AttentionBlock(
                 ch,
-                use_checkpoint=use_checkpoint,
+                use_checkpoint=use_attention_checkpoint,
                 num_heads=num_heads,
                 num_head_channels=num_head_channels,
                 use_new_attention_order=use_new_attention_order,
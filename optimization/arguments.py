@@ -4,16 +4,20 @@ from re import S
 def get_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
 
-    # Larger batch sizes can accelerate the training process by processing more samples in parallel but may require more memory. 
-    # However, smaller batch sizes can provide more accurate gradient estimates and better generalization but may require more iterations to converge.
+    # The number of dst frames swapped together, each frame keeps its own mask, background and eye boxes.
+    # Larger batch sizes (4 to 16 frames) process a video much faster but require more memory.
     # default=1
     parser.add_argument(
         "--batch_size",
         type=int,
-        help="Current version of the code only supports a batch_size of 1",
+        help="The number of dst frames swapped together in one sampling call",
         default=1,
     )
 
+    # The number of dst batches decoded in the background while the current batch is sampled
+    # default=2
+    parser.add_argument("--prefetch", type=int, help="The number of dst batches decoded ahead", default=2)
+
     # Skipping steps in the diffusion process refers to bypassing or not performing certain intermediate steps and directly applying the diffusion operation at a later stage. 
     # This approach is often used to speed up the inference process or reduce computational requirements.
     # Skipping too many steps may result in a loss of fine-grained details or accuracy, while fewer skipped steps may provide more accurate results but at the cost of increased computation.
@@ -35,6 +39,63 @@ def get_arguments() -> argparse.Namespace:
         action="store_true",
     )
 
+    # The amount of noise added at every DDIM step, 0 is the deterministic DDIM and 1 is close to DDPM
+    parser.add_argument(
+        "--ddim_eta",
+        type=float,
+        help="The DDIM eta (0 for deterministic sampling)",
+        default=0.0,
+    )
+
+    # DPM-Solver++ is a multistep ODE solver, of order 1 (the same as a deterministic DDIM) or 2.
+    # It reaches the quality of DDPM in far fewer steps (10 to 20) and takes precedence over --ddim
+    parser.add_argument(
+        "--dpm_solver",
+        help="Indicator for using DPM-Solver++ instead of DDPM or DDIM",
+        action="store_true",
+    )
+
+    # The order of DPM-Solver++, 2 is the multistep second order solver (2M) and 1 a deterministic DDIM
+    # default=2
+    parser.add_argument("--solver_order", type=int, help="The order of DPM-Solver++", choices=[1, 2], default=2)
+
+    # Run the DDPM sampler in parallel: a window of timesteps is refined at once by fixed-point (Picard) iteration,
+    # every iteration is one batched UNet call over the whole window. It needs more UNet evaluations in total but fewer
+    # sequential ones, which lowers the latency when the GPU (or CPU) is not saturated by --batch_size frames.
+    # Only for DDPM, --ddim and --dpm_solver take precedence
+    parser.add_argument(
+        "--parallel",
+        help="Indicator for refining windows of DDPM steps in parallel",
+        action="store_true",
+    )
+
+    # The number of timesteps refined together by --parallel, the UNet batch is --parallel_window times larger
+    # default=8
+    parser.add_argument("--parallel_window", type=int, help="The number of timesteps refined together", default=8)
+
+    # A step of --parallel has converged when its sample changes by less than this fraction of the noise of the step
+    # default=0.1
+    parser.add_argument("--parallel_tolerance", type=float, help="The convergence tolerance of the parallel sampler", default=0.1)
+
+    # Where the sampling of a dst frame starts from.
+    # "noise" noises the aligned dst frame with random noise (the forward diffusion) up to the first sampled step.
+    # "ddim_inversion" maps it to that step with the deterministic DDIM reverse ODE instead, which keeps its structure
+    # (pose, expression, lighting) much better, so fewer steps are needed (e.g. a lower --skip_timesteps).
+    # default=noise
+    parser.add_argument(
+        "--init_mode",
+        type=str,
+        help="How the sampling starts from the dst frame",
+        choices=["noise", "ddim_inversion"],
+        default="noise",
+    )
+
+    # Where the DDIM inversions of the dst frames are cached (with --init_mode ddim_inversion).
+    # They only depend on the frame, --timestep_respacing, --skip_timesteps and the checkpoints, so a rerun with another src face
+    # or other guidance settings reuses them
+    # default=data/dst/latents
+    parser.add_argument("--latent_cache", type=str, help="The directory of the cached DDIM inversions", default="data/dst/latents")
+
     # Timestep respacing is a technique used in diffusion models to control the density of sampling during the diffusion process. 
     # In diffusion models, the goal is to transform an input distribution to a target distribution through a series of iterative steps. 
     # Timestep respacing refers to adjusting the spacing or density of these steps to achieve specific properties or characteristics in the generated samples.
@@ -56,11 +117,56 @@ def get_arguments() -> argparse.Namespace:
         dest="enforce_background",
     )
 
+    # By default the UNet forward pass of every denoising step is shared between the guidance gradient (cond_fn)
+    # and the posterior sample, so the model runs once per step instead of twice.
+    # Add --no_share_model_output to run a separate forward pass inside cond_fn (previous behavior)
+    parser.add_argument(
+        "--no_share_model_output",
+        help="Indicator disabling the shared UNet forward pass between guidance and sampling",
+        action="store_false",
+        dest="share_model_output",
+    )
+
+    # By default the attention blocks of the UNet are recomputed in the backward pass of the exact guidance,
+    # which keeps their activations out of memory at the cost of a second attention forward pass.
+    # Add --no_attention_checkpoint to keep the activations instead (faster, more memory)
+    parser.add_argument(
+        "--no_attention_checkpoint",
+        help="Indicator disabling the recomputation of the attention blocks in the guidance backward pass",
+        action="store_false",
+        dest="attention_checkpoint",
+    )
+
+    # How the guidance gradient is computed at every denoising step.
+    # "exact" backpropagates the ID, segmentation, gaze and background losses through the UNet (pred_xstart depends on x).
+    # "detached" treats pred_xstart as a constant and differentiates the losses with respect to x_in only,
+    # which skips the UNet backward pass entirely (faster, much less memory, approximate gradient).
+    # default=exact
+    parser.add_argument(
+        "--guidance_grad",
+        type=str,
+        help="How to compute the guidance gradient",
+        choices=["exact", "detached"],
+        default="exact",
+    )
+
     # Data augmentation is a common technique used to artificially increase the diversity and size of the training dataset by applying various transformations or modifications to the existing data.
     # Increasing the number of augmentations can help improve the model's generalization ability by exposing it to a wider range of variations and reducing the risk of overfitting.
     # default=8
     parser.add_argument("--aug_num", type=int, help="The number of augmentation", default=8)
 
+    # Where the eye boxes of the gaze loss come from, they are computed once per dst frame.
+    # "fan" runs the 68 point FAN landmark detector (face_alignment) on every dst frame.
+    # "landmarks" derives them from the 5 landmarks found when the frame was aligned (no FAN model is loaded).
+    # default=fan
+    parser.add_argument(
+        "--eye_boxes",
+        type=str,
+        help="Where the eye boxes of the gaze loss come from",
+        choices=["fan", "landmarks"],
+        default="fan",
+    )
+
     # Random seed default=404
     parser.add_argument("--seed", type=int, help="The random seed", default=404)
 
@@ -81,10 +187,15 @@ def get_arguments() -> argparse.Namespace:
         default="output.png",
     )
 
-    # Increasing the number of iterations allows for more fine-grained transformations and can potentially capture more details in the generated samples.
-    # However, it also increases the computational cost and may require more memory.
-    # default=4
-    parser.add_argument("--iterations_num", type=int, help="The number of iterations", default=1)
+    # The number of candidates sampled (together, with independent noise) for every dst frame.
+    # The candidates are ranked by their ID distance to the src face and the best one is kept.
+    # More candidates give better results but multiply the batch size (and memory) of the sampling.
+    # default=1
+    parser.add_argument("--iterations_num", type=int, help="The number of candidates per dst frame", default=1)
+
+    # The number of best candidates of every frame written to the Rank folder, the best one goes to data/dst/preded
+    # default=1
+    parser.add_argument("--top_k", type=int, help="The number of best candidates written per dst frame", default=1)
 
     # Target-preserving blending is to gradually increase the mask intensity from zero to one, according to the time of the diffusion process T.
     # The masking_threshold argument sets the Target-preserving blending time.
@@ -99,6 +210,25 @@ def get_arguments() -> argparse.Namespace:
     # default=512
     parser.add_argument("--crop_size", type=int, help="The size of the aligned and cropped images", default=256)
     
+    # The number of processes cropping the src and dst images, each one loads its own face detector.
+    # 1 crops in the main process. Tracking (--track_interval) is sequential and always runs in the main process.
+    # default=1
+    parser.add_argument("--crop_processes", type=int, help="The number of cropping processes", default=1)
+
+    # The number of torch threads of every cropping process
+    # default=0 (the CPU cores are split between the processes)
+    parser.add_argument("--crop_threads", type=int, help="The number of torch threads per cropping process (0 to split the cores)", default=0)
+
+    # Video dst only: detect the faces every track_interval frames (and at scene cuts), the landmarks of the frames
+    # in between are tracked with optical flow (detection is used again when tracking is not confident enough)
+    # default=0 (detect every frame)
+    parser.add_argument("--track_interval", type=int, help="The number of frames tracked between two face detections (0 to detect every frame)", default=0)
+
+    # Detect the faces on overlapping tiles of this size of the full resolution src and dst images (and on the whole
+    # image resized to it), so that small faces in large images are found. It is not used with --track_interval
+    # default=0 (detect the whole image resized to 1024)
+    parser.add_argument("--det_tile_size", type=int, help="The size of the full resolution detection tiles (0 to detect the resized image)", default=0)
+
     parser.add_argument(
         "--merge_only",
         help="Merge only without cropping or editing",
@@ -117,5 +247,33 @@ def get_arguments() -> argparse.Namespace:
         action="store_true",
     )
 
+    # The number of processes merging the edited faces back into the video frames, the frames keep their order
+    # default=0 (one per CPU)
+    parser.add_argument("--merge_workers", type=int, help="The number of merge processes (0 for one per CPU)", default=0)
+
+    # The encoder of the result video (mp4 dst), the merged frames are piped to it as raw frames
+    # default=libx264
+    parser.add_argument("--codec", type=str, help="The ffmpeg video codec of the result video", default="libx264")
+
+    # The encoder preset, slower presets give smaller files for the same quality
+    # default=medium
+    parser.add_argument("--preset", type=str, help="The ffmpeg encoder preset of the result video", default="medium")
+
+    # The constant rate factor of the encoder, 0 is lossless (very large files) and higher values give smaller files
+    # default=18
+    parser.add_argument("--crf", type=int, help="The ffmpeg constant rate factor of the result video", default=18)
+
+    # Streaming mode for mp4 dst: the frames go from ffmpeg to the cropper, the editor, the merge and back to ffmpeg
+    # through in-memory queues, with every stage running concurrently. No frame is written to data/dst.
+    parser.add_argument(
+        "--stream",
+        help="Swap the faces of a video dst in memory, without intermediate images",
+        action="store_true",
+    )
+
+    # The number of frames waiting between two stages of the streaming mode (bounds its memory)
+    # default=16
+    parser.add_argument("--stream_queue", type=int, help="The size of the streaming mode queues", default=16)
+
     args = parser.parse_args()
     return args
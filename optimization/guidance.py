@@ -0,0 +1,164 @@
+import copy
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+from torchvision.ops import roi_align
+
+# Attributes = [0, 'background', 1 'skin', 2 'r_brow', 3 'l_brow', 4 'r_eye', 5 'l_eye', 6 'eye_g', 7 'l_ear', 8 'r_ear', 9 'ear_r', 10 'nose', 11 'mouth', 12 'u_lip', 13 'l_lip', 14 'neck', 15 'neck_l', 16 'cloth', 17 'hair', 18 'hat']
+# The face classes that are swapped (and compared by the segmentation loss)
+FACE_IDS = [1, 2, 3, 4, 5, 10, 11, 12, 13]
+
+arcface_normalize = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+parsing_normalize = transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
+
+
+def arcface_embedding(netArc, image):
+    """Normalized ArcFace identity embedding
+
+    Args:
+        image: batch of shape [batch, 3, H, W] with values in [-1, 1]
+
+    Returns:
+        embedding: of shape [batch, 512] with unit norm
+    """
+    image = arcface_normalize((image + 1) / 2)
+    image = F.interpolate(image, (112, 112))
+    return F.normalize(netArc(image), p=2, dim=1)
+
+
+def face_parsing(netSeg, spNorm, image):
+    """FaceParser (BiSeNet) logits of a batch of 256 x 256 images
+
+    The images are resized to 512 x 512 for the parser and the logits are resized back to 256 x 256.
+
+    Args:
+        image: batch of shape [batch, 3, 256, 256] with values in [-1, 1]
+
+    Returns:
+        logits: of shape [batch, 19, 256, 256]
+    """
+    image = transforms.Resize((512, 512))((image + 1) / 2)
+    image = parsing_normalize(image)
+    logits = netSeg(spNorm(image))[0]
+    return transforms.Resize((256, 256))(logits)
+
+
+def make_mask(parsing):
+    """Binary mask of the FACE_IDS classes
+
+    Args:
+        parsing: logits of shape [batch, 19, H, W]
+
+    Returns:
+        mask: float tensor of shape [batch, 1, H, W], 1 on the face classes and 0 elsewhere
+    """
+    parsing = parsing.detach().argmax(1, keepdim=True)
+    ids = torch.tensor(FACE_IDS, device=parsing.device)
+    return torch.isin(parsing, ids).float()
+
+
+def gaze_window(t, num_timesteps):
+    """Whether the gaze loss guides the samples at timesteps t
+
+    The window is written for the default 100 respaced steps (from 10 to 50, both excluded), it is scaled to
+    num_timesteps like --masking_threshold, so that it covers the same noise levels with any --timestep_respacing.
+
+    Args:
+        t: tensor of the respaced timesteps of the samples
+        num_timesteps: the number of respaced timesteps of the diffusion
+
+    Returns:
+        window: bool tensor of the shape of t
+    """
+    scale = num_timesteps / 100.0
+    return (t < 50 * scale) & (t > 10 * scale)
+
+
+class GuidanceContext:
+    """Everything the guidance needs that only depends on the src image and the dst frames
+
+    It is built once per batch of dst frames, before sampling, so cond_fn, postprocess_fn and
+    the final scoring do not run the face recognition and face parsing networks on the same
+    constant images at every denoising step.
+    """
+
+    @torch.no_grad()
+    def __init__(self, src_image, targ_image, eye_coords, netArc, netSeg, spNorm, netGaze):
+        """
+        Args:
+            src_image: the src image of shape [1, 3, 256, 256] with values in [-1, 1]
+            targ_image: the dst frames of shape [batch, 3, 256, 256] with values in [-1, 1]
+            eye_coords: for every dst frame, its eye boxes [llx, lly, lrx, lry, rlx, rly, rrx, rry]
+                (see utils/eye_crop) or Nones if no eye was found
+        """
+        self.src_image = src_image
+        self.targ_image = targ_image
+        # dst frames in [0, 1], as the gaze estimator sees them
+        self.targ_unit = (targ_image + 1) / 2
+
+        # Identity of the src face, it conditions the UNet and is the target of the ID loss
+        self.src_id = arcface_embedding(netArc, src_image)
+
+        # Parsing of the dst frames, the target of the segmentation loss
+        self.targ_seg = face_parsing(netSeg, spNorm, targ_image)
+        self.targ_face_seg = self.targ_seg[:, FACE_IDS]
+
+        # Face masks of the dst frames and what is left of the frames outside of them
+        self.mask = make_mask(self.targ_seg)
+        self.targ_background = targ_image * (1 - self.mask)
+
+        # One (frame index, x1, y1, x2, y2) box per eye, for roi_align
+        eye_boxes = []
+        for i, (llx, lly, lrx, lry, rlx, rly, rrx, rry) in enumerate(eye_coords):
+            if llx is not None:
+                eye_boxes += [[i, llx, lly, lrx, lry], [i, rlx, rly, rrx, rry]]
+            else:
+                print('no eye detected')
+        self.eye_boxes = torch.tensor(eye_boxes, dtype=torch.float, device=targ_image.device).view(-1, 5)
+
+        # Gaze of every dst eye, the target of the gaze loss
+        self.targ_gaze = None
+        if len(self.eye_boxes) > 0:
+            targ_eyes = roi_align(self.targ_unit, self.eye_boxes, (96, 160), sampling_ratio=1, aligned=True)
+            self.targ_gaze = netGaze(torch.mean(targ_eyes, dim=1))
+
+    def repeat_interleave(self, repeats):
+        """Context of a batch where every dst frame is repeated `repeats` times in a row
+
+        If the frames are [F1, F2] the samples are [F1, F1, ..., F2, F2, ...], e.g. several candidates per frame.
+        """
+        context = copy.copy(self)
+        for name in ["targ_image", "targ_unit", "targ_seg", "targ_face_seg", "mask", "targ_background"]:
+            setattr(context, name, getattr(self, name).repeat_interleave(repeats, dim=0))
+
+        # The boxes of frame i now belong to the samples i * repeats, ..., i * repeats + repeats - 1
+        eye_boxes = self.eye_boxes.repeat_interleave(repeats, dim=0)
+        eye_boxes[:, 0] = eye_boxes[:, 0] * repeats + torch.arange(repeats, device=eye_boxes.device).repeat(len(self.eye_boxes))
+        context.eye_boxes = eye_boxes
+
+        if self.targ_gaze is not None:
+            context.targ_gaze = self.targ_gaze.repeat_interleave(repeats, dim=0)
+
+        return context
+
+    def tile(self, repeats):
+        """Context of a batch where the whole batch of dst frames is repeated `repeats` times
+
+        If the frames are [F1, F2] the samples are [F1, F2, F1, F2, ...], e.g. the timesteps of a window of the
+        parallel sampler (p_sample_loop_parallel_progressive).
+        """
+        context = copy.copy(self)
+        for name in ["targ_image", "targ_unit", "targ_seg", "targ_face_seg", "mask", "targ_background"]:
+            tensor = getattr(self, name)
+            setattr(context, name, tensor.repeat(repeats, *([1] * (tensor.dim() - 1))))
+
+        # The boxes of frame i now also belong to the samples i + batch, i + 2 * batch, ...
+        batch = len(self.targ_image)
+        eye_boxes = self.eye_boxes.repeat(repeats, 1)
+        eye_boxes[:, 0] += torch.arange(repeats, device=eye_boxes.device).repeat_interleave(len(self.eye_boxes)) * batch
+        context.eye_boxes = eye_boxes
+
+        if self.targ_gaze is not None:
+            context.targ_gaze = self.targ_gaze.repeat(repeats, 1)
+
+        return context
@@ -1,10 +1,11 @@
 import os
 import cv2
 import glob
+import hashlib
+import queue
 import lpips
-import itertools
+import threading
 import numpy as np
-import face_alignment
 
 from PIL import Image
 from numpy import random
@@ -18,7 +19,8 @@ from optimization.augmentations import ImageAugmentations, StructureAugmentation
 import torch
 import torch.nn.functional as F
 from torchvision import transforms
-from torch.utils.data import DataLoader
+from torchvision.ops import roi_align
+from torchvision.io import read_image, ImageReadMode
 from torchvision.transforms import Resize
 from torch.nn.functional import mse_loss, l1_loss
 from torchvision.utils import save_image, make_grid
@@ -32,15 +34,32 @@ from models.guided_diffusion.script_util import (
     create_model_and_diffusion,
     model_and_diffusion_defaults,
 )
+from face_crop_plus.utils import load_index
+from optimization.guidance import GuidanceContext, FACE_IDS, face_parsing, arcface_normalize, arcface_embedding, gaze_window
 
 # Gaze
-from utils.eye_crop import get_eye_coords
+from utils.eye_crop import get_eye_coords, get_eye_coords_from_landmarks
 from models.gaze_estimation.gaze_estimator import Gaze_estimator
 
+# Attributes = [0, 'background', 1 'skin', 2 'r_brow', 3 'l_brow', 4 'r_eye', 5 'l_eye', 6 'eye_g', 7 'l_ear', 8 'r_ear', 9 'ear_r', 10 'nose', 11 'mouth', 12 'u_lip', 13 'l_lip', 14 'neck', 15 'neck_l', 16 'cloth', 17 'hair', 18 'hat']
+# RGB color list for marking different face areas
+color_list = [[0, 0, 0], [255, 0, 0], [0, 204, 204], [0, 0, 204], [255, 153, 51], [204, 0, 204], [0, 0, 0],
+              [204, 0, 0], [102, 51, 0], [0, 0, 0], [76, 153, 0], [102, 204, 0], [255, 255, 0], [0, 0, 153],
+              [0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0]]
+
+# coloring a parsing (class index map of shape (256, 256)) according to the color_list above, with values in [0, 1]
+def color_parsing(parsing):
+    base = np.zeros((256, 256, 3))
+    for idx, color in enumerate(color_list):
+        base[parsing == idx] = color
+    return base / 255.0
+
 # Load and resize images from given path
 class VGGDataset(torch.utils.data.Dataset):
     def __init__(self, path, img_size=256):
         super().__init__()
+        self.path = path
+        self.index = None # crop metadata, loaded on first use (see getmeta)
         self.files = glob.glob(path + '/**/*.jpg', recursive=True)
         self.files.extend(glob.glob(path + '/**/*.png', recursive=True))
         self.files.sort()
@@ -53,14 +72,79 @@ class VGGDataset(torch.utils.data.Dataset):
         x = self.transform(image)
         return x
 
+    # Decodes the image straight to a uint8 tensor of shape (3, H, W), it is resized later (see PrefetchLoader)
+    def read(self, index):
+        return read_image(self.files[index], ImageReadMode.RGB)
+
     def getfilename(self, index):
       path = Path(self.files[index])
       filename = path.name
       return filename
 
+    # The crop metadata (saved by face_crop_plus in the index of the directory), None if there is none
+    def getmeta(self, index):
+      if self.index is None:
+        self.index = load_index(self.path)
+      return self.index.get(os.path.relpath(self.files[index], self.path))
+
     def __len__(self):
         return len(self.files)
 
+# Iterates over the batches of a VGGDataset (in order), while the next batches are decoded in a background thread
+# The images are decoded to uint8 on the CPU and only converted to float and resized on the device
+class PrefetchLoader:
+    def __init__(self, dataset, batch_size, device, prefetch=2):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.prefetch = prefetch # the number of decoded batches waiting for the sampler
+
+    # Moves a list of uint8 images to the device as a float batch of shape (N, 3, img_size, img_size) with values in [0, 1]
+    def to_device(self, images):
+        size = (self.dataset.img_size, self.dataset.img_size)
+        images = [image.to(self.device, non_blocking=True).float().div(255) for image in images]
+        images = [image if image.shape[1:] == size else transforms.Resize(size, antialias=True)(image) for image in images]
+        return torch.stack(images)
+
+    def load(self, index):
+        return self.to_device([self.dataset.read(index)])
+
+    def _decode(self, batches, stop):
+        try:
+            for start in range(0, len(self.dataset), self.batch_size):
+                indices = range(start, min(start + self.batch_size, len(self.dataset)))
+                images = [self.dataset.read(index) for index in indices]
+                if self.device.type == "cuda":
+                    images = [image.pin_memory() for image in images]
+                # Wait for room in the queue (unless the consumer stopped iterating)
+                while not stop.is_set():
+                    try:
+                        batches.put(images, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            batches.put(None)
+        except Exception as e:
+            batches.put(e)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=max(self.prefetch, 1))
+        stop = threading.Event()
+        thread = threading.Thread(target=self._decode, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while (images := batches.get()) is not None:
+                if isinstance(images, Exception):
+                    raise images
+                yield self.to_device(images)
+        finally:
+            stop.set()
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
 # Main class
 class ImageEditor:
     def __init__(self, args) -> None:
@@ -103,6 +187,9 @@ class ImageEditor:
                 "resblock_updown": True,
                 "use_fp16": True, # use FP16 precision for faster computation
                 "use_scale_shift_norm": True,
+                # recompute the attention blocks in the backward pass of the guidance
+                # (less memory) instead of keeping their activations (less compute)
+                "use_attention_checkpoint": self.args.attention_checkpoint,
             }
         )
 
@@ -125,12 +212,8 @@ class ImageEditor:
         
         # Do not record operations on tensor
         # Set the module in evaluation mode on selected device
-        self.model.requires_grad_(False).eval().to(self.device)
-
-        
-        for name, param in self.model.named_parameters():
-            if "qkv" in name or "norm" in name or "proj" in name:
-                param.requires_grad_()
+        # Guidance only needs gradients w.r.t. the image, never w.r.t. the weights
+        self.model.freeze().to(self.device)
 
         # Use FP16 precision for faster computation
         # Converts all floating point tensors in the model to 16-bit precision
@@ -151,6 +234,12 @@ class ImageEditor:
         netArc = netArc_checkpoint['model'].module
         self.netArc = netArc.to(self.device).eval()
 
+        # Fingerprint (size and modification time) of the UNet and ArcFace checkpoints, the DDIM inversions depend on both
+        # (the ArcFace embedding of a dst frame conditions its inversion), it is part of the key of the cached inversions
+        self.checkpoint_fingerprint = "_".join(
+            f"{os.stat(path).st_size}-{os.stat(path).st_mtime_ns}" for path in ["checkpoints/Model.pt", "./checkpoints/Arcface.tar"]
+        )
+
         # Load and evaluate the FaceParser, the face parser model
         self.spNorm = SpecificNorm()
         self.netSeg = BiSeNet(n_classes=19).to(self.device)
@@ -160,8 +249,20 @@ class ImageEditor:
         # Load the gaze estimator model
         self.netGaze = Gaze_estimator().to(self.device)
 
-        # Detect facial landmarks
-        self.fa = face_alignment.FaceAlignment(face_alignment.LandmarksType.TWO_D, flip_input=False)
+        # Detect facial landmarks (for the eye boxes of the gaze loss)
+        # Not needed with --eye_boxes landmarks, the eye boxes then come from the crop landmarks
+        self.fa = None
+        if self.args.eye_boxes == "fan":
+            # Lazy import so that we don't depend on face_alignment without FAN
+            import face_alignment
+            self.fa = face_alignment.FaceAlignment(face_alignment.LandmarksType.TWO_D, flip_input=False)
+
+        # Where the (unmerged) swapped faces are written, merge_faces reads them from here
+        self.preded_path = "./data/dst/preded/"
+
+        # Where the DDIM inversions of the dst frames are cached (--init_mode ddim_inversion)
+        if self.args.init_mode == "ddim_inversion":
+            os.makedirs(self.args.latent_cache, exist_ok=True)
 
         print('done')
         
@@ -170,64 +271,56 @@ class ImageEditor:
         unscaled_timestep = (t * (self.diffusion.num_timesteps / 1000)).long()
         return unscaled_timestep
 
-    # takes two images src and targ, processes them through netarc (face recognition) to obtain their identity representations,
-    # and computes the identity loss by measuring the cosine similarity between these representations
-    def id_distance(self, src, targ):
-        # Convert the src image to a PyTorch tensor
-        # and Add an extra dimension to the tensor using unsqueeze(0) to represent the batch dimension.
-        src = TF.to_tensor(src).unsqueeze(0).to(self.device) 
+    # takes a batch of images src, processes it through netarc (face recognition) to obtain their identity representations,
+    # and computes the identity loss of every image by measuring the cosine similarity with the identity representation targ_id
+    # (the src identity cached in the guidance context)
+    @torch.no_grad()
+    def id_distance(self, src, targ_id):
+        # The images are a tensor of shape (N, 3, H, W) with values in [0, 1]
         # Normalize the tensor using the mean and standard deviation values provided in the list
-        src = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])(src)
+        src = arcface_normalize(src)
         # Resize the tensor to a size of (112, 112)
         src = F.interpolate(src, (112, 112))
         # Passe the normalized and resized tensor through netarc (face recognition) to obtain the identity representation src_id
         src_id = self.netArc(src)
         
-        # Perform the same operations above on the targ image to obtain the identity representation targ_id
-        targ = TF.to_tensor(targ).unsqueeze(0).to(self.device)
-        targ = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])(targ)
-        targ = F.interpolate(targ, (112, 112))
-        targ_id = self.netArc(targ)
-        
         # Calculate the cosine similarity metric between src_id and targ_id using the cosin_metric function.
         # The 1 - cosin_metric is used as the identity loss
         id_loss = 1 - cosin_metric(src_id, targ_id)
 
-        # orints the value of the identity loss
-        print('ID loss: {}'.format(id_loss.item()))
-        return id_loss.item()
-
-
-    # this function takes an input mask, selects specific classes from the mask based on their IDs (skin, nose, mouth...), 
-    # and creates a binary mask where the selected classes are represented by 1 and the rest are represented by 0. 
-    # The resulting modified mask is then returned
-    def makeMask(self, origin_mask):
-        numpy = origin_mask.squeeze(0).detach().cpu().numpy().argmax(0)
-        numpy = numpy.copy().astype(np.uint8)
+        return id_loss
 
-        # atts = [1 'skin', 2 'l_brow', 3 'r_brow', 4 'l_eye', 5 'r_eye', 6 'eye_g', 7 'l_ear', 8 'r_ear', 9 'ear_r', 10 'nose', 11 'mouth', 12 'u_lip', 13 'l_lip', 14 'neck', 15 'neck_l', 16 'cloth', 17 'hair', 18 'hat']
-        ids = [1, 2, 3, 4, 5, 10, 11, 12, 13]
 
-        mask     = np.zeros([256, 256])
-        for id in ids:
-            index = np.where(numpy == id)
-            mask[index] = 1
+    # Returns the eye boxes [llx, lly, lrx, lry, rlx, rly, rrx, rry] of every dst frame of the batch (Nones if no eye was found)
+    # They are computed once per frame, the gaze loss reuses them at every denoising step
+    # targ_image has values in [-1, 1], landmarks are the aligned landmarks of every frame (None if unknown)
+    def eye_coords(self, targ_image, landmarks):
+        eye_coords = []
+        for b, frame_landmarks in enumerate(landmarks):
+            if self.fa is not None:
+                # Run FAN (68 landmarks) on the dst frame
+                eye_coords.append(get_eye_coords(self.fa, targ_image[b] * 0.5 + 0.5))
+            elif frame_landmarks is None:
+                eye_coords.append([None] * 8)
+            else:
+                # Use the 5 landmarks found by face_crop_plus when the frame was aligned
+                eye_coords.append(get_eye_coords_from_landmarks(frame_landmarks, targ_image.shape[-1]))
 
-        return np.expand_dims(mask, axis=0)
+        return eye_coords
 
 
-    # This function computes the identity loss between masked input images and corresponding target images using an embedding network. 
-    # The loss is calculated based on the distances between the embeddings of the masked input images and the target images
-    def id_loss(self, x_in, targ, embedder):
+    # This function computes the identity loss between masked input images and the target identity using an embedding network. 
+    # The loss is calculated based on the distances between the embeddings of the masked input images and the target embedding
+    # (the src identity, computed once per batch in the guidance context) and the face masks of the batch
+    def id_loss(self, x_in, targ_id, embedder, mask):
 
         id_loss = torch.tensor(0) # initial id_loss tensor
 
-        masked_input = x_in * self.mask # preserve only the masked regions
+        masked_input = x_in * mask # preserve only the masked regions
         # masked_input = x_in
 
         # resizing to 112
         masked_input = F.interpolate(masked_input, (112, 112))
-        targ         = F.interpolate(targ, (112, 112))
 
         # TODO
         masked_input = self.image_augmentations(masked_input)
@@ -235,356 +328,424 @@ class ImageEditor:
         src_id  = embedder(masked_input)
         src_id = F.normalize(src_id, p=2, dim=1)
 
-        targ_id = embedder(targ)
-        targ_id = F.normalize(targ_id, p=2, dim=1)
-
         # The cosine similarity between the normalized embeddings is calculated using cosin_metric (cosine similarity function)
         # and subtracted from 1 to obtain the distances between the embeddings
         dists   = 1 - cosin_metric(src_id, targ_id)
 
         # For each image in the batch, the average distance between its embedding and the corresponding target embedding is computed. 
         # The average distances are then summed together.
-        for i in range(self.args.batch_size):
-            id_loss = id_loss + dists[i:: self.args.batch_size].mean()
+        # The augmented batch is laid out as [I1..IN, I1_aug1..IN_aug1, ...], so column i holds every copy of image i
+        id_loss = id_loss + dists.view(-1, x_in.shape[0]).mean(0).sum()
 
         # The resulting id_loss tensor represents the cumulative identity loss across the batch
         return id_loss
 
 
-    def edit_image_by_prompt(self):
-        def cond_fn(x, t, img_id, y=None):
-            with torch.enable_grad():
-                x = x.detach().requires_grad_()
+    # The guidance of every denoising step: the gradient of the ID, segmentation, gaze and background losses
+    # With --guidance_grad detached, pred_xstart is treated as a constant and the guidance losses
+    # are differentiated with respect to x_in only, so no backward pass goes through the UNet
+    def cond_fn(self, x, t, img_id, y=None, p_mean_var=None):
+        detached_guidance = self.args.guidance_grad == "detached"
+
+        with torch.enable_grad():
+            t = self.unscale_timestep(t)
 
-                t = self.unscale_timestep(t)
+            if p_mean_var is None:
+                x = x.detach().requires_grad_(not detached_guidance)
 
                 # Compute mean and variance using the diffusion model
-                out = self.diffusion.p_mean_variance(
-                    self.model, x, t, img_id, clip_denoised=False, model_kwargs={"y": y}
-                )
+                with torch.set_grad_enabled(not detached_guidance):
+                    out = self.diffusion.p_mean_variance(
+                        self.model, x, t, img_id, clip_denoised=False, model_kwargs={"y": y}
+                    )
+            else:
+                # The sampler already ran the model on x (--share_model_output)
+                out = p_mean_var
+
+            # Every sample of the batch has its own timestep
+            fac = self.diffusion._extract("sqrt_one_minus_alphas_cumprod", t, x.shape)
+
+            # Interpolate between the predicted starting point and input x
+            if detached_guidance:
+                x_in = (out["pred_xstart"].detach() * fac + x.detach() * (1 - fac)).requires_grad_()
+                grad_target = x_in
+            else:
+                x_in = out["pred_xstart"] * fac + x * (1 - fac)
+                grad_target = x
+
+            loss = torch.tensor(0)
+            # Everything that only depends on the src image and the dst frames was computed before sampling
+            # The parallel sampler (--parallel) guides a window of timesteps of the whole batch at once
+            context = self.context
+            repeats = x.shape[0] // len(context.targ_image)
+            if repeats > 1:
+                if repeats not in self.window_contexts:
+                    self.window_contexts[repeats] = context.tile(repeats)
+                context = self.window_contexts[repeats]
+
+            # ID loss
+            arc_src   = (x_in + 1) / 2
+            arc_src   = arcface_normalize(arc_src)
+            id_loss   = self.id_loss(arc_src, context.src_id, self.netArc, context.mask) * self.args.loss_weight
+
+            loss = loss + id_loss
+            self.metrics_accumulator.update_metric("id_loss", id_loss.item())
+
+            # Segmentation loss
+            src_seg = face_parsing(self.netSeg, self.spNorm, x_in)
+
+            # l1 loss of every face class (guidance.FACE_IDS), averaged over the pixels and summed over the classes of each sample
+            src_seg  = src_seg[:, FACE_IDS]
+            seg_loss = l1_loss(src_seg, context.targ_face_seg, reduction="none").mean((2, 3)).sum(1)
+            # seg_loss = mse_loss(src_seg, context.targ_face_seg, reduction="none").mean((2, 3)).sum(1)
+
+            loss = loss + seg_loss.sum() * 200
+            self.metrics_accumulator.update_metric("seg_loss", seg_loss.mean().item())
+
+            # Gaze loss, only for the samples whose timestep is in the gaze window (scaled to the respaced steps)
+            # The eye boxes and the gaze of the dst frames were computed before sampling
+            gaze_eyes = gaze_window(t, self.diffusion.num_timesteps)[context.eye_boxes[:, 0].long()]
+            if gaze_eyes.any():
+                src_eye = x_in * 0.5 + 0.5
+
+                # Crop every eye of the batch straight to the gaze estimator input size (96 x 160)
+                eye_boxes = context.eye_boxes[gaze_eyes].to(x_in.dtype)
+                src_eyes  = roi_align(src_eye, eye_boxes, (96, 160), sampling_ratio=1, aligned=True)
+                src_gaze  = self.netGaze(torch.mean(src_eyes, dim=1))
+                # l1 loss of every eye, the left and right eye losses of a sample are summed
+                gaze_loss = l1_loss(context.targ_gaze[gaze_eyes], src_gaze, reduction="none").mean(1) * 200
+
+                loss = loss + gaze_loss.sum()
+                self.metrics_accumulator.update_metric("gaze_loss", gaze_loss.sum().item() / (len(eye_boxes) // 2))
+
+            # Background loss, the mean squared error of each sample summed over the batch
+            masked_background = x_in
+            l2_loss = (masked_background - context.targ_image).square().mean((1, 2, 3))
+            bg_loss = (masked_background - context.targ_background).square().mean((1, 2, 3))
+
+            loss = (loss + l2_loss.sum() * 50)
+            self.metrics_accumulator.update_metric("l2_loss", l2_loss.mean().item())
+            self.metrics_accumulator.update_metric("bg_loss", bg_loss.mean().item())
+            # ------------------------------------------------------------------------------------------------------------------------ #
+
+            return -torch.autograd.grad(loss, grad_target)[0]
+
+    @torch.no_grad() # function should be executed in a no-gradient mode
+    # This function adjusts the output by incorporating the mask and background stage
+    def postprocess_fn(self, out, t):
+
+        if self.context.mask is not None:
+            # Every sample is blended with its own (noised) target frame
+            # The parallel sampler runs every step several times, its noise is the same every time
+            noise = None
+            if self.background_seed is not None:
+                generator = torch.Generator(self.device).manual_seed(self.background_seed + int(t[0]))
+                noise = torch.randn(self.context.targ_image.shape, generator=generator, device=self.device)
+            background_stage_t = self.diffusion.q_sample(self.context.targ_image, t, noise=noise)
+
+            # steps is the number of sampling steps (75 with the default 100 respaced steps and 25 skipped ones),
+            # so the ramp starts from 0 at the first sampled step when more steps than the threshold are sampled
+            # (it used to be a hard-coded 75, which gave a negative mask with fewer skipped steps and skipped the start
+            # of the ramp with more)
+            # --masking_threshold is a step of the default 100 respaced steps, it is scaled to the actual number of steps
+            # (e.g. 30 becomes 7.5 with --timestep_respacing 25), so that the blending happens at the same noise levels
+            steps = self.diffusion.num_timesteps - self.args.skip_timesteps
+            threshold = self.args.masking_threshold * self.diffusion.num_timesteps / 100.0
+
+            # The softmask tensor is calculated by multiplying the context mask with a scaling factor (steps-(t.data+1))/(steps-threshold),
+            # clamped to [0, 1]. This scaling factor gradually increases the influence of the mask over time.
+            # When the threshold is at or above the first sampled step (steps <= threshold, e.g. --skip_timesteps 70 or more
+            # with 100 respaced steps), there is no ramp and the mask is full from the start, like the hard-coded 75 gave
+            if steps > threshold:
+                scale = ((steps - (t.data + 1)) / (steps - threshold)).clamp(0, 1)
+            else:
+                scale = torch.ones_like(t, dtype=torch.float)
+            softmask = self.context.mask * scale.view(-1, 1, 1, 1)
+            blended = out["sample"] * softmask + background_stage_t * (1 - softmask)
+
+            if self.args.enforce_background:
+                out["sample"] = blended
+            else:
+                masked = (t > threshold).view(-1, 1, 1, 1)
+                out["sample"] = torch.where(masked, blended, out["sample"])
+
+        return out
+
+    # DDIM inversion of a batch of dst frames (--init_mode ddim_inversion), targ_image is a tensor of shape (N, 3, 256, 256) with values in [-1, 1]
+    # Returns the noisy image of every frame at the first sampled step (N, 3, 256, 256), the sampling starts from it.
+    # The frames are inverted with their own identity, so a latent does not depend on the src face: it is cached in --latent_cache,
+    # keyed by the frame pixels, the schedule, the model image size and the checkpoints, and only the frames without a cached latent
+    # are inverted
+    @torch.no_grad()
+    def invert_faces(self, targ_image):
+        settings = [self.checkpoint_fingerprint, self.model_config["image_size"], self.args.timestep_respacing, self.args.skip_timesteps]
+        settings = "_".join(str(setting) for setting in settings).encode()
+        pixels = targ_image.add(1).mul(127.5).round().byte().cpu().numpy()
+        paths = [os.path.join(self.args.latent_cache, hashlib.sha1(frame.tobytes() + settings).hexdigest() + ".pt") for frame in pixels]
+
+        latents = [None] * len(paths)
+        missing = [i for i, path in enumerate(paths) if not os.path.exists(path)]
+        if missing:
+            frames = targ_image[missing]
+            inverted = self.diffusion.ddim_reverse_sample_loop(
+                self.model,
+                frames,
+                arcface_embedding(self.netArc, frames),
+                skip_timesteps=self.args.skip_timesteps,
+                clip_denoised=False,
+                model_kwargs={},
+                progress=True,
+            )
+            for i, latent in zip(missing, inverted):
+                torch.save(latent.cpu(), paths[i])
+                latents[i] = latent
+
+        for i, path in enumerate(paths):
+            if latents[i] is None:
+                latents[i] = torch.load(path, map_location=self.device)
+        return torch.stack(latents)
+
+    # Swaps the source face into a batch of dst faces, iterations_num candidates per dst face.
+    # src_image is a tensor of shape (1, 3, 256, 256) and targ_image of shape (N, 3, 256, 256), both with values in [-1, 1],
+    # eye_coords are the eye boxes of every dst face (see eye_coords)
+    # Returns every candidate (N * iterations_num, 3, 256, 256) with values in [0, 1] (the candidates of a face are next to each other),
+    # their ID distances (N, iterations_num) and the colored parsing of every candidate
+    def swap_faces(self, src_image, targ_image, eye_coords):
+        # save current src and targ to self
+        self.src_image  = src_image
+        self.targ_image = targ_image
+        batch_size = targ_image.shape[0]
+
+        # Everything the guidance needs from the src image and the dst frames is computed once, here: the src identity,
+        # the FaceParser logits of the dst frames, their binary face masks, eye boxes and gaze (optimization/guidance)
+        self.context = GuidanceContext(
+            self.src_image,
+            self.targ_image,
+            eye_coords,
+            self.netArc,
+            self.netSeg,
+            self.spNorm,
+            self.netGaze,
+        )
 
-                fac = self.diffusion.sqrt_one_minus_alphas_cumprod[t[0].item()]
+        # Number of candidates sampled for every dst frame is defined in iterations_num parameter, default is 1
+        # All the candidates are sampled together (with independent noise)
+        candidates = self.args.iterations_num
+        # The candidates of a frame are next to each other in the batch: [frame 0 candidate 0, frame 0 candidate 1, ..., frame 1 candidate 0, ...]
+        self.context = self.context.repeat_interleave(candidates)
+        sample_count = batch_size * candidates
+        # The contexts of the windows of the parallel sampler, see cond_fn
+        self.window_contexts = {}
+
+        # If --ddim argument is provided the sampling function is a DDIM, it is a DDM otherwise (default)
+        # DDIM takes the amount of noise of every step (--ddim_eta, 0 is deterministic)
+        # --dpm_solver (DPM-Solver++ of order --solver_order) takes precedence over both
+        # --parallel runs the DDPM steps in windows of --parallel_window steps, refined until --parallel_tolerance
+        sample_func = self.diffusion.p_sample_loop_progressive
+        sample_kwargs = {}
+        self.background_seed = None
+        if self.args.dpm_solver:
+            sample_func = self.diffusion.dpm_solver_sample_loop_progressive
+            sample_kwargs["order"] = self.args.solver_order
+        elif self.args.ddim:
+            sample_func = self.diffusion.ddim_sample_loop_progressive
+            sample_kwargs["eta"] = self.args.ddim_eta
+        elif self.args.parallel:
+            sample_func = self.diffusion.p_sample_loop_parallel_progressive
+            sample_kwargs["window"] = self.args.parallel_window
+            sample_kwargs["tolerance"] = self.args.parallel_tolerance
+            self.background_seed = int(torch.randint(2 ** 31, ()))
+
+        # With --init_mode ddim_inversion the sampling starts from the (cached) DDIM inversion of every dst frame
+        # instead of the randomly noised frame, the candidates of a frame share it
+        if self.args.init_mode == "ddim_inversion":
+            sample_kwargs["init_latent"] = self.invert_faces(targ_image).repeat_interleave(candidates, dim=0)
+
+        # the same src identity conditions every sample of the batch
+        img_id = self.context.src_id.expand(sample_count, -1)
+
+        # Generating samples, iterations_num per dst frame of the batch
+        samples = sample_func(
+            self.model,
+            (
+                sample_count,
+                3,
+                self.model_config["image_size"],
+                self.model_config["image_size"],
+            ),
+            clip_denoised=False,
+            model_kwargs={},
+            cond_fn=self.cond_fn,
+            progress=True,
+            skip_timesteps=self.args.skip_timesteps,
+            init_image=self.context.targ_image,
+            postprocess_fn=self.postprocess_fn,
+            randomize_class=True,
+            img_id = img_id,
+            share_model_output=self.args.share_model_output,
+            detach_shared_output=self.args.guidance_grad == "detached",
+            **sample_kwargs,
+        )
 
-                # Interpolate between the predicted starting point and input x
-                x_in = out["pred_xstart"] * fac + x * (1 - fac)
+        # Only the final step is kept
+        for sample in samples:
+            pass
+
+        self.metrics_accumulator.print_average_metric() # Prints the average metric
+        pred_images = sample["pred_xstart"] # Retrieves the predicted images from the sample dictionary
+
+        with torch.no_grad():
+            # Pass the (clamped) predicted images through FaceParser (netseg), see optimization/guidance
+            pred_src_mask = face_parsing(self.netSeg, self.spNorm, pred_images.clamp(-1, 1))
+            # Colors the parsing of every candidate
+            src_bases = [color_parsing(parsing) for parsing in pred_src_mask.cpu().numpy().argmax(1)]
 
-                loss = torch.tensor(0)
-
-                # ID loss
-                targ = self.src_image
-                arc_src   = (x_in + 1) / 2
-                arc_src   = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])(arc_src)
-                arc_targ  = (targ + 1) / 2
-                arc_targ  = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])(arc_targ)
-                id_loss   = self.id_loss(arc_src, arc_targ, self.netArc) * self.args.loss_weight
-
-                loss = loss + id_loss
-                self.metrics_accumulator.update_metric("id_loss", id_loss.item())
-
-                # Segmentation loss
-                src_mask  = (x_in + 1) / 2
-                src_mask  = transforms.Resize((512,512))(src_mask)
-                src_mask  = transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))(src_mask)
-                targ_mask = (self.targ_image + 1) / 2
-                targ_mask  = transforms.Resize((512,512))(targ_mask)
-                targ_mask = transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))(targ_mask)
-
-                src_seg  = self.netSeg(self.spNorm(src_mask))[0]
-                src_seg = transforms.Resize((256, 256))(src_seg)
-                targ_seg = self.netSeg(self.spNorm(targ_mask))[0]
-                targ_seg = transforms.Resize((256, 256))(targ_seg)
-
-                seg_loss = torch.tensor(0).to(self.device).float()
-
-                # Attributes = [0, 'background', 1 'skin', 2 'r_brow', 3 'l_brow', 4 'r_eye', 5 'l_eye', 6 'eye_g', 7 'l_ear', 8 'r_ear', 9 'ear_r', 10 'nose', 11 'mouth', 12 'u_lip', 13 'l_lip', 14 'neck', 15 'neck_l', 16 'cloth', 17 'hair', 18 'hat']
-                ids = [1, 2, 3, 4, 5, 10, 11, 12, 13]
-
-                for id in ids:
-                    seg_loss += l1_loss(src_seg[0,id,:,:], targ_seg[0,id,:,:])
-                    # seg_loss += mse_loss(src_seg[0,id,:,:], targ_seg[0,id,:,:])
-
-                loss = loss + seg_loss * 200
-                self.metrics_accumulator.update_metric("seg_loss", seg_loss.item())
-
-                # Gaze loss
-                if t < 50 and t > 10:
-                    src_eye = x_in * 0.5 + 0.5
-                    targ_eye = self.targ_image
-                    targ_eye = targ_eye * 0.5 + 0.5
-                    llx, lly, lrx, lry, rlx, rly, rrx, rry = get_eye_coords(self.fa, targ_eye)
-
-                    if llx is not None:
-                        targ_left_eye   = targ_eye[:, :, lly:lry, llx:lrx]
-                        src_left_eye    = src_eye[:, :, lly:lry, llx:lrx]
-                        targ_right_eye  = targ_eye[:, :, rly:rry, rlx:rrx]
-                        src_right_eye   = src_eye[:, :, rly:rry, rlx:rrx]
-                        targ_left_eye   = torch.mean(targ_left_eye, dim=1, keepdim=True)
-                        src_left_eye    = torch.mean(src_left_eye, dim=1, keepdim=True)
-                        targ_right_eye  = torch.mean(targ_right_eye, dim=1, keepdim=True)
-                        src_right_eye   = torch.mean(src_right_eye, dim=1, keepdim=True)
-                        targ_left_gaze  = self.netGaze(targ_left_eye.squeeze(0))
-                        src_left_gaze   = self.netGaze(src_left_eye.squeeze(0))
-                        targ_right_gaze = self.netGaze(targ_right_eye.squeeze(0))
-                        src_right_gaze  = self.netGaze(src_right_eye.squeeze(0))
-                        left_gaze_loss  = l1_loss(targ_left_gaze, src_left_gaze)
-                        right_gaze_loss = l1_loss(targ_right_gaze, src_right_gaze)
-                        gaze_loss = (left_gaze_loss + right_gaze_loss) * 200
-
-                        loss = loss + gaze_loss.sum()
-                        self.metrics_accumulator.update_metric("gaze_loss", gaze_loss.item())
-                    else:
-                        print('no eye detected')
-
-                # Background loss
-                masked_background = x_in
-
-                loss = (loss + mse_loss(masked_background, self.targ_image) * 50)
-                self.metrics_accumulator.update_metric("l2_loss", mse_loss(masked_background, self.targ_image).item())
-                self.metrics_accumulator.update_metric("bg_loss", mse_loss(masked_background, self.targ_image * (1 - self.mask)).item())
-                # ------------------------------------------------------------------------------------------------------------------------ #
-
-                return -torch.autograd.grad(loss, x)[0]
-
-        @torch.no_grad() # function should be executed in a no-gradient mode
-        # This function adjusts the output by incorporating the mask and background stage
-        def postprocess_fn(out, t):
-
-            if self.mask is not None:
-                background_stage_t = self.diffusion.q_sample(self.targ_image, t[0])
-                background_stage_t = torch.tile(
-                    background_stage_t, dims=(self.args.batch_size, 1, 1, 1)
-                )
-
-                # The softmask tensor is calculated by multiplying self.mask with a scaling factor (min(1, (75-(t.data+1))/(75.0-self.args.masking_threshold))).
-                # This scaling factor gradually reduce the influence of the mask over time, 
-                # with the value (75-(t.data+1)) being divided by (75.0-self.args.masking_threshold) and then clamped to a maximum value of 1.
-                softmask = self.mask * (min(1, (75-(t.data+1))/(75.0-self.args.masking_threshold)))
+            # Converts the source bases to a torch tensor of shape (sample_count, 1, 256, 256)
+            _src_base = torch.from_numpy(np.stack(src_bases)[:, :, :, 0]).to(self.device).float()
+            _src_base = _src_base.unsqueeze(1)
 
+            if self.context.mask is not None:
                 if self.args.enforce_background:
-                    out["sample"] = out["sample"] * softmask + background_stage_t * (1 - softmask)
+                    # Applies the target base as a mask to the predicted images (keep the target background)
+                    pred_images = (self.context.targ_image * (1 - self.context.mask) + pred_images * self.context.mask)
                 else:
-                    if t > self.args.masking_threshold:
-                        out["sample"] = out["sample"] * softmask + background_stage_t * (1 - softmask)
+                    # Applies the source base as a mask to the predicted images (keep the source background)
+                    pred_images = (self.context.targ_image * (1 - _src_base) + pred_images * _src_base)
 
-            return out
+            # Adjusts the pixel values of the predicted images
+            pred_images = pred_images.add(1).div(2).clamp(0, 1)
 
+            # Compute the ID distance (ID loss) between every predicted image and the source image, in one batch
+            distances = self.id_distance(pred_images, self.context.src_id).view(batch_size, candidates)
+
+        return pred_images, distances, src_bases
+
+    # In-memory version of edit_image_by_prompt, used by the streaming pipeline (optimization/stream)
+    # src_face is the aligned src face and faces the aligned dst faces, uint8 arrays of shape (H, W, 3) and (N, H, W, 3)
+    # landmarks are the aligned landmarks of every dst face (in [0, 1], only used with --eye_boxes landmarks)
+    # Returns the best swapped face of every dst face, a uint8 array of shape (N, H, W, 3)
+    def edit_faces(self, src_face, faces, landmarks=None):
+        size = (self.model_config["image_size"], self.model_config["image_size"])
+
+        def to_tensor(images):
+            images = torch.from_numpy(np.ascontiguousarray(images)).to(self.device)
+            images = images.permute(0, 3, 1, 2).float().div(255)
+            return transforms.Resize(size, antialias=True)(images) * 2.0 - 1.0
+
+        src_image  = to_tensor(src_face[None])
+        targ_image = to_tensor(faces)
+        if landmarks is None:
+            landmarks = [None] * len(faces)
+
+        pred_images, distances, _ = self.swap_faces(src_image, targ_image, self.eye_coords(targ_image, landmarks))
+
+        # The best candidate of every face, back to the size of the faces
+        best = distances.argmin(dim=1) + torch.arange(len(faces), device=self.device) * distances.shape[1]
+        best = transforms.Resize(faces.shape[1:3], antialias=True)(pred_images[best])
+        return best.mul(255).round().byte().permute(0, 2, 3, 1).cpu().numpy()
+
+    # Swaps the source face into every aligned dst frame.
+    # Returns the final ID distance of every generated sample, in generation order
+    def edit_image_by_prompt(self):
         # load source images and resize to 256, remember our model was trained on 256 images
         src_dataset  = VGGDataset(path='./data/src/aligned',  img_size=256)
         # load destination images and resize to 256, remember our model was trained on 256 images
         targ_dataset = VGGDataset(path='./data/dst/aligned', img_size=256)
-        # Use the Python iterable over the dataset
-        src_loader   = DataLoader(src_dataset,  num_workers=4, shuffle=False, batch_size=1)
-        targ_loader  = DataLoader(targ_dataset, num_workers=4, shuffle=False, batch_size=1)
-        # iterators for src and target
-        src_iter     = iter(src_loader)
-        targ_iter    = iter(targ_loader)
-
-        # Attributes = [0, 'background', 1 'skin', 2 'r_brow', 3 'l_brow', 4 'r_eye', 5 'l_eye', 6 'eye_g', 7 'l_ear', 8 'r_ear', 9 'ear_r', 10 'nose', 11 'mouth', 12 'u_lip', 13 'l_lip', 14 'neck', 15 'neck_l', 16 'cloth', 17 'hair', 18 'hat']
-        # RGB color list for marking different face areas
-        color_list = [[0, 0, 0], [255, 0, 0], [0, 204, 204], [0, 0, 204], [255, 153, 51], [204, 0, 204], [0, 0, 0],
-                      [204, 0, 0], [102, 51, 0], [0, 0, 0], [76, 153, 0], [102, 204, 0], [255, 255, 0], [0, 0, 153],
-                      [0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0], [0, 0, 0]]
+        # dst frames are sampled batch_size at a time (the last batch can be smaller),
+        # the next --prefetch batches are decoded in the background while the current one is sampled
+        targ_loader  = PrefetchLoader(targ_dataset, self.args.batch_size, self.device, prefetch=self.args.prefetch)
 
         length = len(targ_loader)
-        print('Number of dst Data: ', length)
+        print('Number of dst Data: ', len(targ_dataset))
         path = self.args.output_path
-
-        # We will be iterating over each src and targ image for processing
-        for step in range(length):
-            # save current iteration of src and targ to self
-            try:
-                self.src_image = next(itertools.islice(src_loader, 0, None)).to(self.device).float() # only one src image
-                # self.src_image = next(src_iter).to(self.device).float()
-                self.targ_image = next(targ_iter).to(self.device).float()
-            except StopIteration:
-                src_iter        = iter(src_loader)
-                targ_iter       = iter(targ_loader)
-                #self.src_image  = next(src_iter).to(self.device).float()
-                self.src_image = next(itertools.islice(src_loader, 0, None)).to(self.device).float() # only one src image
-                self.targ_image = next(targ_iter).to(self.device).float()
-
-            # Clone the target image for making the mask
-            targ_mask = self.targ_image.detach().clone()
-            # we resize the mask to 512x512 for manipulation
-            targ_mask = transforms.Resize((512,512))(targ_mask)
-            # Normalize target mask with mean and standard deviation
-            targ_mask = transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))(targ_mask)
-            # Pass the mask through FaceParser (netseg) after applying SpecificNorm (mean and standard deviation) to the mask (from utils/module.py)
-            targ_mask = self.netSeg(self.spNorm(targ_mask))[0]
-            # Resize the mask back to 256 (original size)
-            targ_mask = transforms.Resize((256,256))(targ_mask)
-
-            # coloring the mask according to the specifiec color_list above
-            parsing   = targ_mask.squeeze(0).detach().cpu().numpy().argmax(0)
-            targ_base = np.zeros((256, 256, 3))
-            for idx, color in enumerate(color_list):
-                targ_base[parsing == idx] = color
-            targ_base /= 255.0
-
-            # making the binary mask
-            mask  = self.makeMask(targ_mask)
-
-            # convert the array mask to a PyTorch tensor, adds a batch dimension and converts the data type to float
-            self.mask = torch.from_numpy(mask).unsqueeze(0).to(self.device).float()
-            # enable gradient tracking for the tensor
-            self.mask.requires_grad_()
-
-            # TODO document
-            self.src_image  = self.src_image  * 2.0 - 1.0
-            self.targ_image = self.targ_image * 2.0 - 1.0
-
-            # making output rank and step directories
-            self.args.output_path = path + '/' + str(step)
-            os.makedirs(self.args.output_path, exist_ok=True)
-            self.RankPath = path + '/Rank'+ str(step) + '/'
-            os.makedirs(self.RankPath, exist_ok=True)
-
-            # num_timesteps is the number of diffusion steps in the original process to divide up.
-            save_image_interval = self.diffusion.num_timesteps // 5
-            # Number of applied iteration is defined in iterations_num parameter, default is 4
-            for iteration_number in range(self.args.iterations_num):    # self.args.iterations_num: 8
-                print(f"Start iterations {iteration_number}")
-
-                # If --ddim argument is provided the sampling function is a DDIM, it is a DDM otherwise (default)
-                sample_func = (
-                    self.diffusion.ddim_sample_loop_progressive
-                    if self.args.ddim
-                    else self.diffusion.p_sample_loop_progressive
-                )
-
-                # normalize src image with mean and standard deviation
-                img  = (self.src_image + 1) / 2
-                img  = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])(img)
-                # Down/up sampling the input
-                img_id = F.interpolate(img, (112, 112))
-                # apply netarc (face recognition) to src image
-                img_id = self.netArc(img_id)
-                img_id = F.normalize(img_id, p=2, dim=1)
-
-                # Generating samples
-                samples = sample_func(
-                    self.model,
-                    (
-                        self.args.batch_size,
-                        3,
-                        self.model_config["image_size"],
-                        self.model_config["image_size"],
-                    ),
-                    clip_denoised=False,
-                    model_kwargs={},
-                    cond_fn=cond_fn,
-                    progress=True,
-                    skip_timesteps=self.args.skip_timesteps,
-                    init_image=self.targ_image,
-                    postprocess_fn=postprocess_fn,
-                    randomize_class=True,
-                    img_id = img_id
-                )
-                intermediate_samples = [[] for i in range(self.args.batch_size)]
-                total_steps = self.diffusion.num_timesteps - self.args.skip_timesteps - 1
-                
-                for j, sample in enumerate(samples):
-                    # save image on save_image_interval or when finishing save_image_interval
-                    # should_save_image = j % save_image_interval == 0 or j == total_steps
-
-                    # save image only on when finishing steps
-                    should_save_image = j == total_steps
-                    
-                    if should_save_image:
-                        self.metrics_accumulator.print_average_metric() # Prints the average metric
-                        pred_image = sample["pred_xstart"][0] # Retrieves the predicted image from the sample dictionary
-                        # Creates a file path for visualization (the file containing the visualisation progress)
-                        visualization_path = Path(os.path.join(self.args.output_path, self.args.output_file))
-                        # Modifies the stem of the visualization file path
-                        visualization_path = visualization_path.with_stem(f"{visualization_path.stem}_i_{iteration_number}_b_{0}")
-                        # Adjusts the pixel values of the predicted image
-                        pred_src_mask = pred_image.add(1).div(2).clamp(0, 1)
-                        # Resizes the predicted image for applying the model
-                        pred_src_mask = transforms.Resize((512, 512))(pred_src_mask.unsqueeze(0))
-                        # Normalizes the predicted image
-                        pred_src_mask = transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))(pred_src_mask)
-                        # Pass the predicted src mask through FaceParser (netseg) after applying SpecificNorm (mean and standard deviation) to the mask (from utils/module.py)
-                        pred_src_mask = self.netSeg(self.spNorm(pred_src_mask))[0]
-                        # Resize image back to original 256
-                        pred_src_mask = transforms.Resize((256, 256))(pred_src_mask)
-                        # Extracts the parsing information from the predicted mask
-                        parsing = pred_src_mask.squeeze(0).detach().cpu().numpy().argmax(0)
-
-                        # Creates an empty array for the source base
-                        src_base = np.zeros((256, 256, 3))
-                         # Iterates over the color list
-                        for idx, color in enumerate(color_list):
-                            src_base[parsing == idx] = color # Assigns colors based on parsing indices
-                        src_base /= 255. # Normalizes the source base
-
-                        # Converts the source base to a torch tensor
-                        _src_base = torch.from_numpy(src_base)[:,:,0].to(self.device)
-                        # Reshapes the source base tensor
-                        _src_base = _src_base.unsqueeze(0).unsqueeze(0)
-
-                        # if we are at the final step
-                        if (
-                                self.mask is not None
-                                and j == total_steps
-                        ):
-                            if self.args.enforce_background:
-                                # Applies the target base as a mask to the predicted image (keep the target background)
-                                pred_image = (self.targ_image[0] * (1 - self.mask[0]) + pred_image * self.mask[0])
-                            else:
-                                # Applies the source base as a mask to the predicted image (keep the source background)
-                                pred_image = (self.targ_image[0] * (1 - _src_base[0]) + pred_image * _src_base[0])
-
-                        # Adjusts the pixel values of the predicted image to a PIL image
-                        pred_image = pred_image.add(1).div(2).clamp(0, 1)
-                        pred_image_pil = TF.to_pil_image(pred_image)
-
-                        # Adjusts the pixel values of the source image to a PIL image
-                        src_image_pil = self.src_image[0].add(1).div(2).clamp(0, 1)
-                        src_image_pil = TF.to_pil_image(src_image_pil)
-
-                        # Adjusts the pixel values of the target image to a PIL image
-                        targ_image_pil = self.targ_image[0].add(1).div(2).clamp(0, 1)
-                        targ_image_pil = TF.to_pil_image(targ_image_pil)
-
-                        # Retrieves the mask (generated before) and convert it to a PIL image
-                        mask_pil  = self.mask[0]
-                        self.mask_pil = TF.to_pil_image(mask_pil)
-
-                        # Compute the ID distance (ID loss) between the predicted image and the source image
-                        final_distance = self.id_distance(pred_image_pil, src_image_pil)
-                        # Format the distance value as a string
-                        formatted_distance = f"{final_distance:.4f}"
-
-                        # In our final step, we do the following
-                        if j == total_steps:
-                            # Remove dots from distance value to append it as file name
-                            path_friendly_distance = formatted_distance.replace(".", "")
-                            # Save the predicted image in Rank folder with the modified distance string as the filename
-                            pred_image_pil.save(self.RankPath+ str(path_friendly_distance) + '.png')
-                            
-                            # Save the predicted image in output folder with the iteration number as the filename
-                            # pred_image_pil.save(self.args.output_path + '_' + str(iteration_number)+'.png')
-                            
-                            # Save the predicted image (the unmerged result)
-                            fname = targ_dataset.getfilename(step)
-                            pred_image_pil.save("./data/dst/preded/" + fname)
-
-                        # Append the predicted image to the intermediate samples list
-                        intermediate_samples[0].append(pred_image_pil)
-
-                        # I think this is unecessary as we are always inside the if
-                        # if should_save_image:
-
-                        # This function from (utils/visualization)
-                        # It outputs the result grid image we find in the output folder
-                        show_editied_masked_image(
-                            title='Results',
-                            source_image=src_image_pil,
-                            target_image=targ_image_pil,
-                            edited_image=pred_image_pil,
-                            mask=self.mask_pil,
-                            targ_parser=targ_base,
-                            src_parser=src_base,
-                            path=visualization_path,
-                            distance=formatted_distance,
-                        )
+        final_distances = []
+
+        # The src image is decoded only once, it is the same for every dst frame
+        src_image = PrefetchLoader(src_dataset, 1, self.device).load(0) # only one src image
+        # TODO document
+        src_image = src_image * 2.0 - 1.0
+
+        # Only the top_k best candidates of every frame are written
+        candidates = self.args.iterations_num
+        top_k = min(self.args.top_k, candidates)
+
+        # We will be iterating over each batch of targ images (with the same src image) for processing
+        for step, targ_image in enumerate(targ_loader):
+            # Number of dst frames in this batch and their index in the dst dataset
+            batch_size = targ_image.shape[0]
+            frames = [step * self.args.batch_size + b for b in range(batch_size)]
+            targ_image = targ_image * 2.0 - 1.0
+
+            # The eye boxes come from FAN or from the landmarks saved with the aligned faces
+            landmarks = [(targ_dataset.getmeta(frame) or {}).get("landmarks") for frame in frames]
+            pred_images, distances, src_bases = self.swap_faces(src_image, targ_image, self.eye_coords(targ_image, landmarks))
+            final_distances.extend(distances.flatten().tolist())
+
+            # Rank the candidates of every frame, best (lowest distance) first
+            ranking = distances.argsort(dim=1)[:, :top_k].tolist()
+
+            # coloring the mask of every frame according to the specifiec color_list
+            targ_bases = [color_parsing(parsing) for parsing in self.context.targ_seg[::candidates].cpu().numpy().argmax(1)]
+
+            # Adjusts the pixel values of the source image to a PIL image
+            src_image_pil = self.src_image[0].add(1).div(2).clamp(0, 1)
+            src_image_pil = TF.to_pil_image(src_image_pil)
+
+            for b, frame in enumerate(frames):
+                # making output rank and step directories of the current frame
+                self.args.output_path = path + '/' + str(frame)
+                os.makedirs(self.args.output_path, exist_ok=True)
+                self.RankPath = path + '/Rank'+ str(frame) + '/'
+                os.makedirs(self.RankPath, exist_ok=True)
+
+                # Adjusts the pixel values of the target image to a PIL image
+                targ_image_pil = self.targ_image[b].add(1).div(2).clamp(0, 1)
+                targ_image_pil = TF.to_pil_image(targ_image_pil)
+
+                # Retrieves the mask (generated before) and convert it to a PIL image
+                mask_pil  = self.context.mask[b * candidates]
+                self.mask_pil = TF.to_pil_image(mask_pil)
+
+                # Only the top_k candidates of the frame are written
+                for rank, candidate in enumerate(ranking[b]):
+                    i = b * candidates + candidate
+                    pred_image_pil = TF.to_pil_image(pred_images[i])
+
+                    # Creates a file path for visualization (the file containing the visualisation progress)
+                    visualization_path = Path(os.path.join(self.args.output_path, self.args.output_file))
+                    # Modifies the stem of the visualization file path
+                    visualization_path = visualization_path.with_stem(f"{visualization_path.stem}_i_{candidate}_b_{0}")
+
+                    # Format the distance value as a string
+                    formatted_distance = f"{distances[b, candidate].item():.4f}"
+
+                    # Remove dots from distance value to append it as file name
+                    path_friendly_distance = formatted_distance.replace(".", "")
+                    # Save the predicted image in Rank folder with the modified distance string as the filename
+                    pred_image_pil.save(self.RankPath+ str(path_friendly_distance) + '.png')
+
+                    if rank == 0:
+                        # prints the value of the identity loss of the best candidate
+                        print('ID loss: {}'.format(formatted_distance))
+                        # Save the best predicted image (the unmerged result)
+                        fname = targ_dataset.getfilename(frame)
+                        pred_image_pil.save(self.preded_path + fname)
+
+                    # This function from (utils/visualization)
+                    # It outputs the result grid image we find in the output folder
+                    show_editied_masked_image(
+                        title='Results',
+                        source_image=src_image_pil,
+                        target_image=targ_image_pil,
+                        edited_image=pred_image_pil,
+                        mask=self.mask_pil,
+                        targ_parser=targ_bases[b],
+                        src_parser=src_bases[i],
+                        path=visualization_path,
+                        distance=formatted_distance,
+                    )
+
+        # Restore the output path changed per frame above
+        self.args.output_path = path
+
+        return final_distances
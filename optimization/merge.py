@@ -1,128 +1,178 @@
-import dlib
-import os
-import cv2
-import json
-import piexif
-import ffmpeg
-from optimization import pathex
-import numpy as np
-
-def merge_faces(args, extension):
-  input_path = "./data/dst/preded/"
-  output_path = "./data/dst/merged/"
-  reference_path = "./data/dst/"
-  aligned_path = "./data/dst/aligned/"
-
-  # for each image in input path
-  for filename in os.listdir(input_path):
-    file_path = os.path.join(input_path, 'dst.jpg')
-    if os.path.isfile(file_path):
-      image1 = os.path.join(reference_path, 'dst.' + extension) # the dst full image
-      image1 = cv2.imread(image1)
-      image2 = cv2.imread(file_path, cv2.IMREAD_UNCHANGED)
-
-      # %% Read in exif data
-      aligned_image = os.path.join(aligned_path, filename)
-      exif_dict = piexif.load(aligned_image)
-      # Extract the serialized data
-      user_comment = piexif.helper.UserComment.load(exif_dict["Exif"][piexif.ExifIFD.UserComment])
-      # Deserialize
-      d = json.loads(user_comment)
-      print(d)
-
-      # Get the inverted transform array
-      # Deserialize the JSON string to a nested Python list
-      inverse = json.loads(d["inverse"])
-      # Convert the transform_matrix_list back to a NumPy array
-      inverse = np.array(inverse)
-
-      height, width, _ = image1.shape
-      pheight = d["parenth"]
-      pwidth = d["parentw"]
-
-      # Apply the inverse transformation to the transformed image
-      image2 = cv2.warpAffine(
-        image2,
-        inverse,
-        (pwidth, pheight),
-        borderMode=0
-      )
-
-      # Resize image2 to dst dimentions
-      image2 = cv2.resize(image2, (width, height))
-
-      # Create a mask based on black pixels of image2
-      mask = cv2.cvtColor(image2, cv2.COLOR_BGR2GRAY)
-      mask = cv2.threshold(mask, 1, 255, cv2.THRESH_BINARY_INV)[1]
-
-      # Expand the mask to cover potential border
-      kernel = np.ones((20, 20), np.uint8)
-      mask = cv2.dilate(mask, kernel, iterations=1)
-
-      # Invert the mask to make black pixels transparent
-      mask_inv = cv2.bitwise_not(mask)
-
-      # Apply the mask to the images
-      image1_part = cv2.copyTo(image1, mask)
-      image2_part = cv2.copyTo(image2, mask_inv)
-
-      # Blend the two images together
-      result = cv2.add(image1_part, image2_part)
-
-      cv2.imwrite(os.path.join(output_path, filename), result)
-
-  # Now generate video
-  if os.path.exists("./data/dst.mp4"):
-    input_folder = "./data/dst/merged"
-    output_file = "./data/result.mp4"
-    reference_file = "./data/dst.mp4"
-    video_id = None
-    audio_id = None
-    ref_in_a = None
-    #probing reference file
-    probe = ffmpeg.probe(reference_file)
-    #getting first video and audio streams id with fps
-    for stream in probe['streams']:
-      if video_id is None and stream['codec_type'] == 'video':
-        video_id = stream['index']
-        fps = stream['r_frame_rate']
-        if audio_id is None and stream['codec_type'] == 'audio':
-          audio_id = stream['index']
-
-    if audio_id is not None:
-      #has audio track
-      ref_in_a = ffmpeg.input(reference_file)[str(audio_id)]
-
-    if fps is None:
-      fps = 25
-
-    input_image_paths = pathex.get_image_paths(input_folder)
-    i_in = ffmpeg.input('pipe:', format='image2pipe', r=fps)
-    output_args = [i_in]
-
-    if ref_in_a is not None:
-      output_args += [ref_in_a]
-
-    output_args += [output_file]
-
-    output_kwargs = {}
-
-    output_kwargs.update ({"c:v": "libx264",
-                            "crf": "0",
-                            "pix_fmt": "yuv420p",
-                          })
-
-    job = ( ffmpeg.output(*output_args, **output_kwargs).overwrite_output() )
-
-    try:
-      job_run = job.run_async(pipe_stdin=True)
-
-      for image_path in input_image_paths:
-        with open (image_path, "rb") as f:
-          image_bytes = f.read()
-          job_run.stdin.write (image_bytes)
-
-      job_run.stdin.close()
-      job_run.wait()
-    except:
-      print("ffmpeg fail, job commandline:" + str(job.compile()))
+import dlib
+import os
+import cv2
+import collections
+import multiprocessing
+import ffmpeg
+from optimization import pathex
+from face_crop_plus.utils import load_index
+import numpy as np
+
+# Half the size of the border (in pixels of the frame) removed around the pasted face
+MERGE_BORDER = 10
+
+# Pastes an edited (aligned) face back into the frame it was cropped from
+# frame is the full dst image and face the edited face (same channel order), inverse is the inverse of the alignment
+# transform and parent_size the (width, height) of the image the face was cropped from
+# Only the bounding box of the face in the frame is warped and blended, the rest of the frame is not touched
+def merge_face(frame, face, inverse, parent_size):
+  height, width, _ = frame.shape
+  pwidth, pheight = parent_size
+
+  # The inverse transformation goes from the face to the parent image, scale it to the frame size
+  inverse = np.asarray(inverse, dtype=np.float64)
+  inverse = np.diag([width / pwidth, height / pheight]) @ inverse
+
+  # Bounding box of the face in the frame (with a border for the erosion below), clipped to the frame
+  corners = np.float64([[0, 0], [face.shape[1], 0], [0, face.shape[0]], [face.shape[1], face.shape[0]]])
+  corners = cv2.transform(corners.reshape(-1, 1, 2), inverse).reshape(-1, 2)
+  x0, y0 = np.floor(corners.min(0)).astype(int) - MERGE_BORDER
+  x1, y1 = np.ceil(corners.max(0)).astype(int) + MERGE_BORDER
+  x0, y0 = max(x0, 0), max(y0, 0)
+  x1, y1 = min(x1, width), min(y1, height)
+  if x0 >= x1 or y0 >= y1:
+    # The face is out of the frame
+    return frame
+
+  # Apply the inverse transformation to the face, into the bounding box only
+  roi_inverse = inverse.copy()
+  roi_inverse[:, 2] -= (x0, y0)
+  face = cv2.warpAffine(
+    face,
+    roi_inverse,
+    (x1 - x0, y1 - y0),
+    borderMode=0
+  )
+
+  # Create a mask of the face (the black pixels are where the face is not)
+  mask = cv2.cvtColor(face, cv2.COLOR_BGR2GRAY)
+  mask = cv2.threshold(mask, 1, 255, cv2.THRESH_BINARY)[1]
+
+  # Shrink the mask to remove the potential border
+  kernel = np.ones((2 * MERGE_BORDER, 2 * MERGE_BORDER), np.uint8)
+  mask = cv2.erode(mask, kernel, iterations=1)
+
+  # Blend the face into the frame
+  merged = frame.copy()
+  roi = merged[y0:y1, x0:x1]
+  cv2.copyTo(face, mask, roi)
+  return merged
+
+# Probes a video, returns the frame rate of its first video stream, the index of its first audio stream (None if it
+# has no audio) and the frame size
+def probe_video(reference_file):
+  fps = None
+  audio_id = None
+  width = height = None
+  #probing reference file
+  probe = ffmpeg.probe(reference_file)
+  #getting first video and audio streams id with fps
+  for stream in probe['streams']:
+    if fps is None and stream['codec_type'] == 'video':
+      fps = stream['r_frame_rate']
+      width, height = int(stream['width']), int(stream['height'])
+    if audio_id is None and stream['codec_type'] == 'audio':
+      audio_id = stream['index']
+
+  if fps is None:
+    fps = 25
+
+  return fps, audio_id, width, height
+
+# The encoder options of the result video (--codec, --preset and --crf)
+def encoder_options(args):
+  return {"codec": args.codec, "preset": args.preset, "crf": args.crf}
+
+# Starts an ffmpeg process encoding raw frames of the given size (pix_fmt is rgb24 or bgr24), written to its stdin,
+# into output_file. The audio track of reference_file (if any) is copied to the output
+def start_video_writer(reference_file, output_file, width, height, fps, audio_id, pix_fmt='rgb24', codec='libx264', preset='medium', crf=18):
+  i_in = ffmpeg.input('pipe:', format='rawvideo', pix_fmt=pix_fmt, s=f'{width}x{height}', r=fps)
+  output_args = [i_in]
+
+  if audio_id is not None:
+    #has audio track
+    output_args += [ffmpeg.input(reference_file)[str(audio_id)]]
+
+  output_args += [output_file]
+
+  output_kwargs = {"c:v": codec,
+                   "crf": str(crf),
+                   "pix_fmt": "yuv420p",
+                  }
+  if preset is not None:
+    output_kwargs["preset"] = preset
+
+  job = ffmpeg.output(*output_args, **output_kwargs).overwrite_output()
+  return job.run_async(pipe_stdin=True)
+
+# Merges the edited faces of a dst image back into it, returns the merged image (BGR)
+# faces are the index records (see face_crop_plus.utils.save_index) of the faces cropped from the image
+def merge_image(image_path, input_path, faces):
+  image = cv2.imread(image_path)
+
+  for record in faces:
+    # The edited face has the name of the aligned face
+    face_path = os.path.join(input_path, record["name"])
+    if not os.path.isfile(face_path):
+      # This face was not edited
+      continue
+
+    face = cv2.imread(face_path, cv2.IMREAD_UNCHANGED)
+
+    # Paste the edited face back into the dst image
+    image = merge_face(image, face, record["inverse"], tuple(record["parent"]))
+
+  return image
+
+# The index records of the aligned faces of aligned_path, grouped by the dst image they were cropped from
+def faces_by_source(aligned_path):
+  faces = collections.defaultdict(list)
+  for record in load_index(aligned_path).values():
+    faces[record["source"]].append(record)
+  return faces
+
+# Merges the dst images (see merge_image) on a pool of worker processes, yields the merged images in order
+# At most 2 images per worker are merged ahead of the consumer (e.g. the encoder)
+def merge_images(image_paths, input_path, aligned_path, workers=None):
+  workers = workers or os.cpu_count()
+  # The crop metadata of all the faces, read once
+  faces = faces_by_source(aligned_path)
+  with multiprocessing.Pool(workers) as pool:
+    pending = collections.deque()
+    for image_path in image_paths:
+      image_faces = faces.get(os.path.basename(image_path), [])
+      pending.append(pool.apply_async(merge_image, (image_path, input_path, image_faces)))
+      if len(pending) >= 2 * workers:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
+
+def merge_faces(args, extension):
+  input_path = "./data/dst/preded/"
+  output_path = "./data/dst/merged/"
+  reference_path = "./data/dst/"
+  aligned_path = "./data/dst/aligned/"
+
+  if extension != "mp4":
+    # the dst full image
+    image_path = os.path.join(reference_path, 'dst.' + extension)
+    result = merge_image(image_path, input_path, faces_by_source(aligned_path).get(os.path.basename(image_path), []))
+    cv2.imwrite(os.path.join(output_path, 'dst.jpg'), result)
+    return
+
+  # Now generate video
+  # The merged frames are piped to ffmpeg as raw frames, in order, without being written to disk
+  output_file = "./data/result.mp4"
+  reference_file = "./data/dst.mp4"
+  fps, audio_id, width, height = probe_video(reference_file)
+  job_run = start_video_writer(reference_file, output_file, width, height, fps, audio_id, pix_fmt='bgr24', **encoder_options(args))
+
+  try:
+    image_paths = pathex.get_image_paths(reference_path)
+    for merged in merge_images(image_paths, input_path, aligned_path, args.merge_workers):
+      job_run.stdin.write(merged.tobytes())
+
+    job_run.stdin.close()
+    job_run.wait()
+  except:
+    print("ffmpeg fail, job commandline:" + " ".join(job_run.args))
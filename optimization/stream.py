@@ -0,0 +1,186 @@
+import cv2
+import queue
+import ffmpeg
+import threading
+import numpy as np
+
+from optimization.merge import merge_face, probe_video, start_video_writer, encoder_options
+
+
+# Streaming version of main.py for videos: the frames go from ffmpeg (decode) to the Cropper, the ImageEditor,
+# the merge and ffmpeg (encode) through bounded in-memory queues, nothing is written to ./data/dst.
+# Every stage runs in its own thread (the ImageEditor in the calling one), so decoding, cropping, merging and
+# encoding overlap with the sampling. queue_size bounds the number of frames waiting between two stages.
+class VideoStream:
+    def __init__(self, cropper, image_editor, queue_size=16):
+        self.cropper = cropper
+        self.image_editor = image_editor
+        self.queue_size = queue_size
+        self.stop = threading.Event()
+        self.errors = []
+
+    # Puts an item in a queue, waiting for room unless the pipeline is stopping
+    def put(self, items, item):
+        while not self.stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # Gets the next item of a queue, None at the end of the stream or if the pipeline is stopping
+    def get(self, items):
+        while not self.stop.is_set():
+            try:
+                return items.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    # Runs a stage, any error stops the whole pipeline and is raised again by run
+    def stage(self, target, *args):
+        def run_stage():
+            try:
+                target(*args)
+            except Exception as e:
+                self.errors.append(e)
+                self.stop.set()
+        thread = threading.Thread(target=run_stage, daemon=True)
+        thread.start()
+        return thread
+
+    # Decodes the input video to rgb24 frames of shape (height, width, 3)
+    def decode(self, input_file, width, height, frames):
+        process = (
+            ffmpeg.input(input_file)
+            .output('pipe:', format='rawvideo', pix_fmt='rgb24')
+            .run_async(pipe_stdout=True, quiet=True)
+        )
+        frame_size = width * height * 3
+        try:
+            while not self.stop.is_set():
+                data = process.stdout.read(frame_size)
+                if len(data) < frame_size:
+                    break
+                if not self.put(frames, np.frombuffer(data, np.uint8).reshape(height, width, 3)):
+                    return
+            self.put(frames, None)
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+
+    # Crops the aligned face of every frame, Cropper.batch_size frames at a time
+    # Every frame goes on as [frame, face, meta], face and meta are None if no face was found
+    def crop(self, frames, crops):
+        done = False
+        while not done:
+            batch = []
+            while len(batch) < self.cropper.batch_size:
+                frame = self.get(frames)
+                if frame is None:
+                    done = True
+                    break
+                batch.append(frame)
+
+            if len(batch) == 0:
+                break
+
+            items = [[frame, None, None] for frame in batch]
+            faces, indices, transformed_meta, _ = self.cropper.process_images(batch)
+            for face, index, meta in zip(faces, indices, transformed_meta):
+                # One face per frame (strategy "largest"), the first one is kept otherwise
+                if items[index][1] is None:
+                    items[index][1:] = [face, meta]
+
+            for item in items:
+                if not self.put(crops, item):
+                    return
+
+        if not self.stop.is_set():
+            self.put(crops, None)
+
+    # Pastes the edited faces back into their frames and encodes them
+    def encode(self, merges, writer):
+        while (item := self.get(merges)) is not None:
+            frame, face, meta = item
+            if face is not None:
+                # meta = [x, y, w, h, parentw, parenth, inverse, landmarks] (see Cropper.crop_align)
+                frame = merge_face(frame, face, meta[6], (int(meta[4]), int(meta[5])))
+            writer.stdin.write(np.ascontiguousarray(frame).tobytes())
+
+    # Swaps the faces of the pending frames (in one ImageEditor batch) and sends the frames on, in order
+    def edit(self, src_face, pending, merges):
+        edited = [item for item in pending if item[1] is not None]
+        if len(edited) > 0:
+            faces = np.stack([item[1] for item in edited])
+            landmarks = [item[2][7] for item in edited]
+            for item, face in zip(edited, self.image_editor.edit_faces(src_face, faces, landmarks)):
+                item[1] = face
+
+        for item in pending:
+            if not self.put(merges, item):
+                return False
+        return True
+
+    # Swaps the face of src_image (an RGB uint8 image) into every frame of input_file, the result is written to output_file
+    # (with the audio of input_file)
+    def run(self, src_image, input_file, output_file):
+        # The aligned src face, cropped once (detected, it is not a frame of the video)
+        tracker, self.cropper.tracker = self.cropper.tracker, None
+        src_faces, _, _, _ = self.cropper.process_images([src_image])
+        self.cropper.tracker = tracker
+        if len(src_faces) == 0:
+            raise ValueError("No face found in the src image")
+        src_face = src_faces[0]
+
+        if tracker is not None:
+            # the frames are tracked from the first one
+            tracker.reset()
+
+        fps, audio_id, width, height = probe_video(input_file)
+        writer = start_video_writer(input_file, output_file, width, height, fps, audio_id, **encoder_options(self.image_editor.args))
+
+        frames = queue.Queue(maxsize=self.queue_size)
+        crops = queue.Queue(maxsize=self.queue_size)
+        merges = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            self.stage(self.decode, input_file, width, height, frames),
+            self.stage(self.crop, frames, crops),
+            self.stage(self.encode, merges, writer),
+        ]
+
+        try:
+            # The editor runs in this thread, it samples batch_size faces at a time
+            # (frames without a face wait for the faces before them, so the frames stay in order)
+            pending, num_faces = [], 0
+            while (item := self.get(crops)) is not None:
+                pending.append(item)
+                num_faces += item[1] is not None
+                if num_faces == self.image_editor.args.batch_size or num_faces == 0:
+                    if not self.edit(src_face, pending, merges):
+                        break
+                    pending, num_faces = [], 0
+
+            if not self.stop.is_set() and self.edit(src_face, pending, merges):
+                self.put(merges, None)
+        except BaseException:
+            self.stop.set()
+            raise
+        finally:
+            # Wait for the merge and encode stage to write every frame
+            threads[2].join()
+            self.stop.set()
+            for thread in threads[:2]:
+                thread.join()
+            writer.stdin.close()
+            writer.wait()
+
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+
+# Reads the src image (any format OpenCV reads) as an RGB uint8 image
+def read_src_image(path):
+    return cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
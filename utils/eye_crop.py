@@ -1,4 +1,4 @@
-import face_alignment
+import numpy as np
 import torch
 def get_eye_coords(fa, image):
     image = image.squeeze(0)
@@ -22,3 +22,17 @@ def get_eye_coords(fa, image):
     eye_y_average = (right_eye_left[1] + right_eye_right[1]) // 2
     right_eye = [int(right_eye_left[0]) - x, int(eye_y_average - y), int(right_eye_right[0]) + x, int(eye_y_average + y)]
     return [*left_eye, *right_eye]
+
+def get_eye_coords_from_landmarks(landmarks, image_size):
+    # 5 point landmarks (left eye, right eye, nose, left mouth, right mouth) in [0, 1],
+    # as saved with the aligned faces, instead of running the 68 point FAN on the image
+    landmarks = np.asarray(landmarks, dtype=np.float32) * image_size
+
+    # The eye corners are not known, an eye is about half as wide as the distance between the eyes
+    half_width = 0.24 * np.linalg.norm(landmarks[1] - landmarks[0])
+
+    x, y = 5, 9
+    eyes = []
+    for eye_x, eye_y in landmarks[:2]:
+        eyes += [int(eye_x - half_width) - x, int(eye_y - y), int(eye_x + half_width) + x, int(eye_y + y)]
+    return eyes